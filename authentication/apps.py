@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class AuthenticationConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "authentication"
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from .authentication import invalidate_cached_user
+
+        User = get_user_model()
+        post_save.connect(invalidate_cached_user, sender=User)
+        post_delete.connect(invalidate_cached_user, sender=User)
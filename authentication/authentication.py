@@ -0,0 +1,64 @@
+"""
+JWT authentication that serves the token's user from a short-lived cache.
+
+simplejwt's JWTAuthentication loads the User row on every request. Here the
+row is cached under its id in the AUTH_USER_CACHE_ALIAS cache for
+AUTH_USER_CACHE_TTL seconds. User post_save/post_delete signals (connected
+in AuthenticationConfig.ready) delete the entry, so saves, deactivation and
+password changes apply to the next request. With a shared cache (Redis,
+Memcached) that covers every worker. With the default per-process cache,
+other workers see the change within the TTL. Token validation, including
+the blacklist check for token classes that have one, is unchanged.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+USER_CACHE_KEY = 'auth:user:{}'
+
+
+def user_cache():
+    return caches[settings.AUTH_USER_CACHE_ALIAS]
+
+
+def get_cached_user(user_id):
+    """The user with the given id, from the cache when possible; None if it does not exist"""
+    key = USER_CACHE_KEY.format(user_id)
+    user = user_cache().get(key)
+    if user is None:
+        User = get_user_model()
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is not None:
+            user_cache().set(key, user, settings.AUTH_USER_CACHE_TTL)
+    return user
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache().delete(USER_CACHE_KEY.format(getattr(instance, api_settings.USER_ID_FIELD)))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        """Same checks as JWTAuthentication.get_user, with the user lookup cached"""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        user = get_cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
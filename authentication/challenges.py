@@ -0,0 +1,119 @@
+"""
+Storage for pending WebAuthn challenges between the begin and complete steps.
+
+Each backend stores a challenge with a TTL and hands it out at most once:
+consume() atomically removes it, so a challenge cannot be replayed and two
+concurrent completes cannot both succeed. Backend selection is controlled by
+settings.WEBAUTHN_CHALLENGE_STORE.
+"""
+import heapq
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .models import WebAuthnChallenge
+
+
+class MemoryChallengeStore:
+    """Per-process dict; expiry via a heap of deadlines, so purges never scan"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.challenges = {}  # challenge_id -> (data, expires_at)
+        self.deadlines = []   # heap of (expires_at, challenge_id)
+        self.lock = threading.Lock()
+
+    def put(self, challenge_id, data, ttl):
+        expires_at = self.clock() + ttl
+        with self.lock:
+            self.purge_expired()
+            self.challenges[challenge_id] = (data, expires_at)
+            heapq.heappush(self.deadlines, (expires_at, challenge_id))
+
+    def consume(self, challenge_id):
+        with self.lock:
+            entry = self.challenges.pop(challenge_id, None)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        return entry[0]
+
+    def purge_expired(self):
+        now = self.clock()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            expires_at, challenge_id = heapq.heappop(self.deadlines)
+            entry = self.challenges.get(challenge_id)
+            # Consumed or re-put entries leave stale deadlines behind
+            if entry is not None and entry[1] == expires_at:
+                del self.challenges[challenge_id]
+
+
+class CacheChallengeStore:
+    """Django cache backend; expiry is the cache's native TTL.
+
+    Shared across workers and nodes when the cache is (e.g.) Redis or
+    Memcached. consume() claims the challenge with cache.add(), which is
+    atomic on those backends, before reading and deleting it.
+    """
+
+    key_prefix = 'webauthn:challenge:'
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def put(self, challenge_id, data, ttl):
+        self.cache.set(self.key_prefix + challenge_id, data, ttl)
+
+    def consume(self, challenge_id):
+        key = self.key_prefix + challenge_id
+        if not self.cache.add(key + ':claimed', True, settings.WEBAUTHN_CHALLENGE_TTL):
+            return None
+        data = self.cache.get(key)
+        self.cache.delete(key)
+        return data
+
+
+class DatabaseChallengeStore:
+    """WebAuthnChallenge rows; expired rows are purged with a range delete on expires_at"""
+
+    def put(self, challenge_id, data, ttl):
+        now = timezone.now()
+        WebAuthnChallenge.objects.filter(expires_at__lte=now).delete()
+        WebAuthnChallenge.objects.create(
+            challenge_id=challenge_id, data=data, expires_at=now + timedelta(seconds=ttl)
+        )
+
+    def consume(self, challenge_id):
+        challenge = WebAuthnChallenge.objects.filter(
+            challenge_id=challenge_id, expires_at__gt=timezone.now()
+        ).first()
+        if challenge is None:
+            return None
+        # Only the request whose DELETE removes the row gets the challenge
+        deleted = WebAuthnChallenge.objects.filter(pk=challenge.pk).delete()[0]
+        return challenge.data if deleted else None
+
+
+CHALLENGE_STORES = {
+    'memory': MemoryChallengeStore,
+    'cache': lambda: CacheChallengeStore(settings.WEBAUTHN_CHALLENGE_CACHE_ALIAS),
+    'database': DatabaseChallengeStore,
+}
+
+challenge_stores = {}
+challenge_stores_lock = threading.Lock()
+
+
+def get_challenge_store():
+    """The configured store; one instance per process and backend name"""
+    name = settings.WEBAUTHN_CHALLENGE_STORE
+    with challenge_stores_lock:
+        if name not in challenge_stores:
+            try:
+                challenge_stores[name] = CHALLENGE_STORES[name]()
+            except KeyError:
+                raise ValueError(f"Unknown WEBAUTHN_CHALLENGE_STORE: {name!r}") from None
+        return challenge_stores[name]
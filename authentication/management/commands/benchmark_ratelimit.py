@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from authentication.ratelimit import CacheRateLimitBackend, LocalRateLimitBackend
+
+
+def list_check(attempts, key, max_attempts=5, window_minutes=5):
+    """The list-of-datetimes check this limiter replaced, for comparison"""
+    now = datetime.now()
+    window_start = now - timedelta(minutes=window_minutes)
+    attempts[key] = [attempt for attempt in attempts.get(key, []) if attempt > window_start]
+    if len(attempts[key]) >= max_attempts:
+        return False
+    attempts[key].append(now)
+    return True
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure per-check overhead of the rate limiter backends against the "
+        "previous list-based check. The cache backend uses the configured "
+        "cache alias, so point it at the cache you deploy with."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=100000, help='Checks per backend')
+        parser.add_argument('--keys', type=int, default=1000, help='Distinct keys to spread the checks over')
+        parser.add_argument('--cache-alias', default='default', help='Cache alias for the cache backend')
+
+    def handle(self, *args, **options):
+        checks = options['checks']
+        keys = [f'benchmark:{i}' for i in range(options['keys'])]
+
+        attempts = {}
+        self.run('list (previous)', checks, keys, lambda key: list_check(attempts, key))
+
+        local = LocalRateLimitBackend()
+        self.run('local sliding window', checks, keys, lambda key: local.hit(key, 5, 300))
+
+        cache = CacheRateLimitBackend(options['cache_alias'])
+        self.run(f'cache sliding window ({options["cache_alias"]})', checks, keys, lambda key: cache.hit(key, 5, 300))
+        for key in keys:
+            cache.cache.delete_many([f'{cache.key_prefix}{key}:{int(time.time() // 300) + offset}' for offset in (-1, 0)])
+
+    def run(self, label, checks, keys, check):
+        start = time.perf_counter()
+        for i in range(checks):
+            check(keys[i % len(keys)])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"{label}: {elapsed / checks * 1e6:.2f} us/check ({checks / elapsed:,.0f} checks/s)")
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_delete_contact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebAuthnChallenge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('challenge_id', models.CharField(max_length=64, unique=True)),
+                ('data', models.JSONField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -31,3 +31,14 @@ class WebAuthnCredential(models.Model):
         """Increment the signature count"""
         self.sign_count += 1
         self.save(update_fields=['sign_count'])
+
+
+class WebAuthnChallenge(models.Model):
+    """Pending WebAuthn ceremony challenge for the database challenge store"""
+
+    challenge_id = models.CharField(max_length=64, unique=True)
+    data = models.JSONField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Challenge {self.challenge_id} (expires {self.expires_at})"
@@ -0,0 +1,224 @@
+"""
+Sliding-window-counter rate limiting, exposed as DRF throttles.
+
+Each key keeps two counters: hits in the current fixed window and hits in the
+previous one. The rate over the last full window is estimated as
+previous * (unexpired fraction of the previous window) + current, so memory
+per key is constant however many requests arrive.
+
+Backends (settings.RATE_LIMIT_BACKEND):
+- 'local': per-process dict, with keys kept in LRU order per window length.
+  Keys idle for two of their own windows are evicted from the head of
+  their group, and it never holds more than RATE_LIMIT_LOCAL_MAX_KEYS keys.
+- 'cache': counters in the RATE_LIMIT_CACHE_ALIAS cache, updated with atomic
+  incr(). This is shared by all workers when the cache is Redis or
+  Memcached, and idle keys expire through the cache TTL. Counter keys carry
+  a generation number, so clear() forgets them without flushing the cache
+  the other features share.
+
+Rates use DRF's DEFAULT_THROTTLE_RATES, extended with a window multiplier:
+'5/5m' means five requests per five minutes.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+RATE_PATTERN = re.compile(r'^(\d+)/(\d*)([smhd])')
+PERIOD_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'10/5m' -> (10, 300)"""
+    match = RATE_PATTERN.match(rate)
+    if not match:
+        raise ValueError(f"Invalid rate: {rate!r}")
+    limit, multiplier, period = match.groups()
+    return int(limit), int(multiplier or 1) * PERIOD_SECONDS[period]
+
+
+def sliding_window_decision(limit, window, now, current, previous):
+    """Return (allowed, wait_seconds) for one more hit in the current window"""
+    elapsed = (now % window) / window
+    estimate = previous * (1 - elapsed) + current
+    if estimate + 1 <= limit:
+        return True, 0
+    remaining = window * (1 - elapsed)
+    if not previous:
+        return False, remaining
+    # The previous window's share decays linearly to zero at the window end
+    return False, min((estimate + 1 - limit) * window / previous, remaining)
+
+
+class LocalRateLimitBackend:
+    def __init__(self, max_keys=100000, clock=time.time):
+        self.max_keys = max_keys
+        self.clock = clock
+        self.counters = {}  # key -> [window index, current, previous, window]
+        # Keys in LRU order per window length, so each group's head is its most idle key
+        self.recent = defaultdict(OrderedDict)
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        now = self.clock()
+        index = int(now // window)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or counter[3] != window:
+                if counter is not None:
+                    del self.recent[counter[3]][key]
+                counter = self.counters[key] = [index, 0, 0, window]
+            elif counter[0] != index:
+                counter[2] = counter[1] if counter[0] == index - 1 else 0
+                counter[0], counter[1] = index, 0
+            self.recent[window][key] = None
+            self.recent[window].move_to_end(key)
+            allowed, wait = sliding_window_decision(limit, window, now, counter[1], counter[2])
+            if allowed:
+                counter[1] += 1
+            self.evict_idle(now)
+            return allowed, wait
+
+    def idle_windows(self, now, window, keys):
+        """Whole windows since the last hit on the head of a window group"""
+        return int(now // window) - self.counters[next(iter(keys))][0]
+
+    def evict_idle(self, now):
+        # Keys untouched for two of their windows have nothing left to count
+        for window, keys in self.recent.items():
+            while keys and self.idle_windows(now, window, keys) >= 2:
+                del self.counters[keys.popitem(last=False)[0]]
+        while len(self.counters) > self.max_keys:
+            # The key idle for most of its windows goes first, then the one with the shortest window
+            window, keys = max(
+                ((window, keys) for window, keys in self.recent.items() if keys),
+                key=lambda group: (self.idle_windows(now, *group), -group[0]),
+            )
+            del self.counters[keys.popitem(last=False)[0]]
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.recent.clear()
+
+
+class CacheRateLimitBackend:
+    key_prefix = 'ratelimit:'
+    generation_key = 'ratelimit:generation'
+
+    def __init__(self, alias='default', clock=time.time):
+        self.cache = caches[alias]
+        self.clock = clock
+
+    def generation(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            self.cache.add(self.generation_key, 1, None)
+            generation = self.cache.get(self.generation_key, 1)
+        return generation
+
+    def hit(self, key, limit, window):
+        now = self.clock()
+        index = int(now // window)
+        prefix = f'{self.key_prefix}{self.generation()}:{key}'
+        current_key = f'{prefix}:{index}'
+        current = self.incr(current_key, window)
+        previous = self.cache.get(f'{prefix}:{index - 1}', 0)
+        # current already includes this hit
+        allowed, wait = sliding_window_decision(limit, window, now, current - 1, previous)
+        if not allowed:
+            self.cache.decr(current_key)
+        return allowed, wait
+
+    def incr(self, key, window):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Counters live for two windows: current, then as the previous one
+            if self.cache.add(key, 1, 2 * window):
+                return 1
+            return self.cache.incr(key)
+
+    def clear(self):
+        """Forget every counter; the old generation's keys expire on their own"""
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            self.cache.add(self.generation_key, 2, None)
+
+
+RATE_LIMIT_BACKENDS = {
+    'local': lambda: LocalRateLimitBackend(settings.RATE_LIMIT_LOCAL_MAX_KEYS),
+    'cache': lambda: CacheRateLimitBackend(settings.RATE_LIMIT_CACHE_ALIAS),
+}
+
+rate_limit_backends = {}
+rate_limit_backends_lock = threading.Lock()
+
+
+def get_rate_limit_backend():
+    """The configured backend; one instance per process and backend name"""
+    name = settings.RATE_LIMIT_BACKEND
+    with rate_limit_backends_lock:
+        if name not in rate_limit_backends:
+            try:
+                rate_limit_backends[name] = RATE_LIMIT_BACKENDS[name]()
+            except KeyError:
+                raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {name!r}") from None
+        return rate_limit_backends[name]
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """Throttle keyed on the client IP, at the rate configured for `scope`"""
+
+    scope = None
+
+    def get_rate(self):
+        return api_settings.DEFAULT_THROTTLE_RATES[self.scope]
+
+    def get_ident_for(self, request):
+        return self.get_ident(request)
+
+    def allow_request(self, request, view):
+        limit, window = parse_rate(self.get_rate())
+        key = f'{self.scope}:{self.get_ident_for(request)}'
+        allowed, self.wait_seconds = get_rate_limit_backend().hit(key, limit, window)
+        return allowed
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UsernameThrottle(SlidingWindowThrottle):
+    """Throttle keyed on the submitted username, or the client IP without one"""
+
+    def get_ident_for(self, request):
+        username = request.data.get('username') if hasattr(request.data, 'get') else None
+        if isinstance(username, str) and username:
+            return f'user:{username.lower()}'
+        return self.get_ident(request)
+
+
+class LoginRateThrottle(UsernameThrottle):
+    scope = 'login'
+
+
+class LoginIPRateThrottle(SlidingWindowThrottle):
+    scope = 'login_ip'
+
+
+class RegisterRateThrottle(SlidingWindowThrottle):
+    scope = 'register'
+
+
+class WebAuthnBeginRateThrottle(UsernameThrottle):
+    scope = 'webauthn_begin'
+
+
+class WebAuthnCompleteRateThrottle(UsernameThrottle):
+    scope = 'webauthn_complete'
@@ -1,3 +1,241 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.settings import api_settings as jwt_api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, SlidingToken
+
+from .challenges import CacheChallengeStore, DatabaseChallengeStore, MemoryChallengeStore, challenge_stores
+from .models import WebAuthnChallenge
+from .ratelimit import CacheRateLimitBackend, LocalRateLimitBackend, get_rate_limit_backend
+
+
+class AuthQueryBudgetTests(TestCase):
+    """Fixed query budgets for the authentication endpoints"""
+
+    def setUp(self):
+        get_rate_limit_backend().clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+
+    def test_register_budget(self):
+        # username uniqueness, insert
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/auth/register/', {
+                'username': 'bob',
+                'email': 'bob@example.com',
+                'first_name': 'Bob',
+                'last_name': 'Builder',
+                'password': 'Sup3r-secret-pw',
+                'password_confirm': 'Sup3r-secret-pw',
+            })
+        self.assertEqual(response.status_code, 201)
+
+    def test_login_budget(self):
+        # user lookup, outstanding refresh token
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/auth/login/', {'username': 'alice', 'password': 'pass12345'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_profile_budget(self):
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        # user
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/auth/profile/')
+        self.assertEqual(response.data['username'], 'alice')
+
+    def test_webauthn_register_begin_budget(self):
+        # user lookup, expired challenge purge, challenge insert
+        with self.assertNumQueries(3):
+            response = self.client.post('/api/auth/webauthn/register/begin/', {'username': 'alice'})
+        self.assertIn('challenge_id', response.data)
+
+
+class ChallengeStoreTests(TestCase):
+    def setUp(self):
+        get_rate_limit_backend().clear()
+
+    def assert_single_use(self, store):
+        store.put('abc', {'challenge': 'Y2hhbGxlbmdl', 'type': 'registration'}, 60)
+        self.assertEqual(store.consume('abc'), {'challenge': 'Y2hhbGxlbmdl', 'type': 'registration'})
+        self.assertIsNone(store.consume('abc'))
+        self.assertIsNone(store.consume('missing'))
+
+    def test_memory_store(self):
+        now = [0.0]
+        store = MemoryChallengeStore(clock=lambda: now[0])
+        self.assert_single_use(store)
+
+        store.put('old', {}, 10)
+        store.put('new', {}, 100)
+        now[0] = 50
+        self.assertIsNone(store.consume('old'))
+        store.put('old', {}, 10)
+        now[0] = 70
+        store.put('newer', {}, 100)
+        # Expired entries are dropped from the head of the deadline heap
+        self.assertEqual(set(store.challenges), {'new', 'newer'})
+
+    def test_cache_store(self):
+        caches['default'].clear()
+        self.assert_single_use(CacheChallengeStore('default'))
+
+    def test_database_store(self):
+        store = DatabaseChallengeStore()
+        self.assert_single_use(store)
+        self.assertFalse(WebAuthnChallenge.objects.exists())
+
+        store.put('stale', {}, -1)
+        self.assertIsNone(store.consume('stale'))
+        store.put('fresh', {}, 60)
+        self.assertEqual(list(WebAuthnChallenge.objects.values_list('challenge_id', flat=True)), ['fresh'])
+
+    @override_settings(WEBAUTHN_CHALLENGE_STORE='database')
+    def test_challenge_cannot_be_replayed(self):
+        challenge_stores.clear()
+        User.objects.create_user(username='alice', password='pass12345')
+        client = APIClient()
+        challenge_id = client.post('/api/auth/webauthn/register/begin/', {'username': 'alice'}).data['challenge_id']
+        complete = {
+            'username': 'alice',
+            'challenge_id': challenge_id,
+            'credential_id': 'Y3JlZA==',
+            'attestation_object': 'b2JqZWN0',
+            'client_data_json': 'e30=',
+        }
+        first = client.post('/api/auth/webauthn/register/complete/', complete)
+        self.assertNotEqual(first.data.get('error'), 'Invalid or expired challenge')
+        second = client.post('/api/auth/webauthn/register/complete/', complete)
+        self.assertEqual(second.status_code, 400)
+        self.assertEqual(second.data['error'], 'Invalid or expired challenge')
+
+    @override_settings(WEBAUTHN_CHALLENGE_STORE='database')
+    def test_authentication_rejects_a_registration_challenge(self):
+        user = User.objects.create_user(username='alice', password='pass12345')
+        DatabaseChallengeStore().put('reg', {'challenge': 'Y2hhbA==', 'username': 'alice', 'type': 'registration'}, 60)
+        response = APIClient().post('/api/auth/webauthn/authenticate/complete/', {
+            'username': user.username, 'challenge_id': 'reg', 'credential_id': 'Y3JlZA==',
+            'authenticator_data': 'ZGF0YQ==', 'client_data_json': 'e30=', 'signature': 'c2ln',
+        })
+        self.assertEqual(response.data['error'], 'Invalid or expired challenge')
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        get_rate_limit_backend().clear()
+
+    def assert_sliding_window(self, backend, now):
+        for _ in range(5):
+            self.assertEqual(backend.hit('k', 5, 60), (True, 0))
+        allowed, wait = backend.hit('k', 5, 60)
+        self.assertFalse(allowed)
+        self.assertEqual(wait, 60)
+
+        # Halfway through the next window half of the previous window still counts
+        now[0] = 90
+        self.assertTrue(backend.hit('k', 5, 60)[0])
+        self.assertTrue(backend.hit('k', 5, 60)[0])
+        allowed, wait = backend.hit('k', 5, 60)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 6)
+        self.assertTrue(backend.hit('other', 5, 60)[0])
+
+        now[0] = 300
+        self.assertTrue(backend.hit('k', 5, 60)[0])
+
+    def test_local_backend(self):
+        now = [0.0]
+        self.assert_sliding_window(LocalRateLimitBackend(clock=lambda: now[0]), now)
+
+    def test_cache_backend(self):
+        caches['default'].clear()
+        now = [0.0]
+        self.assert_sliding_window(CacheRateLimitBackend('default', clock=lambda: now[0]), now)
+
+    def test_local_backend_evicts_idle_and_excess_keys(self):
+        now = [0.0]
+        backend = LocalRateLimitBackend(max_keys=3, clock=lambda: now[0])
+        for key in ('a', 'b', 'c', 'd'):
+            backend.hit(key, 5, 60)
+        self.assertEqual(list(backend.counters), ['b', 'c', 'd'])
+
+        now[0] = 130
+        backend.hit('e', 5, 60)
+        self.assertEqual(list(backend.counters), ['e'])
+
+    def test_local_backend_measures_idleness_per_window(self):
+        now = [0.0]
+        backend = LocalRateLimitBackend(max_keys=2, clock=lambda: now[0])
+        self.assertTrue(backend.hit('daily', 1, 86400)[0])
+        now[0] = 10
+        backend.hit('a', 5, 60)
+        now[0] = 20
+        backend.hit('b', 5, 60)
+        # Over capacity the short-window key goes, not the least recently used daily one
+        self.assertEqual(set(backend.counters), {'daily', 'b'})
+        now[0] = 200
+        backend.hit('c', 5, 60)
+        self.assertEqual(set(backend.counters), {'daily', 'c'})
+        self.assertFalse(backend.hit('daily', 1, 86400)[0])
+
+    def test_cache_backend_clear_keeps_other_cache_entries(self):
+        cache = caches['default']
+        cache.set('unrelated', 'kept')
+        backend = CacheRateLimitBackend('default', clock=lambda: 0.0)
+        backend.clear()
+        self.assertEqual(backend.hit('k', 1, 60), (True, 0))
+        self.assertFalse(backend.hit('k', 1, 60)[0])
+        backend.clear()
+        self.assertEqual(backend.hit('k', 1, 60), (True, 0))
+        self.assertEqual(cache.get('unrelated'), 'kept')
+
+    @override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {'login': '2/m', 'login_ip': '100/m'}})
+    def test_login_is_throttled_per_username(self):
+        for _ in range(2):
+            response = self.client.post('/api/auth/login/', {'username': 'alice', 'password': 'wrong'})
+            self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/auth/login/', {'username': 'Alice', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        response = self.client.post('/api/auth/login/', {'username': 'bob', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_repeat_requests_skip_the_user_query(self):
+        self.client.get('/api/auth/profile/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/auth/profile/')
+        self.assertEqual(response.data['username'], 'alice')
+
+    def test_saves_and_deletes_invalidate(self):
+        self.client.get('/api/auth/profile/')
+        self.user.username = 'alice2'
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/profile/').data['username'], 'alice2')
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.client.get('/api/auth/profile/')
+        self.user.delete()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+
+    @mock.patch.object(jwt_api_settings, 'AUTH_TOKEN_CLASSES', (SlidingToken,))
+    def test_blacklisted_token_is_rejected_for_a_cached_user(self):
+        token = SlidingToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 200)
+        token.blacklist()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
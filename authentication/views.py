@@ -12,7 +12,7 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
@@ -25,7 +25,15 @@ from webauthn.helpers.structs import (
     AuthenticationCredential,
     AuthenticatorAssertionResponse,
 )
+from .challenges import get_challenge_store
 from .models import WebAuthnCredential
+from .ratelimit import (
+    LoginIPRateThrottle,
+    LoginRateThrottle,
+    RegisterRateThrottle,
+    WebAuthnBeginRateThrottle,
+    WebAuthnCompleteRateThrottle,
+)
 from .serializers import (
     UserRegistrationSerializer,
     UserSerializer,
@@ -35,38 +43,8 @@ from .serializers import (
     WebAuthnAuthenticationCompleteSerializer,
     WebAuthnCredentialSerializer,
 )
-from datetime import datetime, timedelta
-
 
 
-# In-memory storage for WebAuthn challenges (in production, use Redis)
-webauthn_challenges = {}
-
-# Rate limiting for WebAuthn operations
-webauthn_rate_limits = {}
-
-def check_rate_limit(operation, identifier, max_attempts=5, window_minutes=5):
-    """Check rate limiting for WebAuthn operations"""
-    now = datetime.now()
-    key = f"{operation}:{identifier}"
-    
-    if key not in webauthn_rate_limits:
-        webauthn_rate_limits[key] = []
-    
-    # Remove old attempts outside the window
-    window_start = now - timedelta(minutes=window_minutes)
-    webauthn_rate_limits[key] = [
-        attempt for attempt in webauthn_rate_limits[key] 
-        if attempt > window_start
-    ]
-    
-    # Check if limit exceeded
-    if len(webauthn_rate_limits[key]) >= max_attempts:
-        return False
-    
-    # Add current attempt
-    webauthn_rate_limits[key].append(now)
-    return True
 
 def validate_base64_data(data, field_name):
     """Validate base64 encoded data"""
@@ -83,24 +61,6 @@ def validate_base64_data(data, field_name):
     except Exception as e:
         return False, f"Invalid {field_name}: {str(e)}"
 
-def cleanup_expired_challenges():
-    """Clean up expired challenges (older than 10 minutes)"""
-    now = datetime.now()
-    expired_keys = []
-    
-    for challenge_id, challenge_data in webauthn_challenges.items():
-        # Challenges should be cleaned up after use, but this is a safety net
-        if 'created_at' not in challenge_data:
-            # Add creation time if missing
-            challenge_data['created_at'] = now
-        elif now - challenge_data['created_at'] > timedelta(minutes=10):
-            expired_keys.append(challenge_id)
-    
-    for key in expired_keys:
-        del webauthn_challenges[key]
-    
-    return len(expired_keys)
-
 # Create your views here.
 
 # Placeholder views for authentication endpoints
@@ -108,6 +68,7 @@ def cleanup_expired_challenges():
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([RegisterRateThrottle])
 def register_user(request):
     """Register a new user with password"""
 
@@ -127,6 +88,7 @@ def register_user(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([LoginIPRateThrottle, LoginRateThrottle])
 def login_user(request):
     """Login with username and password (fallback)"""
 
@@ -171,6 +133,7 @@ def logout_user(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([WebAuthnBeginRateThrottle])
 def webauthn_register_begin(request):
     """Begin WebAuthn registration process"""
 
@@ -214,11 +177,11 @@ def webauthn_register_begin(request):
 
     # Generate a unique challenge ID and store the challenge
     challenge_id = str(uuid.uuid4())
-    webauthn_challenges[challenge_id] = {
+    get_challenge_store().put(challenge_id, {
         'challenge': base64.b64encode(registration_options.challenge).decode(),
         'username': username,
         'type': 'registration'
-    }
+    }, settings.WEBAUTHN_CHALLENGE_TTL)
 
 
 
@@ -271,6 +234,7 @@ def webauthn_register_begin(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([WebAuthnCompleteRateThrottle])
 def webauthn_register_complete(request):
 
 
@@ -280,13 +244,14 @@ def webauthn_register_complete(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+    # Challenges are single use: consuming removes it whatever the outcome
     challenge_id = request.data.get('challenge_id')
+    stored_data = get_challenge_store().consume(str(challenge_id)) if challenge_id else None
 
-    if not challenge_id or challenge_id not in webauthn_challenges:
+    if not stored_data or stored_data.get('type') != 'registration':
 
         return Response({'error': 'Invalid or expired challenge'}, status=status.HTTP_400_BAD_REQUEST)
 
-    stored_data = webauthn_challenges[challenge_id]
     challenge = stored_data['challenge']
     username = stored_data['username']
 
@@ -363,9 +328,6 @@ def webauthn_register_complete(request):
             backup_state=serializer.validated_data.get('backup_state', False),
         )
 
-
-        del webauthn_challenges[challenge_id]
-
         response_data = {
             'message': 'WebAuthn credential registered successfully',
             'credential': WebAuthnCredentialSerializer(credential_obj).data
@@ -383,24 +345,16 @@ def webauthn_register_complete(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([WebAuthnBeginRateThrottle])
 def webauthn_authenticate_begin(request):
     """Begin WebAuthn authentication process"""
     
-    # Clean up expired challenges
-    cleanup_expired_challenges()
-    
     serializer = WebAuthnAuthenticationBeginSerializer(data=request.data)
     if not serializer.is_valid():   
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     username = serializer.validated_data['username']
-    
-    # Check rate limiting
-    if not check_rate_limit('authenticate_begin', username):
-        return Response({
-            'error': 'Too many authentication attempts. Please try again later.'
-        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
-    
+
 
     try:
         from django.contrib.auth.models import User
@@ -435,11 +389,11 @@ def webauthn_authenticate_begin(request):
 
     # Generate a unique challenge ID and store the challenge
     challenge_id = str(uuid.uuid4())
-    webauthn_challenges[challenge_id] = {
+    get_challenge_store().put(challenge_id, {
         'challenge': base64.b64encode(authentication_options.challenge).decode(),
         'username': username,
         'type': 'authentication'
-    }
+    }, settings.WEBAUTHN_CHALLENGE_TTL)
 
 
     # Convert options to dictionary for JSON serialization
@@ -472,12 +426,10 @@ def webauthn_authenticate_begin(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([WebAuthnCompleteRateThrottle])
 def webauthn_authenticate_complete(request):
     """Complete WebAuthn authentication process"""
     
-    # Clean up expired challenges
-    cleanup_expired_challenges()
-    
     serializer = WebAuthnAuthenticationCompleteSerializer(data=request.data)
     if not serializer.is_valid():
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -505,23 +457,17 @@ def webauthn_authenticate_complete(request):
     if not is_valid:
         return Response({'error': error_msg}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Check rate limiting
-    username = serializer.validated_data['username']
-    if not check_rate_limit('authenticate_complete', username):
-        return Response({
-            'error': 'Too many authentication attempts. Please try again later.'
-        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
-
     # Get challenge ID and retrieve stored challenge
+    # (single use: consuming removes it whatever the outcome)
     challenge_id = request.data.get('challenge_id')
+    stored_data = get_challenge_store().consume(str(challenge_id)) if challenge_id else None
 
-    if not challenge_id or challenge_id not in webauthn_challenges:
+    if not stored_data or stored_data.get('type') != 'authentication':
 
         return Response({
             'error': 'Invalid or expired challenge'
         }, status=status.HTTP_400_BAD_REQUEST)
 
-    stored_data = webauthn_challenges[challenge_id]
     challenge = stored_data['challenge']
     username = stored_data['username']
 
@@ -620,9 +566,6 @@ def webauthn_authenticate_complete(request):
         refresh = RefreshToken.for_user(user)
 
 
-        # Clear the challenge
-        del webauthn_challenges[challenge_id]
-
 
         response_data = {
             'message': 'Authentication successful',
@@ -6,6 +6,7 @@ class CallAdmin(admin.ModelAdmin):
     list_display = ['id', 'get_display_name', 'get_display_number', 'user', 'call_status', 'call_duration', 'created_at']
     list_filter = ['call_status', 'created_at', 'user']
     search_fields = ['contact__name', 'contact_number', 'user__username']
+    list_select_related = ['contact', 'user']
     readonly_fields = ['created_at', 'updated_at']
     date_hierarchy = 'created_at'
     
@@ -26,6 +27,7 @@ class NoteAdmin(admin.ModelAdmin):
     list_display = ['id', 'get_call_info', 'note', 'created_at']
     list_filter = ['created_at']
     search_fields = ['note', 'call__contact__name', 'call__contact_number']
+    list_select_related = ['call__contact', 'call__user']
     readonly_fields = ['created_at', 'updated_at']
     
     def get_call_info(self, obj):
@@ -1,6 +1,42 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate, pre_migrate
+
+
+def ensure_call_search_index(sender, using, **kwargs):
+    from django.db import connections
+    from contact.search import ensure_sqlite_search_index
+    from .search import CALL_SEARCH_FIELDS, CALL_TABLE
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        ensure_sqlite_search_index(connection, CALL_TABLE, CALL_SEARCH_FIELDS)
+
+
+def drop_call_rollup_triggers(sender, using, plan=None, **kwargs):
+    from django.db import connections
+    from .rollups import TRIGGER_TABLE_APPS, drop_sqlite_rollup_triggers
+
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    if plan is None or any(migration.app_label in TRIGGER_TABLE_APPS for migration, _ in plan):
+        drop_sqlite_rollup_triggers(connection)
+
+
+def ensure_call_rollup_triggers(sender, using, **kwargs):
+    from django.db import connections
+    from .rollups import ensure_sqlite_rollup_triggers
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        ensure_sqlite_rollup_triggers(connection)
 
 
 class CallConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "call"
+
+    def ready(self):
+        post_migrate.connect(ensure_call_search_index, sender=self)
+        pre_migrate.connect(drop_call_rollup_triggers, sender=self)
+        post_migrate.connect(ensure_call_rollup_triggers, sender=self)
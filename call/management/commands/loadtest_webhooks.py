@@ -0,0 +1,77 @@
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+
+from call.models import Call
+from call.write_queue import get_call_write_queue
+
+LOADTEST_SID_PREFIX = 'CALOADTEST'
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the WSGI handler (thread pool) and the ASGI handler (event loop) on the "
+        "Twilio webhooks, in-process through the test clients and one write-behind queue; "
+        "not a measure of deployed, multi-worker throughput. Writes and then deletes Call "
+        "rows in the configured database, so point it at a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Webhook calls per mode')
+        parser.add_argument('--concurrency', type=int, default=50, help='Requests in flight at once')
+        parser.add_argument('--user-id', help='UserId to send with each webhook')
+
+    def handle(self, *args, **options):
+        total = options['requests']
+        concurrency = options['concurrency']
+        payloads = [self.payload(options['user_id']) for _ in range(total * 2)]
+
+        try:
+            elapsed = self.run_wsgi(payloads[:total], concurrency)
+            self.report('WSGI (sync, thread pool)', total, elapsed)
+            elapsed = asyncio.run(self.run_asgi(payloads[total:], concurrency))
+            self.report('ASGI (async, event loop)', total, elapsed)
+        finally:
+            get_call_write_queue().flush()
+            Call.objects.filter(call_sid__startswith=LOADTEST_SID_PREFIX).delete()
+
+    def payload(self, user_id):
+        data = {
+            'Direction': 'inbound',
+            'From': '+15551234567',
+            'To': '+15557654321',
+            'CallSid': f'{LOADTEST_SID_PREFIX}{uuid.uuid4().hex}',
+        }
+        if user_id:
+            data['UserId'] = user_id
+        return data
+
+    def run_wsgi(self, payloads, concurrency):
+        def post(data):
+            Client(SERVER_NAME='localhost').post('/api/call/voice/handler/', data)
+            Client(SERVER_NAME='localhost').post('/api/call/voice/status/', {**data, 'CallStatus': 'completed', 'CallDuration': '10'})
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(post, payloads))
+        return time.perf_counter() - start
+
+    async def run_asgi(self, payloads, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def post(data):
+            async with semaphore:
+                client = AsyncClient(SERVER_NAME='localhost')
+                await client.post('/api/call/voice/handler/', data)
+                await client.post('/api/call/voice/status/', {**data, 'CallStatus': 'completed', 'CallDuration': '10'})
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(data) for data in payloads))
+        return time.perf_counter() - start
+
+    def report(self, label, total, elapsed):
+        self.stdout.write(f"{label}: {total} calls in {elapsed:.2f}s ({total / elapsed:.1f} calls/s)")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from call.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete deletion-log tombstones older than SYNC_TOMBSTONE_RETENTION_DAYS. "
+        "Changes cursors older than that are refused, so clients holding one "
+        "sync again from scratch. Run this daily, e.g. from cron."
+    )
+
+    def handle(self, *args, **options):
+        deleted = prune_tombstones()
+        self.stdout.write(f"Deleted {deleted} tombstones")
@@ -0,0 +1,27 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from call.rollups import rebuild_contact_summaries, rebuild_daily_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily call rollups and contact call summaries from the "
+        "call table. The database triggers keep them current; run this after "
+        "bulk fixes made with the triggers disabled, or to verify them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild this username')
+        parser.add_argument('--database', default='default', help='Database alias')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.using(options['database']).get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['user']!r} not found")
+        rows = rebuild_daily_rollups(user=user, using=options['database'])
+        contacts = rebuild_contact_summaries(user=user, using=options['database'])
+        self.stdout.write(f"Rebuilt {rows} daily rollup rows and {contacts} contact summaries")
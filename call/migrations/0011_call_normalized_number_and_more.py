@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0010_alter_call_options'),
+        ('contact', '0003_contact_normalized_phone_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='call',
+            name='normalized_number',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['user', 'normalized_number'], name='call_user_norm_number_idx'),
+        ),
+    ]
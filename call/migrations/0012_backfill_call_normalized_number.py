@@ -0,0 +1,36 @@
+# Generated manually to backfill the canonical phone number in batches
+
+import re
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_normalized_number(apps, schema_editor):
+    Call = apps.get_model('call', 'Call')
+    last_id = 0
+    while True:
+        batch = list(
+            Call.objects.filter(id__gt=last_id)
+            .order_by('id')
+            .only('id', 'contact_number', 'normalized_number')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for call in batch:
+            call.normalized_number = re.sub(r'\D', '', call.contact_number or '')
+        Call.objects.bulk_update(batch, ['normalized_number'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('call', '0011_call_normalized_number_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_normalized_number, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0012_backfill_call_normalized_number'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='note',
+            name='call',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notes', to='call.call'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated manually to remove duplicate call_sid rows before making it unique
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def dedupe_call_sid(apps, schema_editor):
+    Call = apps.get_model('call', 'Call')
+    Note = apps.get_model('call', 'Note')
+
+    # Empty strings would collide once call_sid is unique
+    Call.objects.filter(call_sid='').update(call_sid=None)
+
+    duplicates = (
+        Call.objects.exclude(call_sid__isnull=True)
+        .values('call_sid')
+        .annotate(rows=Count('id'), survivor_id=Min('id'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for duplicate in list(duplicates):
+        extra_calls = Call.objects.filter(call_sid=duplicate['call_sid']).exclude(id=duplicate['survivor_id'])
+        # Keep notes from the duplicate rows on the surviving (earliest) call
+        Note.objects.filter(call__in=extra_calls).update(call_id=duplicate['survivor_id'])
+        extra_calls.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0013_alter_note_call'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_call_sid, migrations.RunPython.noop),
+    ]
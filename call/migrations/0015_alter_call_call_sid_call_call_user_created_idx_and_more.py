@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0014_dedupe_call_sid'),
+        ('contact', '0004_backfill_contact_normalized_phone'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='call',
+            name='call_sid',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['user', 'created_at'], name='call_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['user', 'call_status', 'created_at'], name='call_user_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='call',
+            index=models.Index(fields=['contact', 'created_at'], name='call_contact_created_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated manually to add pg_trgm indexes for call history search
+
+from django.db import migrations
+
+TRIGRAM_INDEXES = {
+    'call_number_trgm_idx': 'contact_number',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # SQLite uses an FTS5 table instead; see call.search
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for index_name, column in TRIGRAM_INDEXES.items():
+        # Matches the UPPER(column::text) LIKE UPPER(...) that icontains compiles to
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} '
+            f'ON call_call USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}')
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('call', '0015_alter_call_call_sid_call_call_user_created_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0016_call_trigram_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCallStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('call_direction', models.CharField(blank=True, default='', max_length=255)),
+                ('call_status', models.CharField(max_length=255)),
+                ('call_count', models.IntegerField(default=0)),
+                ('total_duration', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_call_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day', 'call_direction', 'call_status'), name='call_dailystat_bucket_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated manually to install the daily call rollup triggers on PostgreSQL
+
+from django.db import migrations
+
+
+def create_rollup_triggers(apps, schema_editor):
+    # SQLite gets its triggers after every migrate; see CallConfig.ready
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from call.rollups import ROLLUP_TABLE, postgresql_rollup_statements
+
+    for statement in postgresql_rollup_statements():
+        schema_editor.execute(statement)
+    # Backfill; from here on the triggers keep the rollup current
+    schema_editor.execute(
+        f"INSERT INTO {ROLLUP_TABLE} (user_id, day, call_direction, call_status, call_count, total_duration) "
+        "SELECT user_id, (created_at AT TIME ZONE 'UTC')::date, COALESCE(call_direction, ''), call_status, "
+        "COUNT(*), COALESCE(SUM(call_duration), 0) FROM call_call WHERE user_id IS NOT NULL GROUP BY 1, 2, 3, 4"
+    )
+
+
+def drop_rollup_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for trigger in ('call_rollup_ai', 'call_rollup_ad', 'call_rollup_au'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {trigger} ON call_call')
+    schema_editor.execute('DROP FUNCTION IF EXISTS call_rollup_apply()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0017_dailycallstat'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_rollup_triggers, drop_rollup_triggers),
+    ]
@@ -0,0 +1,41 @@
+# Generated manually to install the contact call summary triggers on PostgreSQL
+
+from django.db import migrations
+
+
+def create_summary_triggers(apps, schema_editor):
+    # SQLite gets its triggers after every migrate; see CallConfig.ready
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from call.rollups import postgresql_summary_statements
+
+    for statement in postgresql_summary_statements():
+        schema_editor.execute(statement)
+    # Backfill; from here on the triggers keep the summaries current
+    schema_editor.execute(
+        "UPDATE contact_contact SET call_count = summary.calls, total_talk_seconds = summary.duration, "
+        "last_call_at = summary.last_call FROM ("
+        "SELECT contact_id, COUNT(*) AS calls, COALESCE(SUM(call_duration), 0) AS duration, "
+        "MAX(created_at) AS last_call FROM call_call WHERE contact_id IS NOT NULL GROUP BY contact_id"
+        ") AS summary WHERE contact_contact.id = summary.contact_id"
+    )
+
+
+def drop_summary_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for trigger in ('call_contact_summary_ai', 'call_contact_summary_ad', 'call_contact_summary_au'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {trigger} ON call_call')
+    schema_editor.execute('DROP FUNCTION IF EXISTS call_contact_summary_apply()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0018_call_rollup_triggers'),
+        ('contact', '0008_contact_call_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_summary_triggers, drop_summary_triggers),
+    ]
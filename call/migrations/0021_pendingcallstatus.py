@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0020_tombstone_and_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCallStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_sid', models.CharField(db_index=True, max_length=255)),
+                ('call_status', models.CharField(max_length=255)),
+                ('call_duration', models.IntegerField(default=0)),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
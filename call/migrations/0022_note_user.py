@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_call_users(apps, schema_editor):
+    Call = apps.get_model('call', 'Call')
+    Note = apps.get_model('call', 'Note')
+    # One UPDATE; updated_at stays, as the synced note fields don't change
+    Note.objects.update(user_id=Subquery(Call.objects.filter(id=OuterRef('call_id')).values('user_id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('call', '0021_pendingcallstatus'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='note',
+            name='note_updated_idx',
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='user',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(copy_call_users, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='note_user_updated_idx'),
+        ),
+    ]
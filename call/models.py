@@ -1,12 +1,129 @@
-from django.db import models
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from contact.models import Contact
+from django.utils import timezone
+from contact.caller_cache import caller_cache
+from contact.models import Contact, normalize_phone_number
 
 # Create your models here.
 
+# Twilio call progress; a status callback may only move a call forward.
+# Terminal statuses share a rank, so the first one delivered wins.
+CALL_STATUS_RANK = {
+    'queued': 0,
+    'initiated': 0,
+    'ringing': 1,
+    'in-progress': 2,
+    'completed': 3,
+    'busy': 3,
+    'no-answer': 3,
+    'failed': 3,
+    'canceled': 3,
+}
+TERMINAL_CALL_STATUS_RANK = 3
+
+
+def call_status_advances(current, new):
+    """Whether a call in status current may move to status new"""
+    if new not in CALL_STATUS_RANK:
+        return False
+    return current not in CALL_STATUS_RANK or CALL_STATUS_RANK[current] < CALL_STATUS_RANK[new]
+
+
+class CallQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the calls, logging them and their notes for the changes endpoints (see call.sync)"""
+        from .sync import record_call_deletions
+
+        with transaction.atomic(using=self.db):
+            record_call_deletions(self)
+            return super().delete()
+
+    def link_to_contact(self, contact):
+        """Link the owner's unlinked calls for the contact's number in a single UPDATE"""
+        if not contact.normalized_phone:
+            return 0
+        return self.filter(
+            user_id=contact.user_id,
+            contact__isnull=True,
+            normalized_number=contact.normalized_phone,
+        ).update(contact=contact, updated_at=timezone.now())
+
+    def link_to_user_contacts(self, user):
+        """Link all of the user's unlinked calls to their contacts by number in a single UPDATE
+
+        Each call gets the oldest of the user's contacts with its canonical
+        number; calls without a matching contact are left alone.
+        """
+        matching = Contact.objects.filter(
+            user=user, normalized_phone=models.OuterRef('normalized_number')
+        ).order_by('id')
+        return self.filter(user=user, contact__isnull=True).exclude(normalized_number='').filter(
+            models.Exists(matching)
+        ).update(contact=models.Subquery(matching.values('id')[:1]), updated_at=timezone.now())
+
+    def advance_status(self, call_sid, status, duration=None, received_at=None):
+        """Apply a status callback as one conditional UPDATE.
+
+        The row only changes when status ranks above the stored one, so late
+        or duplicate callbacks are no-ops. received_at, when the callback
+        arrived, becomes the end time of a terminal status. Returns the
+        number of rows updated.
+        """
+        if status not in CALL_STATUS_RANK:
+            return 0
+        rank = CALL_STATUS_RANK[status]
+        lower = [name for name, name_rank in CALL_STATUS_RANK.items() if name_rank < rank]
+        fields = {'call_status': status, 'updated_at': timezone.now()}
+        if duration:
+            fields['call_duration'] = duration
+        if rank == TERMINAL_CALL_STATUS_RANK:
+            fields['call_end_time'] = received_at or timezone.now()
+        return self.filter(call_sid=call_sid).filter(
+            models.Q(call_status__in=lower) | ~models.Q(call_status__in=list(CALL_STATUS_RANK))
+        ).update(**fields)
+
+    def record_status(self, call_sid, status, duration=None):
+        """advance_status, or keep the callback until its call is written.
+
+        With write-behind the insert may still be queued, in this worker or
+        another, or waiting for the database. The callback is then stored as
+        a PendingCallStatus, which apply_pending_statuses applies once the
+        row exists, so a status is never dropped.
+        """
+        if self.advance_status(call_sid, status, duration) or status not in CALL_STATUS_RANK:
+            return
+        if self.filter(call_sid=call_sid).exists():
+            return  # late or duplicate callback
+        now = timezone.now()
+        PendingCallStatus.objects.filter(
+            received_at__lt=now - timedelta(seconds=settings.CALL_PENDING_STATUS_TTL)
+        ).delete()
+        PendingCallStatus.objects.create(
+            call_sid=call_sid, call_status=status, call_duration=duration or 0, received_at=now
+        )
+        # The insert may have committed in between, without seeing this row
+        self.apply_pending_statuses([call_sid])
+
+    def apply_pending_statuses(self, call_sids):
+        """Apply and clear the stored callbacks of calls that now exist"""
+        pending = list(PendingCallStatus.objects.filter(call_sid__in=call_sids))
+        if not pending:
+            return
+        existing = set(self.filter(call_sid__in={p.call_sid for p in pending}).values_list('call_sid', flat=True))
+        applied = sorted((p for p in pending if p.call_sid in existing),
+                         key=lambda p: (CALL_STATUS_RANK[p.call_status], p.id))
+        for status in applied:
+            self.advance_status(status.call_sid, status.call_status, status.call_duration, status.received_at)
+        PendingCallStatus.objects.filter(id__in=[status.id for status in applied]).delete()
+
+
 class Call(models.Model):
     contact = models.ForeignKey(Contact, on_delete=models.SET_NULL, null=True, blank=True)
     contact_number = models.CharField(max_length=255, null=True, blank=True)
+    normalized_number = models.CharField(max_length=255, blank=True, default='', editable=False)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -14,45 +131,136 @@ class Call(models.Model):
     call_duration = models.IntegerField(default=0)
     call_start_time = models.DateTimeField(null=True, blank=True)
     call_end_time = models.DateTimeField(null=True, blank=True)
-    call_sid = models.CharField(max_length=255, null=True, blank=True)
+    call_sid = models.CharField(max_length=255, null=True, blank=True, unique=True)
     call_direction = models.CharField(max_length=255, choices=[('incoming', 'Incoming'), ('outgoing', 'Outgoing')], null=True, blank=True)
 
+    objects = CallQuerySet.as_manager()
+
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', 'normalized_number'], name='call_user_norm_number_idx'),
+            # Call history: per-user listing, status filter and per-contact timeline
+            models.Index(fields=['user', 'created_at'], name='call_user_created_idx'),
+            models.Index(fields=['user', 'call_status', 'created_at'], name='call_user_status_created_idx'),
+            models.Index(fields=['contact', 'created_at'], name='call_contact_created_idx'),
+            # Delta sync: keyset scan on (updated_at, id)
+            models.Index(fields=['user', 'updated_at', 'id'], name='call_user_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.contact.name if self.contact else self.contact_number} ({self.contact_number})"
     
     def save(self, *args, **kwargs):
-        if self.contact_number and not self.contact:
-            # Normalize phone numbers by removing '+' prefix for comparison
-            normalized_contact_number = self.contact_number.lstrip('+')
-            
-            # Check for contacts with matching phone number (with or without '+')
-            matching_contacts = Contact.objects.filter(
-                phone_number__in=[
-                    self.contact_number,  # Original format
-                    normalized_contact_number,  # Without '+'
-                    f"+{normalized_contact_number}"  # With '+'
-                ]
-            )
-            
-            if matching_contacts.exists():
-                self.contact = matching_contacts.first()
+        self.normalized_number = normalize_phone_number(self.contact_number)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'contact_number' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'normalized_number'}
+
+        if self.normalized_number and self.contact_id is None:
+            # Indexed equality lookup on the canonical number, cached per process
+            match = caller_cache.resolve_number(self.normalized_number, user=self.user_id)
+            if match is not None:
+                self.contact_id = match.id
         super().save(*args, **kwargs)
-            
-    
 
-    
+    def delete(self, *args, **kwargs):
+        from .sync import record_call_deletions
+
+        with transaction.atomic(using=self._state.db):
+            record_call_deletions(Call.objects.using(self._state.db).filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
+
+
+class NoteQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the notes, logging them for the changes endpoints (see call.sync)"""
+        from .sync import record_note_deletions
+
+        with transaction.atomic(using=self.db):
+            record_note_deletions(self)
+            return super().delete()
+
 
 class Note(models.Model):
-    call = models.ForeignKey(Call, on_delete=models.CASCADE)
+    call = models.ForeignKey(Call, on_delete=models.CASCADE, related_name='notes')
+    # The call's user, copied on save so the changes endpoint can scan one user's notes by index
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')
     note = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = NoteQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Delta sync: keyset scan on (updated_at, id)
+            models.Index(fields=['user', 'updated_at', 'id'], name='note_user_updated_idx'),
+        ]
+
     def __str__(self):
         if self.call.contact:
             return f"{self.call.contact.name} - {self.call.user.username if self.call.user else 'Unknown User'}"
         return f"{self.call.contact_number} - {self.call.user.username if self.call.user else 'Unknown User'}"
 
+    def save(self, *args, **kwargs):
+        if self.user_id is None and self.call_id is not None:
+            self.user_id = self.call.user_id
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from .sync import record_note_deletions
+
+        with transaction.atomic(using=self._state.db):
+            record_note_deletions(Note.objects.using(self._state.db).filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
+
+
+class PendingCallStatus(models.Model):
+    """A status callback that arrived before its call was written (see CallQuerySet.record_status)"""
+    call_sid = models.CharField(max_length=255, db_index=True)
+    call_status = models.CharField(max_length=255)
+    call_duration = models.IntegerField(default=0)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.call_sid} {self.call_status} at {self.received_at}"
+
+
+class DailyCallStat(models.Model):
+    """Per-user daily call counts and talk time, maintained by triggers on Call (see call.rollups)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_call_stats')
+    day = models.DateField()
+    call_direction = models.CharField(max_length=255, blank=True, default='')
+    call_status = models.CharField(max_length=255)
+    call_count = models.IntegerField(default=0)
+    total_duration = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index for per-user date range reads
+            models.UniqueConstraint(
+                fields=['user', 'day', 'call_direction', 'call_status'], name='call_dailystat_bucket_uniq'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.day} {self.call_direction}/{self.call_status}: {self.call_count}"
+
+
+class Tombstone(models.Model):
+    """A deleted call, note or contact, reported by the changes endpoints (see call.sync)"""
+    model = models.CharField(max_length=32, choices=[('call', 'Call'), ('note', 'Note'), ('contact', 'Contact')])
+    object_id = models.BigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'model', 'deleted_at', 'id'], name='call_tombstone_sync_idx'),
+            # Pruning by age
+            models.Index(fields=['deleted_at'], name='call_tombstone_deleted_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model} {self.object_id} deleted {self.deleted_at}"
@@ -0,0 +1,276 @@
+"""
+Per-user daily call rollups (DailyCallStat), maintained incrementally.
+
+Database triggers on call_call apply each change to the rollup as a delta.
+An insert adds the call to its (user, day, direction, status) bucket. An
+update that changes the status, duration, user, direction or created_at
+moves it from the old bucket to the new one. A delete removes it. The
+webhook paths stay a single statement each, and the rollup stays exact
+even when an insert is ignored as a duplicate or a late status callback
+matches no row. Days are UTC calendar days of created_at.
+
+A second set of triggers keeps each contact's call summary
+(Contact.last_call_at, call_count, total_talk_seconds) current the same way,
+so the contact list can sort by recency or frequency from an index. Calls
+moving between contacts (link_to_contact) are moved between summaries; a
+contact that loses its latest call gets last_call_at recomputed from the
+(contact, created_at) index.
+
+On SQLite the triggers are checked after every migrate, like the FTS
+search tables, because SQLite drops triggers when a migration remakes the
+table. They are also dropped before a migrate that runs call or contact
+migrations, since SQLite refuses to remake contact_contact or
+call_dailycallstat while a trigger names them. Only triggers that are
+missing or differ from the definitions here are created, and only what
+they maintain is then rebuilt, in the same transaction. So a migrate with
+nothing to do for those apps costs no rebuild. On PostgreSQL they are
+installed by migrations.
+rebuild_daily_rollups() and rebuild_contact_summaries() recompute both from
+call_call; the rebuild_call_rollups command calls them.
+"""
+from datetime import timezone as dt_timezone
+from itertools import islice
+
+from django.db import connections, transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+
+CALL_TABLE = 'call_call'
+ROLLUP_TABLE = 'call_dailycallstat'
+ROLLUP_TRIGGERS = ('call_rollup_ai', 'call_rollup_ad', 'call_rollup_au')
+ROLLUP_COLUMNS = 'call_status, call_duration, user_id, call_direction, created_at'
+CONTACT_TABLE = 'contact_contact'
+SUMMARY_TRIGGERS = ('call_contact_summary_ai', 'call_contact_summary_ad', 'call_contact_summary_au')
+SUMMARY_COLUMNS = 'contact_id, call_duration, created_at'
+# Apps whose migrations may remake a table the triggers name
+TRIGGER_TABLE_APPS = ('call', 'contact')
+REBUILD_BATCH_SIZE = 1000
+
+
+def sqlite_rollup_statements():
+    def add(row):
+        return (
+            f"INSERT INTO {ROLLUP_TABLE} (user_id, day, call_direction, call_status, call_count, total_duration) "
+            f"SELECT {row}.user_id, date({row}.created_at), COALESCE({row}.call_direction, ''), "
+            f"{row}.call_status, 1, {row}.call_duration WHERE {row}.user_id IS NOT NULL "
+            f"ON CONFLICT (user_id, day, call_direction, call_status) DO UPDATE SET "
+            f"call_count = call_count + 1, total_duration = total_duration + excluded.total_duration;"
+        )
+
+    def remove(row):
+        return (
+            f"UPDATE {ROLLUP_TABLE} SET call_count = call_count - 1, "
+            f"total_duration = total_duration - {row}.call_duration "
+            f"WHERE user_id = {row}.user_id AND day = date({row}.created_at) "
+            f"AND call_direction = COALESCE({row}.call_direction, '') AND call_status = {row}.call_status;"
+        )
+
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS call_rollup_ai AFTER INSERT ON {CALL_TABLE} BEGIN {add('new')} END",
+        f"CREATE TRIGGER IF NOT EXISTS call_rollup_ad AFTER DELETE ON {CALL_TABLE} BEGIN {remove('old')} END",
+        f"CREATE TRIGGER IF NOT EXISTS call_rollup_au AFTER UPDATE OF {ROLLUP_COLUMNS} ON {CALL_TABLE} "
+        f"BEGIN {remove('old')} {add('new')} END",
+    ]
+
+
+def sqlite_summary_statements():
+    def add(row):
+        return (
+            f"UPDATE {CONTACT_TABLE} SET call_count = call_count + 1, "
+            f"total_talk_seconds = total_talk_seconds + {row}.call_duration, "
+            f"last_call_at = CASE WHEN last_call_at IS NULL OR last_call_at < {row}.created_at "
+            f"THEN {row}.created_at ELSE last_call_at END "
+            f"WHERE id = {row}.contact_id;"
+        )
+
+    def remove(row):
+        return (
+            f"UPDATE {CONTACT_TABLE} SET call_count = call_count - 1, "
+            f"total_talk_seconds = total_talk_seconds - {row}.call_duration, "
+            f"last_call_at = (SELECT MAX(created_at) FROM {CALL_TABLE} WHERE contact_id = {row}.contact_id) "
+            f"WHERE id = {row}.contact_id;"
+        )
+
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS call_contact_summary_ai AFTER INSERT ON {CALL_TABLE} "
+        f"WHEN new.contact_id IS NOT NULL BEGIN {add('new')} END",
+        f"CREATE TRIGGER IF NOT EXISTS call_contact_summary_ad AFTER DELETE ON {CALL_TABLE} "
+        f"WHEN old.contact_id IS NOT NULL BEGIN {remove('old')} END",
+        f"CREATE TRIGGER IF NOT EXISTS call_contact_summary_au AFTER UPDATE OF {SUMMARY_COLUMNS} ON {CALL_TABLE} "
+        f"BEGIN {remove('old')} {add('new')} END",
+    ]
+
+
+POSTGRESQL_ROLLUP_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION call_rollup_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.user_id IS NOT NULL THEN
+        UPDATE {ROLLUP_TABLE}
+        SET call_count = call_count - 1, total_duration = total_duration - OLD.call_duration
+        WHERE user_id = OLD.user_id
+          AND day = (OLD.created_at AT TIME ZONE 'UTC')::date
+          AND call_direction = COALESCE(OLD.call_direction, '')
+          AND call_status = OLD.call_status;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.user_id IS NOT NULL THEN
+        INSERT INTO {ROLLUP_TABLE} (user_id, day, call_direction, call_status, call_count, total_duration)
+        VALUES (NEW.user_id, (NEW.created_at AT TIME ZONE 'UTC')::date,
+                COALESCE(NEW.call_direction, ''), NEW.call_status, 1, NEW.call_duration)
+        ON CONFLICT (user_id, day, call_direction, call_status) DO UPDATE
+        SET call_count = {ROLLUP_TABLE}.call_count + 1,
+            total_duration = {ROLLUP_TABLE}.total_duration + EXCLUDED.total_duration;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def postgresql_rollup_statements():
+    return [
+        POSTGRESQL_ROLLUP_FUNCTION,
+        f"DROP TRIGGER IF EXISTS call_rollup_ai ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_rollup_ai AFTER INSERT ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_rollup_apply()",
+        f"DROP TRIGGER IF EXISTS call_rollup_ad ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_rollup_ad AFTER DELETE ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_rollup_apply()",
+        f"DROP TRIGGER IF EXISTS call_rollup_au ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_rollup_au AFTER UPDATE OF {ROLLUP_COLUMNS} ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_rollup_apply()",
+    ]
+
+
+POSTGRESQL_SUMMARY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION call_contact_summary_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.contact_id IS NOT NULL THEN
+        UPDATE {CONTACT_TABLE}
+        SET call_count = call_count - 1,
+            total_talk_seconds = total_talk_seconds - OLD.call_duration,
+            last_call_at = (SELECT MAX(created_at) FROM {CALL_TABLE} WHERE contact_id = OLD.contact_id)
+        WHERE id = OLD.contact_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.contact_id IS NOT NULL THEN
+        UPDATE {CONTACT_TABLE}
+        SET call_count = call_count + 1,
+            total_talk_seconds = total_talk_seconds + NEW.call_duration,
+            last_call_at = GREATEST(last_call_at, NEW.created_at)
+        WHERE id = NEW.contact_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def postgresql_summary_statements():
+    return [
+        POSTGRESQL_SUMMARY_FUNCTION,
+        f"DROP TRIGGER IF EXISTS call_contact_summary_ai ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_contact_summary_ai AFTER INSERT ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_contact_summary_apply()",
+        f"DROP TRIGGER IF EXISTS call_contact_summary_ad ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_contact_summary_ad AFTER DELETE ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_contact_summary_apply()",
+        f"DROP TRIGGER IF EXISTS call_contact_summary_au ON {CALL_TABLE}",
+        f"CREATE TRIGGER call_contact_summary_au AFTER UPDATE OF {SUMMARY_COLUMNS} ON {CALL_TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION call_contact_summary_apply()",
+    ]
+
+
+def drop_sqlite_rollup_triggers(connection):
+    with connection.cursor() as cursor:
+        for trigger in ROLLUP_TRIGGERS + SUMMARY_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+
+
+def ensure_sqlite_rollup_triggers(connection):
+    """Create the triggers that are missing or outdated, then rebuild what they maintain.
+
+    Returns whether any trigger was created.
+    """
+    # SQLite stores the statement without IF NOT EXISTS
+    expected = {
+        name: statement.replace(' IF NOT EXISTS', '', 1)
+        for name, statement in zip(
+            ROLLUP_TRIGGERS + SUMMARY_TRIGGERS, sqlite_rollup_statements() + sqlite_summary_statements()
+        )
+    }
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [CALL_TABLE])
+            installed = dict(cursor.fetchall())
+            stale = [name for name, statement in expected.items() if installed.get(name) != statement]
+            for name in stale:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                cursor.execute(expected[name])
+        # Calls written from here on wait for this transaction, then apply their deltas on top
+        if set(stale) & set(ROLLUP_TRIGGERS):
+            rebuild_daily_rollups(using=connection.alias)
+        if set(stale) & set(SUMMARY_TRIGGERS):
+            rebuild_contact_summaries(using=connection.alias)
+    return bool(stale)
+
+
+def rebuild_daily_rollups(user=None, using='default'):
+    """Recompute DailyCallStat from the calls (for one user, or everyone); returns rows written"""
+    from .models import Call, DailyCallStat
+
+    calls = Call.objects.using(using).filter(user__isnull=False)
+    stats = DailyCallStat.objects.using(using)
+    if user is not None:
+        calls = calls.filter(user=user)
+        stats = stats.filter(user=user)
+
+    with transaction.atomic(using=using):
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            # Concurrent call writes wait here, then apply their deltas on top
+            with connection.cursor() as cursor:
+                cursor.execute(f'LOCK TABLE {ROLLUP_TABLE} IN EXCLUSIVE MODE')
+        stats.delete()
+        groups = (
+            # UTC days, like the triggers, whatever time zone is active
+            calls.annotate(
+                day=TruncDate('created_at', tzinfo=dt_timezone.utc),
+                direction=Coalesce('call_direction', Value('')),
+            )
+            .values('user_id', 'day', 'direction', 'call_status')
+            .annotate(calls=Count('id'), duration=Sum('call_duration'))
+            .order_by()
+        )
+        rows = (
+            DailyCallStat(
+                user_id=group['user_id'],
+                day=group['day'],
+                call_direction=group['direction'],
+                call_status=group['call_status'],
+                call_count=group['calls'],
+                total_duration=group['duration'] or 0,
+            )
+            for group in groups.iterator(chunk_size=REBUILD_BATCH_SIZE)
+        )
+        written = 0
+        while True:
+            batch = list(islice(rows, REBUILD_BATCH_SIZE))
+            if not batch:
+                return written
+            DailyCallStat.objects.using(using).bulk_create(batch)
+            written += len(batch)
+
+
+def rebuild_contact_summaries(user=None, using='default'):
+    """Recompute the call summary of every contact (of one user, or everyone); returns contacts updated"""
+    from contact.models import Contact
+    from .models import Call
+
+    calls = Call.objects.using(using).filter(contact=OuterRef('pk')).order_by().values('contact')
+    contacts = Contact.objects.using(using)
+    if user is not None:
+        contacts = contacts.filter(user=user)
+    return contacts.update(
+        call_count=Coalesce(Subquery(calls.annotate(calls=Count('id')).values('calls')), 0),
+        total_talk_seconds=Coalesce(Subquery(calls.annotate(duration=Sum('call_duration')).values('duration')), 0),
+        last_call_at=Subquery(calls.annotate(last=Max('created_at')).values('last')),
+    )
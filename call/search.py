@@ -0,0 +1,26 @@
+"""
+Substring search for call history; see contact.search for the index layout.
+"""
+from django.db.models import Q
+
+from contact.models import Contact
+from contact.search import icontains_filter, ngram_match_ids, search_contacts, uses_ngram_index
+
+CALL_TABLE = 'call_call'
+CALL_SEARCH_FIELDS = ('contact_number',)
+
+
+def search_calls(queryset, query, user):
+    """Filter calls by a substring of the dialled number or the linked contact's name/number.
+
+    The contact side is resolved against user's contacts in the contact index
+    and joined by id, instead of OR-ing icontains filters across the join.
+    """
+    matching_contacts = search_contacts(
+        Contact.objects.filter(user=user), query, rank=False, fields=('name', 'phone_number')
+    )
+    if uses_ngram_index(queryset, query):
+        number_filter = Q(id__in=ngram_match_ids(CALL_TABLE, query))
+    else:
+        number_filter = icontains_filter(CALL_SEARCH_FIELDS, query)
+    return queryset.filter(number_filter | Q(contact__in=matching_contacts.values('id')))
@@ -1,7 +1,10 @@
 from rest_framework import serializers
 from .models import Call, Note
+from contact.fast_serializers import ValuesSerializer, column, datetime_column
 from contact.models import Contact
 from django.contrib.auth.models import User
+from django.db.models import Value
+from django.db.models.functions import Coalesce
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -90,8 +93,81 @@ class CallHistorySerializer(serializers.ModelSerializer):
     
     def get_duration_formatted(self, obj):
         """Format call duration in minutes:seconds format"""
-        if obj.call_duration:
-            minutes = obj.call_duration // 60
-            seconds = obj.call_duration % 60
-            return f"{minutes:02d}:{seconds:02d}"
-        return "00:00"
+        return format_duration(obj.call_duration)
+
+
+def format_duration(duration):
+    if duration:
+        return f"{duration // 60:02d}:{duration % 60:02d}"
+    return "00:00"
+
+
+def nested_contact(row):
+    if row['contact_id'] is None:
+        return None
+    return {
+        'id': row['contact_id'],
+        'name': row['contact__name'],
+        'phone_number': row['contact__phone_number'],
+        'email': row['contact__email'],
+    }
+
+
+def nested_user(row):
+    return {
+        'id': row['user_id'],
+        'username': row['user__username'],
+        'first_name': row['user__first_name'],
+        'last_name': row['user__last_name'],
+    }
+
+
+def annotate_call_history(calls):
+    """The SQL-computed fields of CALL_HISTORY_VALUES"""
+    return calls.annotate(
+        display_name=Coalesce('contact__name', Value('Unknown Contact')),
+        display_number=Coalesce('contact__phone_number', 'contact_number'),
+    )
+
+
+# CallHistorySerializer over values() rows of annotate_call_history();
+# id and created_at are always fetched for the history cursor
+CALL_HISTORY_VALUES = ValuesSerializer({
+    'id': column('id'),
+    'contact': (('contact_id', 'contact__name', 'contact__phone_number', 'contact__email'), nested_contact),
+    'contact_number': column('contact_number'),
+    'user': (('user_id', 'user__username', 'user__first_name', 'user__last_name'), nested_user),
+    'created_at': datetime_column('created_at'),
+    'call_status': column('call_status'),
+    'call_duration': column('call_duration'),
+    'call_start_time': datetime_column('call_start_time'),
+    'call_end_time': datetime_column('call_end_time'),
+    'display_name': column('display_name'),
+    'display_number': column('display_number'),
+    'duration_formatted': (('call_duration',), lambda row: format_duration(row['call_duration'])),
+    'call_direction': column('call_direction'),
+}, required_columns=('id', 'created_at'))
+
+# Delta sync rows (see call.sync): related rows by id, so a contact change
+# never goes stale in the client's copy of its calls
+CALL_SYNC_VALUES = ValuesSerializer({
+    'id': column('id'),
+    'contact': (('contact_id',), lambda row: row['contact_id']),
+    'contact_number': column('contact_number'),
+    'created_at': datetime_column('created_at'),
+    'updated_at': datetime_column('updated_at'),
+    'call_status': column('call_status'),
+    'call_duration': column('call_duration'),
+    'call_start_time': datetime_column('call_start_time'),
+    'call_end_time': datetime_column('call_end_time'),
+    'call_sid': column('call_sid'),
+    'call_direction': column('call_direction'),
+}, required_columns=('id', 'updated_at'))
+
+NOTE_SYNC_VALUES = ValuesSerializer({
+    'id': column('id'),
+    'call': (('call_id',), lambda row: row['call_id']),
+    'note': column('note'),
+    'created_at': datetime_column('created_at'),
+    'updated_at': datetime_column('updated_at'),
+}, required_columns=('id', 'updated_at'))
@@ -0,0 +1,162 @@
+"""
+Delta sync for calls, notes and contacts.
+
+A client keeps a local mirror and polls a changes endpoint with the cursor
+from its previous response. Each response holds the rows whose updated_at
+moved past the cursor, in (updated_at, id) order, and the ids of rows
+deleted since then. Deleted rows are returned from Tombstone. So a poll
+costs about as much as the number of changes, however long the history is.
+
+The cursor holds two keyset positions, one in the rows and one in the
+tombstones. updated_at is set when a write is made, but other readers only
+see the row once its transaction commits. So a cursor must never move past
+a timestamp that a transaction still in progress might have written. Rows
+and tombstones are returned as soon as they are visible, but the cursor
+only moves past those older than SYNC_SETTLE_SECONDS. Newer ones come back
+again on the next poll, which is harmless for a client that upserts by id.
+That makes SYNC_SETTLE_SECONDS the longest a write transaction may take
+between stamping updated_at and committing. A transaction that takes
+longer can be missed by clients whose cursor moved past its timestamp.
+The longest writers are a CONTACT_IMPORT_MAX_ROWS import, a bulk upsert,
+and the per-batch transactions of merge_duplicate_contacts. Keep them
+under the window, e.g. with --users-per-batch.
+Without a cursor the rows start from the beginning, which is the initial
+snapshot, and the tombstones start from the settled edge of now.
+Tombstones are kept for SYNC_TOMBSTONE_RETENTION_DAYS (see the
+prune_sync_tombstones command). A cursor older than that may have missed
+deletions and is refused with SyncCursorExpired. The client must then
+sync again from scratch.
+
+Every write path sets updated_at, including QuerySet.update() calls and
+the contact upsert. Tombstones are written by the delete() methods of the
+Call, Note and Contact models and querysets, with one INSERT per delete
+and no delete signals, so Django can still delete in bulk. Deleting a
+call also logs its notes, and deleting a contact touches its calls with
+one UPDATE, because their contact becomes NULL. Deleting a user logs
+nothing, since the user's tombstones go with them. Rows removed any other
+way, e.g. by raw SQL, leave no tombstone. The contact call summary (call_count,
+last_call_at, total_talk_seconds) is kept by triggers that leave
+updated_at alone, so it is not part of the contact rows here. Clients
+derive it from their calls.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Call, Note, Tombstone
+
+
+class SyncCursorExpired(ValueError):
+    pass
+
+
+def encode_sync_cursor(row_position, tombstone_position):
+    """Encode the two (timestamp, id) positions as an opaque cursor; row_position may be None"""
+    payload = json.dumps([
+        [row_position[0].isoformat(), row_position[1]] if row_position else None,
+        [tombstone_position[0].isoformat(), tombstone_position[1]],
+    ])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_sync_cursor(cursor):
+    """Decode a cursor produced by encode_sync_cursor; raises ValueError"""
+    try:
+        row_position, (deleted_at, tombstone_id) = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if row_position is not None:
+            row_position = (datetime.fromisoformat(row_position[0]), int(row_position[1]))
+        return row_position, (datetime.fromisoformat(deleted_at), int(tombstone_id))
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def after(queryset, field, position):
+    """Rows past position in (field, id) order"""
+    if position is None:
+        return queryset.order_by(field, 'id')
+    value, row_id = position
+    return queryset.filter(
+        Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': row_id})
+    ).order_by(field, 'id')
+
+
+def changes_since(queryset, model, user, cursor, values, fields, page_size):
+    """One page of changes to queryset's rows and of model's tombstones for user.
+
+    values is the ValuesSerializer for the rows; it must always fetch id
+    and updated_at. Raises ValueError for a malformed cursor and
+    SyncCursorExpired for one older than the tombstone retention.
+    """
+    now = timezone.now()
+    until = now - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+    if cursor:
+        row_position, tombstone_position = decode_sync_cursor(cursor)
+        if tombstone_position[0] < now - timedelta(days=settings.SYNC_TOMBSTONE_RETENTION_DAYS):
+            raise SyncCursorExpired("Cursor is older than the deletion log; sync again without one")
+    else:
+        row_position, tombstone_position = None, (until, 0)
+
+    rows = list(values.values(after(queryset, 'updated_at', row_position), fields)[:page_size + 1])
+    tombstones = list(
+        after(Tombstone.objects.filter(user=user, model=model), 'deleted_at', tombstone_position)
+        .values_list('deleted_at', 'id', 'object_id')[:page_size + 1]
+    )
+    more_rows, more_tombstones = len(rows) > page_size, len(tombstones) > page_size
+    rows, tombstones = rows[:page_size], tombstones[:page_size]
+    # The cursor only moves past settled changes; pages of unsettled ones end the sync for now
+    settled_rows = [row for row in rows if row['updated_at'] <= until]
+    settled_tombstones = [tombstone for tombstone in tombstones if tombstone[0] <= until]
+    if settled_rows:
+        row_position = (settled_rows[-1]['updated_at'], settled_rows[-1]['id'])
+    if settled_tombstones:
+        tombstone_position = settled_tombstones[-1][:2]
+    has_more = (more_rows and bool(settled_rows)) or (more_tombstones and bool(settled_tombstones))
+    return {
+        'changed': values.serialize(rows, fields),
+        'deleted': [object_id for _, _, object_id in tombstones],
+        'next_cursor': encode_sync_cursor(row_position, tombstone_position),
+        'has_more': has_more,
+    }
+
+
+def sync_page_size(params):
+    """?page_size= for the changes endpoints, capped at SYNC_PAGE_SIZE; raises ValueError"""
+    page_size = int(params.get('page_size', settings.SYNC_PAGE_SIZE))
+    if page_size < 1:
+        raise ValueError("page_size must be positive")
+    return min(page_size, settings.SYNC_PAGE_SIZE)
+
+
+def record_deletions(model, rows):
+    """Tombstones for (object id, user id) rows about to be deleted, in one INSERT"""
+    Tombstone.objects.bulk_create([
+        Tombstone(model=model, object_id=object_id, user_id=user_id)
+        for object_id, user_id in rows if user_id is not None
+    ], batch_size=1000)
+
+
+def record_call_deletions(calls):
+    """Log the calls about to be deleted, and the notes deleted with them"""
+    record_deletions('call', calls.values_list('id', 'user_id'))
+    record_deletions('note', Note.objects.filter(call__in=calls.values('id')).values_list('id', 'user_id'))
+
+
+def record_note_deletions(notes):
+    record_deletions('note', notes.values_list('id', 'user_id'))
+
+
+def record_contact_deletions(contacts):
+    """Log the contacts about to be deleted and touch their calls, which lose their contact"""
+    record_deletions('contact', contacts.values_list('id', 'user_id'))
+    Call.objects.filter(contact__in=contacts.values('id')).update(updated_at=timezone.now())
+
+
+def prune_tombstones():
+    """Delete tombstones older than the retention; returns the number deleted"""
+    cutoff = timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_RETENTION_DAYS)
+    return Tombstone.objects.filter(deleted_at__lt=cutoff).delete()[0]
@@ -1,3 +1,891 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, connections, migrations
+from django.db.models import Count
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import jwt
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from contact import fast_serializers
+from contact.caller_cache import caller_cache
+from contact.models import Contact
+from .models import Call, DailyCallStat, Note, PendingCallStatus, Tombstone
+from .apps import drop_call_rollup_triggers
+from .rollups import ensure_sqlite_rollup_triggers, rebuild_daily_rollups
+from .search import search_calls
+from .serializers import CallHistorySerializer
+from .sync import prune_tombstones
+from .tokens import VoiceTokenCache
+from .write_queue import CallWriteQueue, call_record, write_calls
+
+
+class CallContactResolutionTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.other = User.objects.create_user(username='bob', password='pass12345')
+
+    def test_save_links_contact_by_normalized_number(self):
+        contact = Contact.objects.create(user=self.user, name='A', phone_number='+1 234 567 8900')
+        call = Call.objects.create(user=self.user, contact_number='12345678900', call_status='initiated')
+        self.assertEqual(call.normalized_number, '12345678900')
+        self.assertEqual(call.contact, contact)
+
+    def test_save_does_not_link_other_users_contact(self):
+        Contact.objects.create(user=self.other, name='B', phone_number='+12345678900')
+        call = Call.objects.create(user=self.user, contact_number='+12345678900', call_status='initiated')
+        self.assertIsNone(call.contact)
+
+
+class CallHistoryPaginationTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number=f'+1555000{index:04d}', call_status='completed')
+            for index in range(25)
+        ])
+
+    def test_page_number_contract_is_unchanged(self):
+        response = self.client.get('/api/call/history/', {'page': 2, 'page_size': 10})
+        self.assertEqual(response.data['total'], 25)
+        self.assertEqual(response.data['total_pages'], 3)
+        self.assertEqual(response.data['page'], 2)
+        self.assertEqual(len(response.data['calls']), 10)
+        self.assertNotIn('next_cursor', response.data)
+
+    def test_cursor_mode_walks_every_call_once(self):
+        seen = []
+        params = {'pagination': 'cursor', 'page_size': 10}
+        while True:
+            response = self.client.get('/api/call/history/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.data['total'])
+            seen += [call['id'] for call in response.data['calls']]
+            if not response.data['next_cursor']:
+                break
+            params = {'cursor': response.data['next_cursor'], 'page_size': 10}
+        self.assertEqual(seen, sorted(Call.objects.values_list('id', flat=True), reverse=True))
+
+    def test_cursor_mode_skips_count_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/call/history/', {'pagination': 'cursor'})
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+
+    def test_approximate_total_and_invalid_cursor(self):
+        response = self.client.get('/api/call/history/', {'total': 'approximate'})
+        self.assertEqual(response.data['total'], 25)
+        self.assertFalse(response.data['total_is_approximate'])
+        response = self.client.get('/api/call/history/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CallQueryBudgetTests(TestCase):
+    """Fixed query budgets; a per-row query anywhere makes these fail"""
+
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        token = RefreshToken.for_user(self.user).access_token
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        contacts = [
+            Contact.objects.create(user=self.user, name=f'Contact {index}', phone_number=f'+1555100{index:04d}')
+            for index in range(10)
+        ]
+        calls = []
+        for index in range(40):
+            contact = contacts[index % 10] if index % 2 else None
+            calls.append(Call(user=self.user, contact=contact, contact_number=f'+1555100{index % 10:04d}',
+                              call_status='completed', call_duration=index * 7))
+        Call.objects.bulk_create(calls)
+        self.call = Call.objects.filter(contact__isnull=False).first()
+        Note.objects.bulk_create([Note(call=self.call, note=f'Note {index}') for index in range(5)])
+
+    def test_call_history_budget(self):
+        # user, count, page
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/call/history/', {'page_size': 40})
+        self.assertEqual(len(response.data['calls']), 40)
+
+    def test_call_history_cursor_budget(self):
+        # user, page
+        with self.assertNumQueries(2):
+            self.client.get('/api/call/history/', {'pagination': 'cursor', 'page_size': 40})
+
+    def test_call_detail_budget(self):
+        # user, call with contact and user, notes
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/call/detail/{self.call.id}/')
+        self.assertEqual(len(response.data['call']['notes']), 5)
+        self.assertEqual(response.data['call']['display_name'], self.call.contact.name)
+
+
+class CallHistoryFastPathTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345', first_name='Ålice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        contact = Contact.objects.create(user=self.user, name='Zoë \u2028 "Z"', phone_number='+15550001111')
+        now = timezone.now()
+        Call.objects.bulk_create([
+            Call(user=self.user, contact=contact if index % 3 == 0 else None,
+                 contact_number=f'+1555000{index:04d}' if index % 4 else None,
+                 call_status='completed', call_duration=index * 37,
+                 call_start_time=now - timedelta(minutes=index) if index % 2 else None,
+                 call_end_time=now if index % 2 else None)
+            for index in range(12)
+        ])
+
+    def expected(self, **params):
+        calls = Call.objects.filter(user=self.user).select_related('contact', 'user').order_by('-created_at', '-id')
+        return CallHistorySerializer(calls[:params.get('page_size', 20)], many=True).data
+
+    def test_output_is_byte_identical_to_serializer(self):
+        for orjson in (fast_serializers.orjson, None):
+            with self.subTest(orjson=orjson is not None), mock.patch.object(fast_serializers, 'orjson', orjson):
+                response = self.client.get('/api/call/history/', {'page_size': 20})
+                self.assertEqual(response.content, JSONRenderer().render({
+                    'calls': self.expected(), 'total': 12, 'page': 1, 'page_size': 20,
+                    'total_pages': 1, 'status': 'success',
+                }))
+        self.assertIn(b'\\u2028', response.content)
+
+    def test_sparse_fieldset_and_cursor(self):
+        response = self.client.get('/api/call/history/', {
+            'pagination': 'cursor', 'page_size': 5, 'fields': 'display_name,duration_formatted',
+        })
+        expected = [
+            {'display_name': row['display_name'], 'duration_formatted': row['duration_formatted']}
+            for row in self.expected()
+        ]
+        self.assertEqual(response.json()['calls'], expected[:5])
+        response = self.client.get('/api/call/history/', {
+            'cursor': response.json()['next_cursor'], 'page_size': 5, 'fields': 'display_name,duration_formatted',
+        })
+        self.assertEqual(response.json()['calls'], expected[5:10])
+
+    def test_unknown_field_is_rejected(self):
+        response = self.client.get('/api/call/history/', {'fields': 'id,notes'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('notes', response.json()['error'])
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class CallChangesTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.contact = Contact.objects.create(user=self.user, name='Ann', phone_number='+15550001111')
+        Call.objects.bulk_create([
+            Call(user=self.user, contact=self.contact if index == 0 else None, contact_number=f'+1555000{index:04d}',
+                 call_status='initiated', call_sid=f'CA{index}')
+            for index in range(7)
+        ])
+        self.note = Note.objects.create(call=Call.objects.get(call_sid='CA1'), note='Call back')
+
+    def changes(self, since=None, path='/api/call/changes/', **params):
+        if since:
+            params['since'] = since
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def sync(self, since=None, path='/api/call/changes/', key='calls'):
+        """Follow next_cursor until has_more is false; returns (changed ids, deleted ids, cursor)"""
+        changed, deleted = [], []
+        while True:
+            page = self.changes(since, path, page_size=3)
+            changed += [row['id'] for row in page[key]]
+            deleted += page['deleted']
+            since = page['next_cursor']
+            if not page['has_more']:
+                return changed, deleted, since
+
+    def test_snapshot_then_only_changes(self):
+        changed, deleted, cursor = self.sync()
+        self.assertEqual(sorted(changed), sorted(Call.objects.values_list('id', flat=True)))
+        self.assertEqual(deleted, [])
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+
+        Call.objects.advance_status('CA3', 'completed', 42)
+        Call.objects.get(call_sid='CA5').delete()
+        row = self.changes(cursor)['calls'][0]
+        self.assertEqual((row['call_sid'], row['call_status'], row['call_duration']), ('CA3', 'completed', 42))
+        changed, deleted, cursor = self.sync(cursor)
+        self.assertEqual(changed, [Call.objects.get(call_sid='CA3').id])
+        self.assertEqual(len(deleted), 1)
+        self.assertFalse(Call.objects.filter(id=deleted[0]).exists())
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+
+    def test_notes_and_cascaded_deletes(self):
+        self.assertEqual(self.note.user, self.user)
+        changed, _, cursor = self.sync(path='/api/call/notes/changes/', key='notes')
+        self.assertEqual(changed, [self.note.id])
+        self.note.call.delete()
+        self.assertEqual(self.sync(cursor, '/api/call/notes/changes/', 'notes')[:2], ([], [self.note.id]))
+
+    def test_deleting_a_contact_changes_its_calls(self):
+        _, _, cursor = self.sync()
+        self.contact.delete()
+        page = self.changes(cursor)
+        self.assertEqual([(row['call_sid'], row['contact']) for row in page['calls']], [('CA0', None)])
+        contacts = self.changes(path='/api/contact/contacts/changes/')
+        self.assertEqual(contacts['contacts'], [])
+
+    def test_cursor_stays_behind_the_settle_window(self):
+        _, _, cursor = self.sync()
+        with override_settings(SYNC_SETTLE_SECONDS=60):
+            Call.objects.advance_status('CA3', 'completed')
+            Call.objects.get(call_sid='CA5').delete()
+            page = self.changes(cursor)
+            self.assertEqual([row['call_sid'] for row in page['calls']], ['CA3'])
+            self.assertEqual(len(page['deleted']), 1)
+            # Unsettled changes come back until they are older than the window
+            again = self.changes(page['next_cursor'])
+            self.assertEqual((again['calls'], again['deleted']), (page['calls'], page['deleted']))
+            self.assertFalse(self.changes(page['next_cursor'], page_size=1)['has_more'])
+        # Once settled they are delivered one last time and the cursor moves past them
+        changed, deleted, cursor = self.sync(page['next_cursor'])
+        self.assertEqual((changed, deleted), ([page['calls'][0]['id']], page['deleted']))
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+
+    def test_bulk_deletes_take_a_fixed_number_of_queries(self):
+        def delete_queries(count):
+            Tombstone.objects.all().delete()
+            contacts = Contact.objects.bulk_create([
+                Contact(user=self.user, name=f'Bulk {index}', phone_number=f'+1555200{index:04d}')
+                for index in range(count)
+            ])
+            calls = Call.objects.bulk_create([
+                Call(user=self.user, contact=contact, contact_number=contact.phone_number, call_status='completed')
+                for contact in contacts * 2
+            ])
+            Note.objects.bulk_create([Note(call=call, user=self.user, note='Bulk') for call in calls])
+            with CaptureQueriesContext(connection) as queries:
+                Call.objects.filter(id__in=[call.id for call in calls[:count]]).delete()
+                Contact.objects.filter(name__startswith='Bulk').delete()
+            self.assertEqual(
+                dict(Tombstone.objects.values_list('model').annotate(Count('id'))),
+                {'call': count, 'note': count, 'contact': count},
+            )
+            self.assertFalse(Call.objects.filter(id__in=[call.id for call in calls[count:]], contact__isnull=False)
+                             .exists())
+            return len(queries)
+
+        self.assertEqual(delete_queries(3), delete_queries(30))
+
+    def test_sparse_fields_and_bad_cursors(self):
+        self.assertEqual(set(self.changes(fields='call_status')['calls'][0]), {'call_status'})
+        self.assertEqual(self.client.get('/api/call/changes/', {'since': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/call/changes/', {'page_size': 0}).status_code, 400)
+        cursor = self.changes()['next_cursor']
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(days=31)):
+            self.assertEqual(self.client.get('/api/call/changes/', {'since': cursor}).status_code, 410)
+
+    def test_tombstones_are_pruned_and_go_with_their_user(self):
+        Call.objects.get(call_sid='CA2').delete()
+        Tombstone.objects.update(deleted_at=timezone.now() - timedelta(days=31))
+        Call.objects.get(call_sid='CA4').delete()
+        self.assertEqual(prune_tombstones(), 1)
+        self.user.delete()
+        self.assertFalse(Tombstone.objects.exists())
+
+
+class CallExportTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.contact = Contact.objects.create(user=self.user, name='Ann, "A"', phone_number='+15550001111')
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number=f'+1555000{index:04d}', normalized_number=f'1555000{index:04d}',
+                 call_status='completed' if index % 2 else 'failed', call_sid=f'CA{index}', call_duration=index)
+            for index in range(25)
+        ])
+        Call.objects.filter(call_sid='CA1').update(contact=self.contact)
+
+    def export(self, **params):
+        response = self.client.get('/api/call/export/', params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    @override_settings(EXPORT_CHUNK_SIZE=4)
+    def test_csv_streams_filtered_rows_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            response, body = self.export(status='completed')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="calls-', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        self.assertEqual(len(rows), 12)
+        self.assertEqual({row['call_status'] for row in rows}, {'completed'})
+        self.assertEqual(next(row for row in rows if row['call_sid'] == 'CA1')['contact_name'], 'Ann, "A"')
+        # Rows come from one streamed query, not one per chunk or row
+        self.assertEqual(sum('call_call' in query['sql'] for query in queries.captured_queries), 1)
+
+    def test_ndjson_gzip(self):
+        response, body = self.export(output='ndjson', compress='gzip', status='failed')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.ndjson.gz"'))
+        rows = [json.loads(line) for line in gzip.decompress(body).decode().splitlines()]
+        self.assertEqual({row['call_sid'] for row in rows}, {f'CA{index}' for index in range(0, 25, 2)})
+        self.assertEqual(rows[0]['call_duration'], int(rows[0]['call_sid'][2:]))
+        self.assertIsNone(rows[0]['contact_name'])
+
+    def test_invalid_options(self):
+        self.assertEqual(self.client.get('/api/call/export/', {'output': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/call/export/', {'compress': 'zip'}).status_code, 400)
+
+
+class CallHistoryIndexTests(TestCase):
+    """EXPLAIN the history queries and check they are served by the composite indexes"""
+
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.contact = Contact.objects.create(user=self.user, name='A', phone_number='+12345678900')
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be sequentially scanned
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_history_uses_user_created_index(self):
+        start = timezone.now() - timedelta(days=7)
+        queryset = Call.objects.filter(user=self.user, created_at__gte=start).order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset[:20], 'call_user_created_idx')
+
+    def test_status_filter_uses_user_status_created_index(self):
+        queryset = Call.objects.filter(user=self.user, call_status='completed').order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset[:20], 'call_user_status_created_idx')
+
+    def test_note_changes_use_user_updated_index(self):
+        queryset = Note.objects.filter(user=self.user, updated_at__gt=timezone.now()).order_by('updated_at', 'id')
+        self.assertUsesIndex(queryset[:500], 'note_user_updated_idx')
+
+    def test_contact_filter_uses_contact_created_index(self):
+        queryset = Call.objects.filter(user=self.user, contact=self.contact).order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset[:20], 'call_contact_created_idx')
+
+    def test_call_sid_lookup_is_not_a_scan(self):
+        plan = Call.objects.filter(call_sid='CA123').explain()
+        self.assertNotIn('SCAN call_call', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_date_filters_are_half_open_ranges(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        call = Call.objects.create(user=self.user, contact_number='+12345678900', call_status='completed')
+        day = timezone.localtime(call.created_at).strftime('%Y-%m-%d')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/call/history/', {'date_from': day, 'date_to': day})
+        self.assertEqual(response.data['total'], 1)
+        self.assertFalse(any('django_datetime_cast_date' in query['sql'] for query in queries))
+
+
+class CallHistorySearchTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        contact = Contact.objects.create(user=self.user, name='Margaret', phone_number='+15557771234')
+        self.linked = Call.objects.create(user=self.user, contact_number='+15557771234', call_status='completed')
+        self.unlinked = Call.objects.create(user=self.user, contact_number='+442079460000', call_status='completed')
+        self.assertEqual(self.linked.contact, contact)
+
+    def search(self, query):
+        response = self.client.get('/api/call/history/', {'search': query})
+        return {call['id'] for call in response.data['calls']}
+
+    def test_search_by_contact_name_and_number(self):
+        self.assertEqual(self.search('garet'), {self.linked.id})
+        self.assertEqual(self.search('2079'), {self.unlinked.id})
+        self.assertEqual(self.search('+'), {self.linked.id, self.unlinked.id})
+
+    def test_contact_side_only_scans_the_users_contacts(self):
+        other = User.objects.create_user(username='bob', password='pass12345')
+        Contact.objects.create(user=other, name='Margaret', phone_number='+15550001111')
+        query = str(search_calls(Call.objects.filter(user=self.user), 'garet', self.user).query)
+        self.assertIn(f'FROM "contact_contact" U0 WHERE (U0."user_id" = {self.user.id}', query)
+        self.assertEqual(self.search('garet'), {self.linked.id})
+
+    def test_search_follows_number_updates(self):
+        self.unlinked.contact_number = '+33140000000'
+        self.unlinked.save()
+        self.assertEqual(self.search('2079'), set())
+        self.assertEqual(self.search('3314'), {self.unlinked.id})
+
+
+@override_settings(CALL_WRITE_BEHIND=False)
+class AsyncVoiceWebhookTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.contact = Contact.objects.create(user=self.user, name='Caller', phone_number='5551234567')
+
+    async def test_inbound_call_is_recorded_and_updated(self):
+        client = AsyncClient()
+        response = await client.post('/api/call/voice/handler/', {
+            'Direction': 'inbound', 'From': '+15551234567', 'To': '+15550000000',
+            'CallSid': 'CA-async-1', 'UserId': str(self.user.id),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<Client>dashboard</Client>', response.content)
+        call = await Call.objects.select_related('contact').aget(call_sid='CA-async-1')
+        self.assertEqual(call.contact, self.contact)
+        self.assertEqual(call.call_direction, 'incoming')
+
+        response = await client.post('/api/call/voice/status/', {
+            'CallSid': 'CA-async-1', 'CallStatus': 'completed', 'CallDuration': '42',
+        })
+        self.assertEqual(response.status_code, 200)
+        call = await Call.objects.aget(call_sid='CA-async-1')
+        self.assertEqual((call.call_status, call.call_duration), ('completed', 42))
+
+    async def test_duplicate_webhook_creates_one_call(self):
+        client = AsyncClient()
+        data = {'Direction': 'outbound-api', 'To': '+15551234567', 'CallSid': 'CA-async-2', 'UserId': str(self.user.id)}
+        await client.post('/api/call/voice/handler/', data)
+        await client.post('/api/call/voice/handler/', data)
+        self.assertEqual(await Call.objects.filter(call_sid='CA-async-2').acount(), 1)
+
+    async def test_write_queue_runs_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        queue_threads = []
+        queue = mock.Mock()
+        queue.enqueue.side_effect = lambda record: queue_threads.append(threading.current_thread()) or True
+        queue.merge_pending.side_effect = lambda *args: queue_threads.append(threading.current_thread()) or True
+        client = AsyncClient()
+        with override_settings(CALL_WRITE_BEHIND=True), \
+                mock.patch('call.views.get_call_write_queue', return_value=queue):
+            await client.post('/api/call/voice/handler/', {
+                'Direction': 'outbound-api', 'To': '+15551234567', 'CallSid': 'CA-async-3',
+            })
+            await client.post('/api/call/voice/status/', {'CallSid': 'CA-async-3', 'CallStatus': 'completed'})
+        self.assertEqual(len(queue_threads), 2)
+        self.assertNotIn(loop_thread, queue_threads)
+
+    async def test_fallback(self):
+        response = await AsyncClient().post('/api/call/voice/fallback/')
+        self.assertIn(b'<Say>', response.content)
+
+
+@override_settings(CALL_WRITE_BEHIND=False)
+class IdempotentCallInsertTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.contact = Contact.objects.create(user=self.user, name='Callee', phone_number='+15551234567')
+        self.data = {'Direction': 'outbound-api', 'To': '+1 (555) 123-4567', 'CallSid': 'CA-once', 'UserId': str(self.user.id)}
+
+    def test_webhook_insert_is_one_statement(self):
+        self.client.post('/api/call/voice/handler/', self.data)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/call/voice/handler/', self.data)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('INSERT', queries[0]['sql'])
+        call = Call.objects.get(call_sid='CA-once')
+        self.assertEqual((call.user, call.contact), (self.user, self.contact))
+
+    def test_retry_does_not_overwrite_the_stored_call(self):
+        write_calls([call_record('CA-once', '+15551234567', 'initiated', 'outgoing', user_id=self.user.id)])
+        Call.objects.advance_status('CA-once', 'completed', 12)
+        write_calls([call_record('CA-once', '+15551234567', 'initiated', 'outgoing', user_id=self.user.id)])
+        call = Call.objects.get()
+        self.assertEqual((call.call_status, call.call_duration), ('completed', 12))
+
+    def test_unknown_user_is_stored_as_null(self):
+        write_calls([call_record('CA-nouser', '+15551234567', 'initiated', 'outgoing', user_id=999999)])
+        call = Call.objects.get(call_sid='CA-nouser')
+        self.assertIsNone(call.user_id)
+        self.assertIsNone(call.contact_id)
+
+
+class WebhookMetricsTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+
+    def test_metrics_are_staff_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/call/metrics/').status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        caller_cache.resolve_caller('+15551234567', user=self.user)
+        caller_cache.resolve_caller('+15551234567', user=self.user)
+        stats = self.client.get('/api/call/metrics/').json()['caller_cache']
+        self.assertGreaterEqual(stats['hits'], 1)
+        self.assertGreaterEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+
+class VoiceTokenCacheTests(TestCase):
+    def setUp(self):
+        self.now = [1_000_000.0]
+        self.cache = VoiceTokenCache(
+            'ACtest', 'SKtest', 'secret', 'APtest', ttl=3600, refresh_margin=300, clock=lambda: self.now[0]
+        )
+
+    def test_token_is_reused_until_the_refresh_margin(self):
+        token, expires_at = self.cache.get('alice')
+        self.assertEqual(expires_at, 1_000_000 + 3600)
+        payload = jwt.decode(token, 'secret', algorithms=['HS256'], options={'verify_exp': False})
+        self.assertEqual(payload['grants']['identity'], 'alice')
+        self.assertEqual(payload['grants']['voice']['outgoing']['application_sid'], 'APtest')
+
+        self.now[0] += 3000
+        self.assertEqual(self.cache.get('alice')[0], token)
+        self.assertNotEqual(self.cache.get('bob')[0], token)
+        self.now[0] += 301
+        self.assertNotEqual(self.cache.get('alice')[0], token)
+        self.assertEqual(self.cache.stats(), {'size': 2, 'hits': 1, 'minted': 3, 'reuse_rate': 0.25})
+
+    def test_endpoint_serves_cached_token(self):
+        user = User.objects.create_user(username='alice', password='pass12345', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch('call.views.voice_token_cache', self.cache):
+            first = client.get('/api/call/token/').data
+            second = client.get('/api/call/token/').data
+            metrics = client.get('/api/call/metrics/').data
+        self.assertEqual(first['token'], second['token'])
+        self.assertEqual(first['identity'], 'alice')
+        self.assertEqual(metrics['access_tokens']['reuse_rate'], 0.5)
+
+
+class CallWriteQueueTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.contact = Contact.objects.create(user=self.user, name='Caller', phone_number='5551234567')
+        self.queue = CallWriteQueue(max_size=2, batch_size=10, flush_interval=0.1, autostart=False)
+        patcher = mock.patch('call.views.get_call_write_queue', return_value=self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_inbound(self, call_sid):
+        return self.client.post('/api/call/voice/handler/', {
+            'Direction': 'inbound', 'From': '+15551234567', 'CallSid': call_sid, 'UserId': str(self.user.id),
+        })
+
+    def test_handler_returns_twiml_before_the_insert(self):
+        with self.assertNumQueries(0):
+            response = self.post_inbound('CA-queued-1')
+        self.assertIn(b'<Dial', response.content)
+        self.assertFalse(Call.objects.filter(call_sid='CA-queued-1').exists())
+
+        self.queue.flush()
+        call = Call.objects.get(call_sid='CA-queued-1')
+        self.assertEqual((call.contact, call.user, call.normalized_number), (self.contact, self.user, '15551234567'))
+
+    def test_status_callback_merges_into_queued_call(self):
+        self.post_inbound('CA-queued-2')
+        self.client.post('/api/call/voice/status/', {
+            'CallSid': 'CA-queued-2', 'CallStatus': 'completed', 'CallDuration': '30',
+        })
+        self.queue.flush()
+        call = Call.objects.get(call_sid='CA-queued-2')
+        self.assertEqual((call.call_status, call.call_duration), ('completed', 30))
+        self.assertIsNotNone(call.call_end_time)
+
+    def test_two_workers_sharing_the_database(self):
+        workers = [CallWriteQueue(max_size=10, batch_size=3, flush_interval=0.1, autostart=False) for _ in range(2)]
+        call_sids = [f'CA-worker-{index}' for index in range(6)]
+        for index, call_sid in enumerate(call_sids):
+            with mock.patch('call.views.get_call_write_queue', return_value=workers[index % 2]):
+                self.post_inbound(call_sid)
+                self.client.post('/api/call/voice/status/', {'CallSid': call_sid, 'CallStatus': 'ringing'})
+            # Twilio's next callback lands on the other worker
+            with mock.patch('call.views.get_call_write_queue', return_value=workers[(index + 1) % 2]):
+                self.client.post('/api/call/voice/status/', {
+                    'CallSid': call_sid, 'CallStatus': 'completed', 'CallDuration': str(10 + index),
+                })
+            if index == 2:
+                workers[0].flush()
+
+        workers[1].flush()
+        workers[0].flush()
+        self.assertEqual(
+            dict(Call.objects.values_list('call_sid', 'call_status')),
+            {call_sid: 'completed' for call_sid in call_sids},
+        )
+        self.assertEqual(sorted(Call.objects.values_list('call_duration', flat=True)), list(range(10, 16)))
+        self.assertFalse(PendingCallStatus.objects.exists())
+
+    def test_status_callback_for_a_call_queued_in_another_worker(self):
+        other_worker = CallWriteQueue(max_size=10, batch_size=10, flush_interval=0.1, autostart=False)
+        other_worker.enqueue(call_record('CA-elsewhere', '+15551234567', 'ringing', 'incoming',
+                                         user_id=self.user.id, match='caller'))
+        for status, duration in (('in-progress', '0'), ('completed', '30'), ('ringing', '0')):
+            response = self.client.post('/api/call/voice/status/', {
+                'CallSid': 'CA-elsewhere', 'CallStatus': status, 'CallDuration': duration,
+            })
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(PendingCallStatus.objects.count(), 3)
+
+        other_worker.flush()
+        call = Call.objects.get(call_sid='CA-elsewhere')
+        self.assertEqual((call.call_status, call.call_duration), ('completed', 30))
+        self.assertIsNotNone(call.call_end_time)
+        self.assertFalse(PendingCallStatus.objects.exists())
+
+    def test_full_queue_writes_synchronously_and_duplicates_are_ignored(self):
+        for call_sid in ('CA-1', 'CA-2', 'CA-3', 'CA-3'):
+            self.post_inbound(call_sid)
+        self.assertEqual(list(Call.objects.values_list('call_sid', flat=True)), ['CA-3'])
+        self.queue.flush()
+        self.queue.enqueue(call_record('CA-1', '+15551234567', 'ringing', 'incoming'))
+        self.queue.flush()
+        self.assertEqual(Call.objects.count(), 3)
+
+    def test_contact_deleted_behind_the_cache_is_not_linked(self):
+        self.assertEqual(caller_cache.resolve_caller('+15551234567', user=self.user.id).id, self.contact.id)
+        # Another worker deletes the contact; this process gets no signal
+        Contact.objects.filter(id=self.contact.id)._raw_delete(Contact.objects.db)
+        self.post_inbound('CA-stale')
+        self.queue.enqueue(call_record('CA-other', '+15559998888', 'ringing', 'incoming', user_id=self.user.id))
+        self.queue.flush()
+        self.assertEqual(
+            dict(Call.objects.values_list('call_sid', 'contact')), {'CA-stale': None, 'CA-other': None}
+        )
+
+    def test_journal_of_dead_process_is_replayed(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            record = call_record('CA-replayed', '+15551234567', 'ringing', 'incoming',
+                                 user_id=self.user.id, match='caller')
+            with open(os.path.join(journal_dir, 'calls-999999999.jsonl'), 'w') as journal:
+                journal.write(json.dumps(record) + '\n')
+                journal.write(json.dumps({**record, 'call_status': 'completed'}) + '\n')
+                journal.write('{"torn')
+
+            queue = CallWriteQueue(max_size=10, batch_size=10, flush_interval=0.1,
+                                   journal_dir=journal_dir, autostart=False)
+            self.assertEqual(list(queue.pending), ['CA-replayed'])
+            queue.flush()
+            self.assertEqual(os.listdir(journal_dir), [])
+
+        call = Call.objects.get(call_sid='CA-replayed')
+        self.assertEqual((call.call_status, call.contact), ('completed', self.contact))
+
+
+    def test_unwritable_record_is_dead_lettered_without_blocking_the_queue(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            queue = CallWriteQueue(max_size=10, batch_size=10, flush_interval=0.1,
+                                   journal_dir=journal_dir, autostart=False)
+            queue.enqueue({**call_record('CA-bad', '+15551234567', 'ringing', 'incoming'),
+                           'call_start_time': 'yesterday'})
+            queue.enqueue(call_record('CA-good', '+15551234567', 'ringing', 'incoming'))
+            with self.assertLogs('call.write_queue', 'ERROR') as logs:
+                queue.flush()
+            self.assertIn('CA-bad to the dead-letter journal', logs.output[-1])
+            self.assertEqual(list(queue.pending), [])
+            self.assertEqual(os.listdir(journal_dir), ['dead-calls.jsonl'])
+            with open(os.path.join(journal_dir, 'dead-calls.jsonl')) as journal:
+                self.assertEqual([json.loads(line)['record']['call_sid'] for line in journal], ['CA-bad'])
+        self.assertEqual(list(Call.objects.values_list('call_sid', flat=True)), ['CA-good'])
+
+    def test_database_outage_keeps_records_queued(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            queue = CallWriteQueue(max_size=10, batch_size=10, flush_interval=0.1,
+                                   journal_dir=journal_dir, autostart=False)
+            queue.enqueue(call_record('CA-wait-1', '+15551234567', 'ringing', 'incoming'))
+            queue.enqueue(call_record('CA-wait-2', '+15551234567', 'ringing', 'incoming'))
+            with mock.patch('call.write_queue.write_queued_calls', side_effect=OperationalError('gone')), \
+                    self.assertLogs('call.write_queue', 'ERROR'):
+                self.assertFalse(queue.write_next_batch())
+            self.assertEqual(list(queue.pending), ['CA-wait-1', 'CA-wait-2'])
+            self.assertEqual(os.listdir(journal_dir), [queue.journal_path.name])
+
+            queue.flush()
+            self.assertEqual(os.listdir(journal_dir), [])
+        self.assertEqual(Call.objects.count(), 2)
+
+
+class CallStatusTransitionTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.call = Call.objects.create(
+            user=self.user, call_sid='CA-status', contact_number='+15551234567', call_status='initiated'
+        )
+
+    def test_update_is_a_single_statement(self):
+        with CaptureQueriesContext(connection) as queries:
+            updated = Call.objects.advance_status('CA-status', 'completed', 30)
+        self.assertEqual(updated, 1)
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertTrue(sql.startswith('UPDATE'))
+        self.assertNotIn('"contact_id"', sql.split('WHERE')[0])
+        self.call.refresh_from_db()
+        self.assertEqual((self.call.call_status, self.call.call_duration), ('completed', 30))
+        self.assertIsNotNone(self.call.call_end_time)
+
+    def test_late_and_duplicate_statuses_are_ignored(self):
+        Call.objects.advance_status('CA-status', 'completed', 30)
+        self.assertEqual(Call.objects.advance_status('CA-status', 'ringing'), 0)
+        self.assertEqual(Call.objects.advance_status('CA-status', 'completed', 99), 0)
+        self.assertEqual(Call.objects.advance_status('CA-status', 'failed'), 0)
+        self.assertEqual(Call.objects.advance_status('CA-status', 'bogus'), 0)
+        self.call.refresh_from_db()
+        self.assertEqual((self.call.call_status, self.call.call_duration), ('completed', 30))
+
+    def test_status_callback_does_not_resolve_contact(self):
+        Contact.objects.create(user=self.user, name='Later', phone_number='5551234567')
+        Call.objects.advance_status('CA-status', 'ringing')
+        self.call.refresh_from_db()
+        self.assertIsNone(self.call.contact_id)
+
+
+@override_settings(CALL_WRITE_BEHIND=False)
+class ConcurrentStatusCallbackTests(TransactionTestCase):
+    def test_shuffled_duplicate_callbacks_end_completed(self):
+        caller_cache.clear()
+        Call.objects.create(call_sid='CA-race', contact_number='+15551234567', call_status='initiated')
+        callbacks = [
+            {'CallSid': 'CA-race', 'CallStatus': status, 'CallDuration': '30' if status == 'completed' else '0'}
+            for status in ('initiated', 'ringing', 'in-progress', 'completed') * 4
+        ]
+        random.Random(11).shuffle(callbacks)
+
+        def post(data):
+            try:
+                return Client().post('/api/call/voice/status/', data).status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(post, callbacks))
+
+        self.assertEqual(set(statuses), {200})
+        call = Call.objects.get(call_sid='CA-race')
+        self.assertEqual((call.call_status, call.call_duration), ('completed', 30))
+        self.assertIsNotNone(call.call_end_time)
+
+
+class DailyCallRollupTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def buckets(self):
+        return {
+            (stat.day.isoformat(), stat.call_direction, stat.call_status): (stat.call_count, stat.total_duration)
+            for stat in DailyCallStat.objects.filter(call_count__gt=0)
+        }
+
+    def test_webhook_writes_keep_the_rollup_current(self):
+        today = timezone.now().date().isoformat()
+        for call_sid in ('CA-r1', 'CA-r2', 'CA-r1'):
+            write_calls([call_record(call_sid, '+15551234567', 'initiated', 'outgoing', user_id=self.user.id)])
+        Call.objects.advance_status('CA-r1', 'in-progress')
+        Call.objects.advance_status('CA-r1', 'completed', 40)
+        Call.objects.advance_status('CA-r1', 'ringing')
+        Call.objects.advance_status('CA-r2', 'failed')
+        Call.objects.create(contact_number='+15550000000', call_status='completed')  # no user
+
+        expected = {
+            (today, 'outgoing', 'completed'): (1, 40),
+            (today, 'outgoing', 'failed'): (1, 0),
+        }
+        self.assertEqual(self.buckets(), expected)
+        Call.objects.filter(call_sid='CA-r2').delete()
+        del expected[(today, 'outgoing', 'failed')]
+        self.assertEqual(self.buckets(), expected)
+
+        rebuild_daily_rollups()
+        self.assertEqual(self.buckets(), expected)
+
+    def test_migrate_rebuilds_only_when_triggers_were_missing(self):
+        config = django_apps.get_app_config('call')
+        day = timezone.now().date().isoformat()
+        Call.objects.create(user=self.user, contact_number='1', call_status='completed', call_duration=5)
+        unrelated = [(migrations.Migration('0099_other', 'authentication'), False)]
+        drop_call_rollup_triggers(sender=config, using='default', plan=unrelated)
+        with mock.patch('call.rollups.rebuild_daily_rollups') as rebuild_rollups, \
+                mock.patch('call.rollups.rebuild_contact_summaries') as rebuild_summaries:
+            self.assertFalse(ensure_sqlite_rollup_triggers(connection))
+        rebuild_rollups.assert_not_called()
+        rebuild_summaries.assert_not_called()
+
+        drop_call_rollup_triggers(sender=config, using='default',
+                                  plan=[(migrations.Migration('0099_other', 'call'), False)])
+        # Written while the triggers are gone; the rebuild counts it
+        Call.objects.create(user=self.user, contact_number='2', call_status='completed', call_duration=7)
+        self.assertTrue(ensure_sqlite_rollup_triggers(connection))
+        self.assertEqual(self.buckets(), {(day, '', 'completed'): (2, 12)})
+
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER call_rollup_ai')
+            cursor.execute('CREATE TRIGGER call_rollup_ai AFTER INSERT ON call_call BEGIN SELECT 1; END')
+        with mock.patch('call.rollups.rebuild_contact_summaries') as rebuild_summaries:
+            self.assertTrue(ensure_sqlite_rollup_triggers(connection))
+        rebuild_summaries.assert_not_called()
+        Call.objects.create(user=self.user, contact_number='3', call_status='completed', call_duration=1)
+        self.assertEqual(self.buckets(), {(day, '', 'completed'): (3, 13)})
+
+    def test_rebuild_uses_utc_days_like_the_triggers(self):
+        call = Call.objects.create(user=self.user, contact_number='1', call_status='completed', call_duration=5)
+        Call.objects.filter(pk=call.pk).update(created_at='2026-03-10T02:30:00Z')  # March 9th in New York
+        expected = {('2026-03-10', '', 'completed'): (1, 5)}
+        self.assertEqual(self.buckets(), expected)
+        with timezone.override('America/New_York'):
+            rebuild_daily_rollups()
+        self.assertEqual(self.buckets(), expected)
+
+    def test_rebuild_command(self):
+        call = Call.objects.create(user=self.user, contact_number='1', call_status='completed', call_duration=5)
+        DailyCallStat.objects.all().delete()
+        call_command('rebuild_call_rollups', user='alice', stdout=io.StringIO())
+        self.assertEqual(self.buckets(), {(call.created_at.date().isoformat(), '', 'completed'): (1, 5)})
+
+    def test_time_series_buckets(self):
+        for day, status, duration in (('2026-01-05', 'completed', 60), ('2026-01-06', 'completed', 30),
+                                      ('2026-01-07', 'failed', 0), ('2026-01-12', 'completed', 90)):
+            DailyCallStat.objects.create(user=self.user, day=day, call_direction='outgoing',
+                                         call_status=status, call_count=1, total_duration=duration)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/call/analytics/', {
+                'bucket': 'week', 'date_from': '2026-01-01', 'date_to': '2026-01-31',
+            })
+        self.assertEqual(response.data['series'], [
+            {'period': '2026-01-05', 'calls': 3, 'total_duration': 90, 'avg_duration': 30.0,
+             'by_status': {'completed': 2, 'failed': 1}, 'by_direction': {'outgoing': 3}},
+            {'period': '2026-01-12', 'calls': 1, 'total_duration': 90, 'avg_duration': 90.0,
+             'by_status': {'completed': 1}, 'by_direction': {'outgoing': 1}},
+        ])
+        response = self.client.get('/api/call/analytics/', {'bucket': 'month', 'date_from': '2026-01-01',
+                                                            'date_to': '2026-01-31', 'status': 'completed'})
+        self.assertEqual([(p['period'], p['calls']) for p in response.data['series']], [('2026-01-01', 3)])
+        self.assertEqual(self.client.get('/api/call/analytics/', {'bucket': 'year'}).status_code, 400)
@@ -0,0 +1,88 @@
+"""
+Twilio Voice access tokens for the dashboard's Device, cached per identity.
+
+Minting signs a JWT, and the dashboard asks for a token on every page load
+and reconnect. Tokens are minted with TWILIO_TOKEN_TTL and handed out again
+until TWILIO_TOKEN_REFRESH_MARGIN seconds before they expire. The Twilio
+credentials and grant configuration are read from settings once, when the
+cache is created.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from twilio.jwt.access_token import AccessToken
+from twilio.jwt.access_token.grants import VoiceGrant
+
+
+class VoiceTokenCache:
+    def __init__(self, account_sid, api_key, api_secret, application_sid, ttl, refresh_margin,
+                 max_size=10000, clock=time.time):
+        self.account_sid = account_sid
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.application_sid = application_sid
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.max_size = max_size
+        self.clock = clock
+        self.tokens = OrderedDict()  # identity -> (jwt, expires_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, identity):
+        """Return (jwt, expires_at) for identity, minting only when needed"""
+        now = self.clock()
+        with self.lock:
+            cached = self.tokens.get(identity)
+            if cached is not None and cached[1] - self.refresh_margin > now:
+                self.tokens.move_to_end(identity)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        token = self.mint(identity, now)
+        with self.lock:
+            self.tokens[identity] = token
+            self.tokens.move_to_end(identity)
+            while len(self.tokens) > self.max_size:
+                self.tokens.popitem(last=False)
+        return token
+
+    def mint(self, identity, now):
+        issued_at = int(now)
+        token = AccessToken(
+            self.account_sid,
+            self.api_key,
+            self.api_secret,
+            identity=identity,
+            ttl=self.ttl,
+            valid_until=issued_at + self.ttl,
+        )
+        token.add_grant(VoiceGrant(
+            outgoing_application_sid=self.application_sid,
+            incoming_allow=True
+        ))
+        return token.to_jwt(), issued_at + self.ttl
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.tokens),
+                'hits': self.hits,
+                'minted': self.misses,
+                'reuse_rate': round(self.hits / requests, 4) if requests else None,
+            }
+
+
+voice_token_cache = VoiceTokenCache(
+    account_sid=settings.TWILIO_ACCOUNT_SID,
+    api_key=settings.TWILIO_API_KEY,
+    api_secret=settings.TWILIO_API_SECRET,
+    application_sid=settings.TWIML_APP_SID,
+    ttl=settings.TWILIO_TOKEN_TTL,
+    refresh_margin=settings.TWILIO_TOKEN_REFRESH_MARGIN,
+)
@@ -6,7 +6,12 @@ urlpatterns = [
     path("voice/handler/", views.voice_handler, name="voice_handler"),
     path("voice/fallback/", views.voice_fallback, name="voice_fallback"),
     path("voice/status/", views.voice_status_callback, name="voice_status_callback"),
+    path("metrics/", views.webhook_metrics, name="webhook_metrics"),
+    path("analytics/", views.call_analytics, name="call_analytics"),
     path("history/", views.call_history, name="call_history"),
+    path("export/", views.call_export, name="call_export"),
+    path("changes/", views.call_changes, name="call_changes"),
+    path("notes/changes/", views.note_changes, name="note_changes"),
     path("detail/<int:call_id>/", views.call_detail, name="call_detail"),
     path("detail/<int:call_id>/notes/", views.add_note, name="add_note"),
 ] 
\ No newline at end of file
@@ -1,23 +1,38 @@
+import base64
+import binascii
 import random
 from django.shortcuts import render
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework import status
-from twilio.jwt.access_token import AccessToken
-from twilio.jwt.access_token.grants import VoiceGrant
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from twilio.twiml.voice_response import VoiceResponse, Dial
-from .models import Call, Note
-from .serializers import CallSerializer, CallCreateSerializer, CallHistorySerializer, NoteSerializer
+from .models import CALL_STATUS_RANK, TERMINAL_CALL_STATUS_RANK, Call, DailyCallStat, Note
+from .search import search_calls
+from .tokens import voice_token_cache
+from .write_queue import call_record, get_call_write_queue, write_calls
+from .serializers import (
+    CALL_HISTORY_VALUES, CALL_SYNC_VALUES, NOTE_SYNC_VALUES, CallSerializer, CallCreateSerializer, NoteSerializer,
+    annotate_call_history,
+)
+from .sync import SyncCursorExpired, changes_since, sync_page_size
+from contact.caller_cache import caller_cache
+from contact.exports import export_options, stream_export
+from contact.fast_serializers import FastJSONRenderer
 from contact.models import Contact
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import F, Q, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
 import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
 # Create your views here.
 
@@ -27,28 +42,16 @@ logging.info("This will always show up in Render logs")
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_token(request):
-    """Generate Twilio access token for voice calls"""
+    """Twilio access token for voice calls, reused until shortly before it expires"""
     identity = request.GET.get("identity", request.user.username)
-    
 
     try:
-        token = AccessToken(
-            os.getenv("TWILIO_ACCOUNT_SID"),
-            os.getenv("TWILIO_API_KEY"),
-            os.getenv("TWILIO_API_SECRET"),
-            identity=identity,
-        )
-        
-        voice_grant = VoiceGrant(
-            outgoing_application_sid=os.getenv("TWIML_APP_SID"),
-            incoming_allow=True
-        )
-        token.add_grant(voice_grant)
-        
-        
+        token, expires_at = voice_token_cache.get(identity)
+
         return Response({
-            "token": token.to_jwt(),
+            "token": token,
             "identity": identity,
+            "expires_at": expires_at,
             "status": "success"
         })
     except Exception as e:
@@ -58,72 +61,140 @@ def get_token(request):
         }, status=500)
 
 
+HISTORY_APPROXIMATE_TOTAL_CAP = 10000
+
+
+def encode_history_cursor(row):
+    """Encode the (created_at, id) position of a call history row as an opaque cursor"""
+    payload = json.dumps([row['created_at'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_history_cursor(cursor):
+    """Decode a cursor produced by encode_history_cursor; raises ValueError"""
+    try:
+        created_at, call_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(call_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def filter_call_history(calls, params, user):
+    """Apply the call history query parameters shared by call_history and call_export to user's calls"""
+    status_filter = params.get("status")
+    contact_id = params.get("contact_id")
+    date_from = params.get("date_from")
+    date_to = params.get("date_to")
+    search = params.get("search")
+    call_direction = params.get("call_direction") or params.get("direction")
+
+    if status_filter:
+        calls = calls.filter(call_status=status_filter)
+
+    if call_direction:
+        calls = calls.filter(call_direction=call_direction)
+
+    if contact_id:
+        calls = calls.filter(contact_id=contact_id)
+
+    if date_from:
+        try:
+            # Half-open range on the raw column so the index can serve it
+            date_from = timezone.make_aware(datetime.strptime(date_from, "%Y-%m-%d"))
+            calls = calls.filter(created_at__gte=date_from)
+        except ValueError:
+            pass
+
+    if date_to:
+        try:
+            date_to = timezone.make_aware(datetime.strptime(date_to, "%Y-%m-%d"))
+            calls = calls.filter(created_at__lt=date_to + timedelta(days=1))
+        except ValueError:
+            pass
+
+    if search:
+        calls = search_calls(calls, search, user)
+    return calls
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
+@renderer_classes([FastJSONRenderer, BrowsableAPIRenderer])
 def call_history(request):
     """Get all call history (no user filtering)"""
     try:
-        # Get query parameters for filtering
-        status_filter = request.GET.get("status")
-        contact_id = request.GET.get("contact_id")
-        date_from = request.GET.get("date_from")
-        date_to = request.GET.get("date_to")
-        search = request.GET.get("search")
-        call_direction = request.GET.get("call_direction") or request.GET.get("direction")
-        
-        # Start with all calls (no user filtering)
-        calls = Call.objects.filter(user=request.user).order_by('-created_at')
-        
-        # Apply filters
-        if status_filter:
-            calls = calls.filter(call_status=status_filter)
-
-        if call_direction:
-            calls = calls.filter(call_direction=call_direction)   
-
-        if contact_id:
-            calls = calls.filter(contact_id=contact_id)
-        
-        if date_from:
-            try:
-                date_from = datetime.strptime(date_from, "%Y-%m-%d")
-                calls = calls.filter(created_at__date__gte=date_from.date())
-            except ValueError:
-                pass
-        
-        if date_to:
-            try:
-                date_to = datetime.strptime(date_to, "%Y-%m-%d")
-                calls = calls.filter(created_at__date__lte=date_to.date())
-            except ValueError:
-                pass
-        
-        if search:
-            calls = calls.filter(
-                Q(contact__name__icontains=search) |
-                Q(contact_number__icontains=search) |
-                Q(contact__phone_number__icontains=search)
-            )
+        try:
+            fields = CALL_HISTORY_VALUES.select(request.GET.get("fields"))
+        except ValueError as e:
+            return Response({
+                "error": str(e),
+                "status": "error"
+            }, status=400)
+        calls = filter_call_history(
+            Call.objects.filter(user=request.user).order_by('-created_at'),
+            request.GET,
+            request.user,
+        )
         
         # Pagination
-        page = int(request.GET.get("page", 1))
         page_size = int(request.GET.get("page_size", 20))
-        start = (page - 1) * page_size
-        end = start + page_size
-        
-        total_calls = calls.count()
-        calls_page = calls[start:end]
-        
-        serializer = CallHistorySerializer(calls_page, many=True)
+        cursor = request.GET.get("cursor")
+        use_cursor = cursor is not None or request.GET.get("pagination") == "cursor"
+        total_mode = request.GET.get("total", "none" if use_cursor else "exact")
+
+        if total_mode == "exact":
+            total_calls = calls.count()
+        elif total_mode == "approximate":
+            # Count at most HISTORY_APPROXIMATE_TOTAL_CAP rows
+            total_calls = calls[:HISTORY_APPROXIMATE_TOTAL_CAP].count()
+        else:
+            total_calls = None
+        total_pages = (total_calls + page_size - 1) // page_size if total_calls is not None else None
+
+        if use_cursor:
+            # Keyset pagination on (created_at, id)
+            calls = calls.order_by('-created_at', '-id')
+            if cursor:
+                try:
+                    cursor_created_at, cursor_id = decode_history_cursor(cursor)
+                except ValueError:
+                    return Response({
+                        "error": "Invalid cursor",
+                        "status": "error"
+                    }, status=400)
+                calls = calls.filter(
+                    Q(created_at__lt=cursor_created_at) |
+                    Q(created_at=cursor_created_at, id__lt=cursor_id)
+                )
+            calls_page = list(CALL_HISTORY_VALUES.values(annotate_call_history(calls), fields)[:page_size + 1])
+            next_cursor = None
+            if len(calls_page) > page_size:
+                calls_page = calls_page[:page_size]
+                next_cursor = encode_history_cursor(calls_page[-1])
+            page = None
+        else:
+            page = int(request.GET.get("page", 1))
+            start = (page - 1) * page_size
+            end = start + page_size
+            calls_page = CALL_HISTORY_VALUES.values(
+                annotate_call_history(calls.order_by('-created_at', '-id')), fields
+            )[start:end]
+            next_cursor = None
         
-        return Response({
-            "calls": serializer.data,
+        # values() rows instead of CallHistorySerializer; same output, no model instances
+        response_data = {
+            "calls": CALL_HISTORY_VALUES.serialize(calls_page, fields),
             "total": total_calls,
             "page": page,
             "page_size": page_size,
-            "total_pages": (total_calls + page_size - 1) // page_size,
+            "total_pages": total_pages,
             "status": "success"
-        })
+        }
+        if use_cursor:
+            response_data["next_cursor"] = next_cursor
+        if total_mode == "approximate":
+            response_data["total_is_approximate"] = total_calls >= HISTORY_APPROXIMATE_TOTAL_CAP
+        return Response(response_data)
         
     except Exception as e:
         return Response({
@@ -131,12 +202,153 @@ def call_history(request):
             "status": "error"
         }, status=500)
 
+CALL_EXPORT_COLUMNS = (
+    'id', 'call_sid', 'created_at', 'call_direction', 'call_status', 'call_duration',
+    'call_start_time', 'call_end_time', 'contact_number', 'contact_id', 'contact_name',
+)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def call_export(request):
+    """Stream the call history as CSV or NDJSON, with the same filters as call_history"""
+    try:
+        output, compress = export_options(request.GET)
+    except ValueError as e:
+        return Response({
+            "error": str(e),
+            "status": "error"
+        }, status=400)
+
+    calls = filter_call_history(
+        Call.objects.filter(user=request.user).annotate(contact_name=F('contact__name')),
+        request.GET,
+        request.user,
+    ).order_by('-created_at', '-id')
+    return stream_export(calls, CALL_EXPORT_COLUMNS, 'calls', output, compress)
+
+
+def changes_response(request, queryset, model, values, key):
+    """A page of call.sync changes in the call API's response format"""
+    try:
+        fields = values.select(request.GET.get("fields"))
+        page_size = sync_page_size(request.GET)
+        changes = changes_since(
+            queryset, model, request.user, request.GET.get("since"), values, fields, page_size
+        )
+    except SyncCursorExpired as e:
+        return Response({
+            "error": str(e),
+            "status": "error"
+        }, status=410)
+    except ValueError as e:
+        return Response({
+            "error": str(e),
+            "status": "error"
+        }, status=400)
+    return Response({
+        key: changes["changed"],
+        "deleted": changes["deleted"],
+        "next_cursor": changes["next_cursor"],
+        "has_more": changes["has_more"],
+        "status": "success"
+    })
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@renderer_classes([FastJSONRenderer, BrowsableAPIRenderer])
+def call_changes(request):
+    """Calls changed or deleted since the ?since= cursor"""
+    return changes_response(request, Call.objects.filter(user=request.user), 'call', CALL_SYNC_VALUES, "calls")
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@renderer_classes([FastJSONRenderer, BrowsableAPIRenderer])
+def note_changes(request):
+    """Notes on the user's calls changed or deleted since the ?since= cursor"""
+    return changes_response(request, Note.objects.filter(user=request.user), 'note', NOTE_SYNC_VALUES, "notes")
+
+
+ANALYTICS_BUCKETS = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 366 * 2
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def call_analytics(request):
+    """Call counts and talk time per day, week or month, read from the daily rollups"""
+    bucket = request.GET.get("bucket", "day")
+    if bucket not in ANALYTICS_BUCKETS:
+        return Response({
+            "error": "bucket must be one of: day, week, month",
+            "status": "error"
+        }, status=400)
+
+    try:
+        date_to = datetime.strptime(request.GET["date_to"], "%Y-%m-%d").date() if request.GET.get("date_to") else timezone.now().date()
+        date_from = (
+            datetime.strptime(request.GET["date_from"], "%Y-%m-%d").date() if request.GET.get("date_from")
+            else date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+        )
+    except ValueError:
+        return Response({
+            "error": "date_from and date_to must be YYYY-MM-DD",
+            "status": "error"
+        }, status=400)
+    if date_from > date_to or (date_to - date_from).days >= ANALYTICS_MAX_DAYS:
+        return Response({
+            "error": f"date range must be ascending and at most {ANALYTICS_MAX_DAYS} days",
+            "status": "error"
+        }, status=400)
+
+    stats = DailyCallStat.objects.filter(user=request.user, day__gte=date_from, day__lte=date_to, call_count__gt=0)
+    call_direction = request.GET.get("call_direction") or request.GET.get("direction")
+    if call_direction:
+        stats = stats.filter(call_direction=call_direction)
+    if request.GET.get("status"):
+        stats = stats.filter(call_status=request.GET["status"])
+
+    rows = (
+        stats.annotate(period=ANALYTICS_BUCKETS[bucket]('day'))
+        .values('period', 'call_direction', 'call_status')
+        .annotate(calls=Sum('call_count'), duration=Sum('total_duration'))
+        .order_by('period')
+    )
+    series = {}
+    for row in rows:
+        point = series.setdefault(row['period'], {
+            "period": row['period'].isoformat(),
+            "calls": 0,
+            "total_duration": 0,
+            "by_status": {},
+            "by_direction": {},
+        })
+        point["calls"] += row['calls']
+        point["total_duration"] += row['duration']
+        point["by_status"][row['call_status']] = point["by_status"].get(row['call_status'], 0) + row['calls']
+        direction = row['call_direction'] or 'unknown'
+        point["by_direction"][direction] = point["by_direction"].get(direction, 0) + row['calls']
+    for point in series.values():
+        point["avg_duration"] = round(point["total_duration"] / point["calls"], 2)
+
+    return Response({
+        "bucket": bucket,
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "series": list(series.values()),
+        "status": "success"
+    })
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def call_detail(request, call_id):
     """Get detailed information about a specific call"""
     try:
-        call = Call.objects.get(id=call_id)
+        call = Call.objects.select_related('contact', 'user').prefetch_related('notes').get(id=call_id)
         serializer = CallSerializer(call)
         
         return Response({
@@ -190,12 +402,27 @@ def add_note(request, call_id):
 
 
 
+def enqueue_call(record):
+    # Blocking: appends to the journal, and the first use replays old journals
+    return get_call_write_queue().enqueue(record)
+
+
+def merge_queued_call(call_sid, fields):
+    # Blocking: waits for the batch write when the call is in flight
+    return get_call_write_queue().merge_pending(call_sid, fields)
+
+
+async def persist_call(record):
+    """Queue a new call for write-behind, or write it now when disabled or full"""
+    # The queue does no database work, so it needn't share the thread of the ORM calls
+    if settings.CALL_WRITE_BEHIND and await sync_to_async(enqueue_call, thread_sensitive=False)(record):
+        return
+    await sync_to_async(write_calls)([record])
+
+
 @csrf_exempt
-def voice_handler(request):
+async def voice_handler(request):
     """Unified handler for both incoming and outgoing calls."""
-    from django.contrib.auth.models import User
-    from contact.models import Contact
-
     logger = logging.getLogger("call.voice_handler")
 
     logger.info("=== Twilio Voice Handler Called ===")
@@ -211,9 +438,7 @@ def voice_handler(request):
 
     # Extract custom parameters sent from frontend
     user_id = request.POST.get("UserId")
-    if user_id:
-        user = User.objects.get(id=user_id)
-    else:
+    if not user_id:
         logger.info("No User ID provided")
 
     # Log custom parameters
@@ -221,34 +446,18 @@ def voice_handler(request):
 
     logger.info(f"Direction: {direction}, To: {to_target}, From: {from_number}, CallSid: {call_sid}, AccountSid: {account_sid}")
 
+    # Call records are persisted off the critical path (see call.write_queue);
+    # user and contact resolution happen when the record is written.
     if direction == "outbound-api":
         logger.info("Handling outbound-api (outgoing call from web client)")
-        # Try to find contact by number
-        contact = None
-        if to_target:
+        if call_sid:
             try:
-                contact = Contact.objects.filter(phone_number__icontains=to_target).first()
-                logger.info(f"Contact found for {to_target}: {contact}")
+                await persist_call(call_record(
+                    call_sid, to_target, "initiated", "outgoing", user_id=user_id
+                ))
+                logger.info(f"Call record queued for outgoing call: {call_sid}")
             except Exception as e:
-                logger.warning(f"Error finding contact: {e}")
-                contact = None
-
-        # Only create if not already exists
-        if call_sid and not Call.objects.filter(call_sid=call_sid).exists():
-            # Create call record with custom parameters
-            call_data = {
-                'contact': contact,
-                'contact_number': to_target,
-                'call_status': "initiated",
-                'call_start_time': datetime.now(),
-                'call_sid': call_sid,
-                'call_direction': "outgoing",
-            }
-            if user:
-                call_data['user'] = user
-
-            Call.objects.create(**call_data)
-            logger.info(f"Call record created for outgoing call: {call_sid}")
+                logger.warning(f"Error creating call record: {e}")
 
         if not to_target:
             logger.warning("No 'To' destination provided.")
@@ -266,33 +475,13 @@ def voice_handler(request):
         if from_number and from_number.startswith("client:"):
             logger.info("Inbound call from Twilio Client")
             
-            # Create call record for Twilio Client calls
-            # Try to find contact by number
-            contact = None
-            if to_target:
-                try:
-                    contact = Contact.objects.filter(phone_number__icontains=to_target).first()
-                    logger.info(f"Contact found for {to_target}: {contact}")
-                except Exception as e:
-                    logger.warning(f"Error finding contact: {e}")
-                    contact = None
-            
-            if call_sid and not Call.objects.filter(call_sid=call_sid).exists():
+            if call_sid:
                 try:
-                    # Create call record with custom parameters
-                    call_data = {
-                        'contact': contact,
-                        'contact_number': to_target,
-                        'call_status': "ringing",
-                        'call_start_time': datetime.now(),
-                        'call_sid': call_sid,
-                        'call_direction': "outgoing",  # This is outgoing from the client's perspective
-                    }
-                    if user:
-                        call_data['user'] = user
-
-                    Call.objects.create(**call_data)
-                    logger.info(f"Call record created for Twilio Client call: {call_sid}")
+                    # This is outgoing from the client's perspective
+                    await persist_call(call_record(
+                        call_sid, to_target, "ringing", "outgoing", user_id=user_id
+                    ))
+                    logger.info(f"Call record queued for Twilio Client call: {call_sid}")
                 except Exception as e:
                     logger.warning(f"Error creating call record: {e}")
             
@@ -302,35 +491,13 @@ def voice_handler(request):
             logger.info(f"Dialing number {to_target} from client")
         else:
             logger.info("Inbound call from real phone number")
-            # Try to find contact by phone number
-            contact = None
-            if from_number:
-                try:
-                    clean_number = from_number.replace('+', '').replace('-', '').replace('(', '').replace(')', '').replace(' ', '')
-                    contact = Contact.objects.filter(
-                        phone_number__icontains=clean_number[-10:]
-                    ).first()
-                    logger.info(f"Contact found for {from_number}: {contact}")
-                except Exception as e:
-                    logger.warning(f"Error finding contact: {e}")
-                    contact = None
-
-            if call_sid and not Call.objects.filter(call_sid=call_sid).exists():
+            if call_sid:
                 try:
-                    # Create call record with custom parameters
-                    call_data = {
-                        'contact': contact,
-                        'contact_number': from_number,
-                        'call_status': "ringing",
-                        'call_start_time': datetime.now(),
-                        'call_sid': call_sid,
-                        'call_direction': "incoming",
-                    }
-                    if user:
-                        call_data['user'] = user
-
-                    Call.objects.create(**call_data)
-                    logger.info(f"Call record created for incoming call: {call_sid}")
+                    # Caller ID is matched on the last 10 digits
+                    await persist_call(call_record(
+                        call_sid, from_number, "ringing", "incoming", user_id=user_id, match="caller"
+                    ))
+                    logger.info(f"Call record queued for incoming call: {call_sid}")
                 except Exception as e:
                     logger.warning(f"Error creating call record: {e}")
 
@@ -350,7 +517,7 @@ def voice_handler(request):
 
 
 @csrf_exempt
-def voice_status_callback(request):
+async def voice_status_callback(request):
     """Handle call status updates from Twilio (same as previous logic)."""
     try:
         call_sid = request.POST.get("CallSid")
@@ -358,24 +525,39 @@ def voice_status_callback(request):
         call_duration = request.POST.get("CallDuration", 0)
         from_number = request.POST.get("From")
         to_number = request.POST.get("To")
+        duration = int(call_duration) if call_duration else None
+        if call_sid and settings.CALL_WRITE_BEHIND:
+            # The call may still be waiting in the write-behind queue
+            queued_fields = {'call_status': call_status}
+            if duration:
+                queued_fields['call_duration'] = duration
+            if CALL_STATUS_RANK.get(call_status) == TERMINAL_CALL_STATUS_RANK:
+                queued_fields['call_end_time'] = timezone.now().isoformat()
+            if await sync_to_async(merge_queued_call, thread_sensitive=False)(call_sid, queued_fields):
+                return HttpResponse("", status=200)
         if call_sid:
-            try:
-                call = Call.objects.get(call_sid=call_sid)
-                call.call_status = call_status or call.call_status
-                call.call_duration = int(call_duration) if call_duration else call.call_duration
-                if call_status == "completed":
-                    from datetime import datetime
-                    call.call_end_time = datetime.now()
-                call.save()
-            except Call.DoesNotExist:
-                pass
+            # With write-behind the call may not be written yet, e.g. queued in another worker;
+            # without it the insert committed before Twilio got the TwiML
+            apply_status = Call.objects.record_status if settings.CALL_WRITE_BEHIND else Call.objects.advance_status
+            await sync_to_async(apply_status)(call_sid, call_status, duration)
         return HttpResponse("", status=200)
     except Exception as e:
         return HttpResponse("", status=500)
 
 
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def webhook_metrics(request):
+    """In-process counters for the voice caches (staff only)"""
+    return Response({
+        "caller_cache": caller_cache.stats(),
+        "access_tokens": voice_token_cache.stats(),
+        "status": "success"
+    })
+
+
 @csrf_exempt
-def voice_fallback(request):
+async def voice_fallback(request):
     """Fallback handler for TwiML App."""
     response = VoiceResponse()
     response.say("Sorry, we are unable to process your call at the moment. Please try again later.")
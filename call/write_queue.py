@@ -0,0 +1,360 @@
+"""
+Write-behind persistence for Call rows created by the Twilio voice webhooks.
+
+voice_handler hands each new call to an in-process bounded queue and returns
+TwiML straight away; a background thread resolves users and contacts and
+inserts the rows with one bulk_create per batch. Every queued record is also
+kept in a per-process JSON-lines journal, so records survive a crash: the
+next process to start replays journals left behind by dead processes.
+Replays are safe because call_sid is unique and inserts ignore conflicts.
+Journal appends are fsynced, and compaction writes a new file and renames
+it over the old one, so a crash never loses a record still queued.
+
+When a batch fails, its records are retried one at a time. A record that
+fails on its own for any reason other than a lost connection can never be
+written (e.g. an over-long call_sid, or a bad timestamp in a replayed
+journal). It is moved to the dead-letter journal, dead-calls.jsonl, so it
+doesn't hold up the calls queued behind it.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import InterfaceError, OperationalError, close_old_connections
+from django.db.models import Subquery
+from django.utils import timezone
+
+from contact.caller_cache import caller_cache
+from contact.models import Contact, normalize_phone_number
+from .models import Call, call_status_advances
+
+logger = logging.getLogger("call.write_queue")
+
+DATETIME_FIELDS = ('call_start_time', 'call_end_time')
+DEAD_LETTER_JOURNAL = 'dead-calls.jsonl'
+# The database is unreachable; everything else a single record raises is permanent
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def call_record(call_sid, contact_number, call_status, call_direction, user_id=None, match='number'):
+    """Build a queue record for a new call.
+
+    match selects how the contact is resolved: 'number' for an exact
+    canonical match, 'caller' for inbound caller ID suffix matching.
+    """
+    try:
+        user_id = int(user_id) if user_id else None
+    except (TypeError, ValueError):
+        user_id = None
+    return {
+        'call_sid': call_sid,
+        'contact_number': contact_number,
+        'call_status': call_status,
+        'call_direction': call_direction,
+        'call_start_time': timezone.now().isoformat(),
+        'user_id': user_id,
+        'match': match,
+    }
+
+
+def contact_for(record):
+    """The cached contact as a subquery, so a contact deleted since it was cached inserts NULL"""
+    resolve = caller_cache.resolve_caller if record['match'] == 'caller' else caller_cache.resolve_number
+    match = resolve(record['contact_number'], user=record['user_id'])
+    if match is None:
+        return None
+    # The cache is per process; another worker may have deleted the contact
+    contacts = Contact.objects.filter(id=match.id)
+    if record['user_id']:
+        contacts = contacts.filter(user_id=record['user_id'])
+    return Subquery(contacts.values('id'))
+
+
+def write_calls(records):
+    """Insert call records in one INSERT ... ON CONFLICT DO NOTHING on call_sid.
+
+    Contacts come from the caller cache, so a redelivered webhook or a repeat
+    caller costs that single statement and never adds a row.
+    User and contact ids are checked inside the statement, so an unknown
+    UserId or a contact deleted behind the cache stores NULL instead of
+    failing the foreign key and with it the batch.
+    """
+    calls = []
+    for record in records:
+        fields = {
+            field: datetime.fromisoformat(record[field]) if record.get(field) else None
+            for field in DATETIME_FIELDS
+        }
+        user_id = record['user_id']
+        calls.append(Call(
+            call_sid=record['call_sid'],
+            contact_number=record['contact_number'],
+            normalized_number=normalize_phone_number(record['contact_number']),
+            contact_id=contact_for(record),
+            user_id=Subquery(User.objects.filter(id=user_id).values('id')) if user_id else None,
+            call_status=record['call_status'],
+            call_direction=record['call_direction'],
+            call_duration=record.get('call_duration') or 0,
+            **fields,
+        ))
+    Call.objects.bulk_create(calls, ignore_conflicts=True)
+
+
+def write_queued_calls(records):
+    """write_calls, then apply the status callbacks that arrived first (see CallQuerySet.record_status)"""
+    write_calls(records)
+    Call.objects.apply_pending_statuses([record['call_sid'] for record in records])
+
+
+class CallWriteQueue:
+    def __init__(self, max_size, batch_size, flush_interval, journal_dir=None, autostart=True):
+        self.max_size = max_size
+        self.autostart = autostart
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_dir = Path(journal_dir) if journal_dir else None
+        self.journal_path = None
+        self.pending = OrderedDict()  # call_sid -> record
+        self.in_flight = set()
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.worker = None
+        self.stopping = False
+        if self.journal_dir:
+            self.journal_dir.mkdir(parents=True, exist_ok=True)
+            self.journal_path = self.journal_dir / f'calls-{os.getpid()}.jsonl'
+            self.replay_orphaned_journals()
+
+    def enqueue(self, record):
+        """Queue a call insert; returns False when the queue is full"""
+        with self.lock:
+            if record['call_sid'] in self.pending:
+                return True  # duplicate webhook, already queued
+            if len(self.pending) >= self.max_size:
+                return False
+            self.pending[record['call_sid']] = record
+            self.journal_append(record)
+            self.lock.notify()
+        if self.autostart:
+            self.ensure_worker()
+        return True
+
+    def merge_pending(self, call_sid, fields):
+        """Apply fields to a call that is still queued; returns False if it is not.
+
+        A call whose batch is being written is waited for, so afterwards the
+        caller can update the row in the database.
+        """
+        with self.lock:
+            record = self.pending.get(call_sid)
+            if record is not None and call_sid not in self.in_flight:
+                if not call_status_advances(record['call_status'], fields.get('call_status')):
+                    return True  # late or duplicate callback
+                record.update(fields)
+                self.journal_append(record)
+                return True
+            in_flight = call_sid in self.in_flight
+        if in_flight:
+            with self.flush_lock:
+                pass
+        return False
+
+    def flush(self):
+        """Write everything queued so far in the calling thread"""
+        while self.write_next_batch():
+            pass
+
+    def shutdown(self, timeout=10):
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        if self.worker is not None:
+            self.worker.join(timeout)
+        self.flush()
+
+    def write_next_batch(self):
+        """Write the oldest batch; returns whether any record left the queue"""
+        with self.flush_lock:
+            with self.lock:
+                call_sids = list(self.pending)[:self.batch_size]
+                if not call_sids:
+                    return False
+                self.in_flight.update(call_sids)
+                records = [dict(self.pending[call_sid]) for call_sid in call_sids]
+            try:
+                write_queued_calls(records)
+                done = call_sids
+            except Exception:
+                logger.exception("Failed to write %d queued calls; retrying them one at a time", len(records))
+                done = self.write_one_by_one(records)
+            with self.lock:
+                for call_sid in done:
+                    del self.pending[call_sid]
+                self.in_flight.difference_update(call_sids)
+                if done:
+                    self.journal_rewrite()
+            return bool(done)
+
+    def write_one_by_one(self, records):
+        """Write records singly after a failed batch; returns the call_sids that left the queue"""
+        done = []
+        for record in records:
+            try:
+                write_queued_calls([record])
+            except TRANSIENT_ERRORS:
+                logger.exception("Database unavailable; %d queued calls will be retried", len(records) - len(done))
+                break
+            except Exception as e:
+                logger.exception("Moving queued call %s to the dead-letter journal", record.get('call_sid'))
+                self.dead_letter(record, e)
+            done.append(record['call_sid'])
+        return done
+
+    def ensure_worker(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='call-write-queue', daemon=True)
+                self.worker.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.stopping:
+                    self.lock.wait(self.flush_interval)
+                if self.stopping:
+                    return
+                has_pending = bool(self.pending)
+            if not has_pending:
+                continue
+            # The worker thread keeps its own connection; drop it if it went stale
+            close_old_connections()
+            if not self.write_next_batch():
+                # Database error: back off before retrying
+                with self.lock:
+                    self.lock.wait(self.flush_interval)
+
+    # Journal
+
+    def journal_append(self, record):
+        if self.journal_path is None:
+            return
+        append_json_lines(self.journal_path, [record])
+
+    def journal_rewrite(self):
+        """Compact the journal down to the records still pending"""
+        if self.journal_path is None:
+            return
+        if not self.pending:
+            self.journal_path.unlink(missing_ok=True)
+            return
+        replace_json_lines(self.journal_path, self.pending.values())
+
+    def dead_letter(self, record, error):
+        entry = {'failed_at': timezone.now().isoformat(), 'error': repr(error), 'record': record}
+        if self.journal_dir is None:
+            logger.error("Dropped queued call: %s", json.dumps(entry))
+            return
+        append_json_lines(self.journal_dir / DEAD_LETTER_JOURNAL, [entry])
+
+    def replay_orphaned_journals(self):
+        for path in self.journal_dir.glob('calls-*.jsonl'):
+            try:
+                pid = int(path.stem.split('-', 1)[1])
+            except ValueError:
+                continue
+            if pid != os.getpid() and process_is_alive(pid):
+                continue
+            # An unfinished compaction; the journal itself is still whole
+            path.with_name(f'{path.name}.tmp').unlink(missing_ok=True)
+            claimed = path.with_name(f'{path.name}.claimed-{os.getpid()}')
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # another process claimed it first
+            replayed = OrderedDict()
+            with open(claimed) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                        replayed[record['call_sid']] = record
+                    except (ValueError, KeyError, TypeError):
+                        continue  # torn final line, or not a call record
+            with self.lock:
+                for call_sid, record in replayed.items():
+                    self.pending.setdefault(call_sid, record)
+                self.journal_rewrite()
+            claimed.unlink()
+            logger.info("Replayed %d queued calls from %s", len(replayed), path.name)
+
+
+def append_json_lines(path, items):
+    """Append items to a JSON-lines file and fsync it"""
+    with open(path, 'a') as journal:
+        journal.write(''.join(json.dumps(item) + '\n' for item in items))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def replace_json_lines(path, items):
+    """Replace a JSON-lines file atomically: write a temp file, fsync it, rename it over path"""
+    temp = path.with_name(f'{path.name}.tmp')
+    with open(temp, 'w') as journal:
+        journal.write(''.join(json.dumps(item) + '\n' for item in items))
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(temp, path)
+    fsync_directory(path.parent)
+
+
+def fsync_directory(path):
+    """Make a rename in the directory durable; a no-op where directories can't be opened"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+call_write_queue = None
+call_write_queue_lock = threading.Lock()
+
+
+def get_call_write_queue():
+    global call_write_queue
+    if call_write_queue is None:
+        with call_write_queue_lock:
+            if call_write_queue is None:
+                call_write_queue = CallWriteQueue(
+                    max_size=settings.CALL_WRITE_QUEUE_MAX_SIZE,
+                    batch_size=settings.CALL_WRITE_QUEUE_BATCH_SIZE,
+                    flush_interval=settings.CALL_WRITE_QUEUE_FLUSH_INTERVAL,
+                    journal_dir=settings.CALL_WRITE_QUEUE_JOURNAL_DIR,
+                )
+                atexit.register(call_write_queue.shutdown)
+                if call_write_queue.pending:
+                    call_write_queue.ensure_worker()
+    return call_write_queue
@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate, post_save
+
+
+def ensure_contact_search_index(sender, using, **kwargs):
+    from django.db import connections
+    from .search import CONTACT_SEARCH_FIELDS, CONTACT_TABLE, ensure_sqlite_search_index
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        ensure_sqlite_search_index(connection, CONTACT_TABLE, CONTACT_SEARCH_FIELDS)
 
 
 class ContactConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "contact"
+
+    def ready(self):
+        from .caller_cache import invalidate_cached_contact
+        from .models import Contact
+
+        post_migrate.connect(ensure_contact_search_index, sender=self)
+        post_save.connect(invalidate_cached_contact, sender=Contact)
+        post_delete.connect(invalidate_cached_contact, sender=Contact)
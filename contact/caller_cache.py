@@ -0,0 +1,154 @@
+"""
+In-process cache of phone number -> contact resolutions for the voice webhooks.
+
+Entries map (kind, owning user, canonical number) to the resolved contact's
+id and name, or to None for numbers with no contact. Positive entries live
+for CALLER_CACHE_TTL seconds and negative ones for CALLER_CACHE_NEGATIVE_TTL;
+the least recently used entry is evicted when the cache is full.
+
+Contact post_save/post_delete signals (connected in ContactConfig.ready)
+evict exactly the entries a contact can affect: those pointing at it, and
+those whose number it could now match. Changes that skip signals, such as
+QuerySet.update() or bulk_create(), and changes made in other processes are
+only picked up when entries expire, unless invalidate_contacts() is called.
+A negative entry made ambiguous by a contact's previous number is likewise
+left to its (short) negative TTL.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .models import CALLER_SUFFIX_DIGITS, Contact, normalize_phone_number
+
+CachedContact = namedtuple('CachedContact', ['id', 'name'])
+
+NUMBER = 'number'  # exact canonical match, as Contact.objects.matching_number()
+CALLER = 'caller'  # inbound caller ID, as Contact.objects.resolve_caller()
+
+
+class CallerCache:
+    def __init__(self, max_size, ttl, negative_ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (CachedContact or None, expires_at)
+        self.keys_by_suffix = {}      # last digits of the number -> keys
+        self.keys_by_contact = {}     # contact id -> keys
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # bumped by every invalidation
+
+    def resolve_number(self, phone_number, user=None):
+        """Cached Contact.objects.matching_number(...).first()"""
+        return self.resolve(NUMBER, phone_number, user, lambda normalized, user_id: (
+            Contact.objects.matching_number(normalized, user=user_id).order_by('id').first()
+        ))
+
+    def resolve_caller(self, phone_number, user=None):
+        """Cached Contact.objects.resolve_caller()"""
+        return self.resolve(CALLER, phone_number, user, lambda normalized, user_id: (
+            Contact.objects.resolve_caller(normalized, user=user_id)
+        ))
+
+    def resolve(self, kind, phone_number, user, load):
+        normalized = normalize_phone_number(phone_number)
+        if not normalized:
+            return None
+        user_id = getattr(user, 'pk', user)
+        key = (kind, user_id, normalized)
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        contact = load(normalized, user_id)
+        value = CachedContact(contact.id, contact.name) if contact else None
+        with self.lock:
+            # Skip storing a result that a concurrent invalidation may have outdated
+            if generation == self.generation:
+                self.store(key, value, now + (self.ttl if value else self.negative_ttl))
+        return value
+
+    def store(self, key, value, expires_at):
+        self.discard(key)
+        self.entries[key] = (value, expires_at)
+        self.keys_by_suffix.setdefault(key[2][-CALLER_SUFFIX_DIGITS:], set()).add(key)
+        if value is not None:
+            self.keys_by_contact.setdefault(value.id, set()).add(key)
+        while len(self.entries) > self.max_size:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        suffix = key[2][-CALLER_SUFFIX_DIGITS:]
+        self.keys_by_suffix[suffix].discard(key)
+        if not self.keys_by_suffix[suffix]:
+            del self.keys_by_suffix[suffix]
+        if entry[0] is not None:
+            self.keys_by_contact[entry[0].id].discard(key)
+            if not self.keys_by_contact[entry[0].id]:
+                del self.keys_by_contact[entry[0].id]
+
+    def invalidate_contacts(self, contacts):
+        """Evict every entry that the given contacts resolve to or could match"""
+        with self.lock:
+            stale = set()
+            for contact in contacts:
+                stale |= self.keys_by_contact.get(contact.id, set())
+                # Lookups match a contact when its number ends with the lookup's
+                # last digits, so check every suffix of the contact's number
+                normalized = normalize_phone_number(contact.phone_number)
+                for length in range(1, min(len(normalized), CALLER_SUFFIX_DIGITS) + 1):
+                    stale |= {
+                        key for key in self.keys_by_suffix.get(normalized[-length:], ())
+                        if key[1] is None or key[1] == contact.user_id
+                    }
+            for key in stale:
+                self.discard(key)
+            self.invalidations += len(stale)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.keys_by_suffix.clear()
+            self.keys_by_contact.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+caller_cache = CallerCache(
+    max_size=settings.CALLER_CACHE_MAX_SIZE,
+    ttl=settings.CALLER_CACHE_TTL,
+    negative_ttl=settings.CALLER_CACHE_NEGATIVE_TTL,
+)
+
+
+def invalidate_cached_contact(sender, instance, **kwargs):
+    caller_cache.invalidate_contacts([instance])
@@ -0,0 +1,91 @@
+"""
+values()-based, read-only serialization for list endpoints.
+
+A ValuesSerializer mirrors a ModelSerializer's output field for field.
+Each output field names the columns it needs and a function that builds
+its value from a values() row, so a page is fetched as plain dicts and
+no model instances or serializer fields are created per row. Datetimes are
+formatted by DRF's own DateTimeField, so responses are byte-identical to
+the ModelSerializer they replace.
+
+?fields=a,b selects a subset of the output fields (sparse fieldsets); only
+the columns those fields need are selected.
+
+FastJSONRenderer uses orjson when it is installed and produces the same
+bytes as DRF's compact JSONRenderer for these payloads (strings, integers,
+booleans, None, lists and dicts). It is only used by the endpoints built on
+ValuesSerializer; orjson writes some floats differently from json.dumps.
+"""
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # optional; DRF's json.dumps is used instead
+    orjson = None
+else:
+    ORJSON_OPTIONS = (
+        orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+DATETIME_FIELD = serializers.DateTimeField()
+
+
+def format_datetime(value):
+    """A datetime as DateTimeField renders it in a ModelSerializer"""
+    return None if value is None else DATETIME_FIELD.to_representation(value)
+
+
+def column(name):
+    """A field read straight from one column"""
+    return (name,), lambda row: row[name]
+
+
+def datetime_column(name):
+    return (name,), lambda row: format_datetime(row[name])
+
+
+class ValuesSerializer:
+    def __init__(self, fields, required_columns=()):
+        # fields: {output field: (columns, build(row))}, in output order
+        self.fields = fields
+        self.required_columns = tuple(required_columns)
+
+    def select(self, fields_param):
+        """Output fields for a ?fields= value (None for all); raises ValueError on unknown names"""
+        if not fields_param:
+            return list(self.fields)
+        requested = {name.strip() for name in fields_param.split(',') if name.strip()}
+        unknown = requested - set(self.fields)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Available: {', '.join(self.fields)}")
+        return [name for name in self.fields if name in requested]
+
+    def columns(self, fields):
+        columns = dict.fromkeys(self.required_columns)
+        for name in fields:
+            columns.update(dict.fromkeys(self.fields[name][0]))
+        return list(columns)
+
+    def values(self, queryset, fields):
+        return queryset.values(*self.columns(fields))
+
+    def serialize(self, rows, fields):
+        builders = [(name, self.fields[name][1]) for name in fields]
+        return [{name: build(row) for name, build in builders} for row in rows]
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer that encodes with orjson when available; same bytes as the default"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # Datetimes and subclasses go through DRF's encoder, as they would in json.dumps
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. non-string keys or integers beyond 64 bits
+            return super().render(data, accepted_media_type, renderer_context)
+        # Like JSONRenderer, escape the separators that are invalid in JavaScript strings
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
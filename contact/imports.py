@@ -0,0 +1,291 @@
+"""
+Bulk contact import from CSV, vCard or JSON, and keyed contact upserts.
+
+Rows are validated, normalized and deduplicated in memory: against each
+other, and against the user's existing contacts with one batched lookup
+per CONTACT_IMPORT_BATCH_SIZE rows. The survivors are inserted with
+bulk_create in batches. Afterwards a single UPDATE links every unlinked call
+of the user whose number matches a contact. Per-row problems are reported
+instead of failing the whole import.
+
+upsert_contacts() is the CRM sync path: rows are written with
+ContactQuerySet.upsert() (INSERT ... ON CONFLICT on the user's canonical
+number), so existing contacts are updated instead of reported.
+"""
+import csv
+import io
+import json
+import re
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from call.models import Call
+from .caller_cache import caller_cache
+from .models import Contact, normalize_phone_number
+
+IMPORT_INPUTS = ('csv', 'vcard', 'json')
+INPUT_EXTENSIONS = {'.csv': 'csv', '.vcf': 'vcard', '.vcard': 'vcard', '.json': 'json'}
+
+# CSV header aliases, after lowercasing and replacing spaces with underscores
+CSV_COLUMNS = {
+    'name': 'name',
+    'full_name': 'name',
+    'phone_number': 'phone_number',
+    'phone': 'phone_number',
+    'mobile': 'phone_number',
+    'email': 'email',
+    'email_address': 'email',
+}
+MIN_PHONE_DIGITS = 10
+NAME_MAX_LENGTH = Contact._meta.get_field('name').max_length
+
+
+class ContactImportError(ValueError):
+    """The upload as a whole cannot be imported"""
+
+
+def detect_input(filename, text):
+    for extension, kind in INPUT_EXTENSIONS.items():
+        if filename and filename.lower().endswith(extension):
+            return kind
+    head = text.lstrip()[:20].upper()
+    if head.startswith('BEGIN:VCARD'):
+        return 'vcard'
+    if head.startswith(('[', '{')):
+        return 'json'
+    return 'csv'
+
+
+def parse_csv(text):
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames:
+        return []
+    columns = [CSV_COLUMNS.get(name.strip().lower().replace(' ', '_')) for name in reader.fieldnames]
+    if 'phone_number' not in columns:
+        raise ContactImportError("CSV needs a phone_number (or phone) column")
+    return [{column: value for column, value in zip(columns, row.values()) if column} for row in reader]
+
+
+def unescape_vcard(value):
+    return re.sub(r'\\([\\,;nN])', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def parse_vcard(text):
+    # Folded lines continue with a leading space or tab
+    lines = re.sub(r'\r?\n[ \t]', '', text).splitlines()
+    rows, card = [], None
+    for line in lines:
+        key, _, value = line.partition(':')
+        prop = key.split(';', 1)[0].rsplit('.', 1)[-1].upper()  # drop parameters and item groups
+        if prop == 'BEGIN' and value.strip().upper() == 'VCARD':
+            card = {}
+        elif prop == 'END' and card is not None:
+            rows.append(card)
+            card = None
+        elif card is None:
+            continue
+        elif prop == 'FN':
+            card['name'] = unescape_vcard(value)
+        elif prop == 'N' and 'name' not in card:
+            family, given = (value.split(';') + [''])[:2]
+            card['name'] = f'{unescape_vcard(given)} {unescape_vcard(family)}'.strip()
+        elif prop == 'TEL':
+            card.setdefault('phone_number', value.removeprefix('tel:'))
+        elif prop == 'EMAIL':
+            card.setdefault('email', value)
+    return rows
+
+
+def parse_json(data):
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            raise ContactImportError("Invalid JSON") from None
+    if isinstance(data, dict):
+        data = data.get('contacts')
+    if not isinstance(data, list):
+        raise ContactImportError("JSON must be an array of contacts or {\"contacts\": [...]}")
+    return data
+
+
+def parse_upload(upload, kind=None):
+    """Rows from an uploaded file; kind is detected from the name or content when omitted"""
+    try:
+        text = upload.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ContactImportError("File must be UTF-8") from None
+    kind = kind or detect_input(getattr(upload, 'name', ''), text)
+    if kind == 'csv':
+        return parse_csv(text)
+    if kind == 'vcard':
+        return parse_vcard(text)
+    return parse_json(text)
+
+
+def clean_row(row):
+    """(name, phone_number, normalized, email) for a raw row; raises ValidationError with field errors"""
+    if not isinstance(row, dict):
+        raise ValidationError({'row': 'Expected an object with name, phone_number and email'})
+    errors = {}
+    name = str(row.get('name') or '').strip()
+    if not name:
+        errors['name'] = 'This field is required.'
+    elif len(name) > NAME_MAX_LENGTH:
+        errors['name'] = f'Ensure this field has no more than {NAME_MAX_LENGTH} characters.'
+    # Same cleaning as ContactSerializer.validate_phone_number
+    phone_number = ''.join(c for c in str(row.get('phone_number') or '') if c.isdigit() or c == '+')
+    normalized = normalize_phone_number(phone_number)
+    if len(normalized) < MIN_PHONE_DIGITS:
+        errors['phone_number'] = f'Phone number must contain at least {MIN_PHONE_DIGITS} digits'
+    email = str(row.get('email') or '').strip() or None
+    if email:
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors['email'] = 'Enter a valid email address.'
+    if errors:
+        raise ValidationError(errors)
+    return name, phone_number, normalized, email
+
+
+def existing_values(user, field, values, batch_size):
+    found = set()
+    values = list(values)
+    for start in range(0, len(values), batch_size):
+        found.update(Contact.objects.filter(
+            user=user, **{f'{field}__in': values[start:start + batch_size]}
+        ).values_list(field, flat=True))
+    return found
+
+
+def clean_rows(rows):
+    """Validate rows and drop repeats within them.
+
+    Returns ([(row number, name, phone_number, normalized, email)], errors).
+    """
+    errors = []
+    candidates = []
+    first_row_by_phone, first_row_by_email = {}, {}
+    for number, row in enumerate(rows, 1):
+        try:
+            name, phone_number, normalized, email = clean_row(row)
+        except ValidationError as e:
+            errors.append({'row': number, 'errors': {field: messages[0] for field, messages in e.message_dict.items()}})
+            continue
+        duplicate_of = first_row_by_phone.get(normalized) or (email and first_row_by_email.get(email))
+        if duplicate_of:
+            errors.append({'row': number, 'errors': {'row': f'Duplicate of row {duplicate_of}'}})
+            continue
+        first_row_by_phone[normalized] = number
+        if email:
+            first_row_by_email[email] = number
+        candidates.append((number, name, phone_number, normalized, email))
+    return candidates, errors
+
+
+def new_contacts(user, candidates, batch_size, errors):
+    """Contacts for the candidates whose number and email the user has no contact with yet.
+
+    Rows that clash with an existing contact are added to errors.
+    """
+    existing_phones = existing_values(user, 'normalized_phone', {row[3] for row in candidates}, batch_size)
+    existing_emails = existing_values(user, 'email', {row[4] for row in candidates if row[4]}, batch_size)
+    contacts = []
+    for number, name, phone_number, normalized, email in candidates:
+        if normalized in existing_phones:
+            errors.append({'row': number, 'errors': {'phone_number': 'A contact with this phone number already exists'}})
+        elif email in existing_emails:
+            errors.append({'row': number, 'errors': {'email': 'A contact with this email already exists'}})
+        else:
+            # bulk_create skips Contact.save(), so fill the derived columns here
+            contacts.append((number, Contact(
+                user=user, name=name, phone_number=phone_number, email=email,
+                normalized_phone=normalized, reversed_phone=normalized[::-1],
+            )))
+    return contacts
+
+
+def import_contacts(user, rows):
+    """Create contacts for valid, new rows and link matching calls; returns a report dict"""
+    started = time.perf_counter()
+    batch_size = settings.CONTACT_IMPORT_BATCH_SIZE
+    candidates, errors = clean_rows(rows)
+
+    contacts = new_contacts(user, candidates, batch_size, errors)
+    try:
+        with transaction.atomic():
+            created = Contact.objects.bulk_create([contact for _, contact in contacts], batch_size=batch_size)
+            linked_calls = Call.objects.link_to_user_contacts(user) if created else 0
+    except IntegrityError:
+        # A concurrent create or import took some of the numbers or emails:
+        # check again, then insert row by row so only the clashing rows fail
+        pending = {number for number, _ in contacts}
+        created = []
+        with transaction.atomic():
+            retry = [row for row in candidates if row[0] in pending]
+            for number, contact in new_contacts(user, retry, batch_size, errors):
+                try:
+                    with transaction.atomic():
+                        created += Contact.objects.bulk_create([contact])
+                except IntegrityError:
+                    errors.append({'row': number, 'errors': {'row': 'A contact with this phone number or email already exists'}})
+            linked_calls = Call.objects.link_to_user_contacts(user) if created else 0
+    # bulk_create sends no post_save, so evict cached caller lookups explicitly
+    caller_cache.invalidate_contacts(created)
+
+    elapsed = time.perf_counter() - started
+    errors.sort(key=lambda error: error['row'])
+    return {
+        'received': len(rows),
+        'created': len(created),
+        'failed': len(errors),
+        'linked_calls': linked_calls,
+        'errors': errors,
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'rows_per_second': round(len(rows) / elapsed) if elapsed else None,
+    }
+
+
+def upsert_contacts(user, rows):
+    """Create or update contacts by canonical number; returns a report dict"""
+    candidates, errors = clean_rows(rows)
+    results = {}
+    try:
+        with transaction.atomic():
+            results = Contact.objects.upsert(user, [(name, phone, email) for _, name, phone, _, email in candidates])
+    except IntegrityError:
+        # An email belongs to another contact: retry row by row to find which
+        for number, name, phone_number, normalized, email in candidates:
+            try:
+                with transaction.atomic():
+                    results.update(Contact.objects.upsert(user, [(name, phone_number, email)]))
+            except IntegrityError:
+                errors.append({'row': number, 'errors': {'email': 'A contact with this email already exists'}})
+
+    contacts = []
+    written = []
+    for number, name, phone_number, normalized, email in candidates:
+        if normalized in results:
+            contact_id, created = results[normalized]
+            contacts.append({'row': number, 'id': contact_id, 'created': created})
+            written.append(Contact(id=contact_id, user_id=user.pk, phone_number=phone_number))
+    created = sum(contact['created'] for contact in contacts)
+    linked_calls = Call.objects.link_to_user_contacts(user) if created else 0
+    # Raw SQL sends no post_save; names and numbers may have changed
+    caller_cache.invalidate_contacts(written)
+
+    errors.sort(key=lambda error: error['row'])
+    return {
+        'received': len(rows),
+        'created': created,
+        'updated': len(contacts) - created,
+        'failed': len(errors),
+        'linked_calls': linked_calls,
+        'contacts': contacts,
+        'errors': errors,
+    }
@@ -0,0 +1,62 @@
+import json
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from contact.merge import merge_duplicates
+
+
+class Command(BaseCommand):
+    help = (
+        "Find contacts that are the same person (same number up to a missing "
+        "country code, or same email up to case) and merge each group into its "
+        "oldest contact, moving the calls. Runs over users in id order; with "
+        "--checkpoint, progress is saved after every batch and an interrupted "
+        "run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only this username')
+        parser.add_argument('--users-per-batch', type=int, default=500, help='Users scanned and merged per batch')
+        parser.add_argument('--checkpoint', help='JSON file recording the last finished user, for resuming')
+        parser.add_argument('--dry-run', action='store_true', help='Report duplicate groups without merging')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['user']!r} not found")
+
+        checkpoint = options['checkpoint']
+        after_user_id = 0
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                after_user_id = json.load(f)['last_user_id']
+            self.stdout.write(f"Resuming after user {after_user_id}")
+
+        totals = {'clusters': 0, 'conflicts': 0, 'contacts_removed': 0, 'calls_moved': 0}
+        for progress in merge_duplicates(after_user_id, options['users_per_batch'], user, options['dry_run']):
+            totals['clusters'] += len(progress['clusters'])
+            totals['conflicts'] += len(progress['conflicts'])
+            totals['contacts_removed'] += progress['contacts_removed']
+            totals['calls_moved'] += progress['calls_moved']
+            for cluster in progress['conflicts']:
+                self.stdout.write(f"Needs review (conflicting numbers): contacts {cluster}")
+            if checkpoint and not options['dry_run']:
+                # Write then rename, so a crash never leaves a torn checkpoint
+                with open(f'{checkpoint}.tmp', 'w') as f:
+                    json.dump({'last_user_id': progress['last_user_id']}, f)
+                os.replace(f'{checkpoint}.tmp', checkpoint)
+            self.stdout.write(
+                f"Users up to {progress['last_user_id']}: {len(progress['clusters'])} groups, "
+                f"{progress['contacts_removed']} contacts merged, {progress['calls_moved']} calls moved"
+            )
+
+        verb = 'Found' if options['dry_run'] else 'Merged'
+        self.stdout.write(
+            f"{verb} {totals['clusters']} duplicate groups ({totals['contacts_removed']} contacts removed, "
+            f"{totals['calls_moved']} calls moved); {totals['conflicts']} groups need review"
+        )
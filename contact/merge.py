@@ -0,0 +1,167 @@
+"""
+Duplicate contact detection and merging.
+
+Duplicates are found by grouping, never by comparing contacts pairwise.
+Each contact gets two keys: the last CALLER_SUFFIX_DIGITS digits of its
+canonical number (the prefix of reversed_phone) and its lowercased email.
+SQL GROUP BY finds the keys shared by several of a user's contacts. Only
+the members of those groups are loaded, and a union-find joins groups that
+share a contact into clusters. A cluster is only merged automatically when
+every number in it is a suffix of the longest one, e.g. the same number
+saved with and without its country code. Clusters such as
++44 20 7946 0000 / +1 207 946 0000 (same suffix, different numbers), or
+one email on two different numbers, are reported as conflicts for review,
+just as resolve_caller() treats such numbers as ambiguous.
+
+A cluster is merged into its oldest contact. Calls are moved with one
+CASE-mapped UPDATE per MERGE_BATCH_SIZE duplicates, the duplicates are
+deleted, and a survivor without an email takes one from its duplicates.
+The call triggers move the call summaries along with the calls. Users are
+processed in id order, in batches, so memory is bounded by one batch's
+duplicate groups and a run can resume after the last finished user.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, Value, When
+from django.db.models.functions import Lower, Substr
+from django.utils import timezone
+
+from call.models import Call
+from .caller_cache import caller_cache
+from .models import CALLER_SUFFIX_DIGITS, Contact
+
+PHONE = 'phone'
+EMAIL = 'email'
+MERGE_BATCH_SIZE = 200  # duplicates per UPDATE; keeps the CASE within SQLite's parameter limit
+
+
+def duplicate_key_querysets(contacts):
+    """{kind: contacts annotated with that duplicate key as `key`}"""
+    return {
+        PHONE: contacts.exclude(normalized_phone='').annotate(key=Substr('reversed_phone', 1, CALLER_SUFFIX_DIGITS)),
+        EMAIL: contacts.filter(email__gt='').annotate(key=Lower('email')),
+    }
+
+
+def numbers_compatible(numbers):
+    """Whether the (non-empty) numbers are all suffixes of the longest one"""
+    numbers = [number for number in numbers if number]
+    longest = max(numbers, key=len, default='')
+    return all(longest.endswith(number) for number in numbers)
+
+
+def find_clusters(contacts):
+    """Duplicate clusters among contacts, as (mergeable, conflicts).
+
+    Both are lists of clusters; a cluster is a sorted list of contact ids,
+    oldest first.
+    """
+    parent = {}
+    numbers = {}
+
+    def find(contact_id):
+        root = parent.setdefault(contact_id, contact_id)
+        while root != parent[root]:
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    def union(ids):
+        roots = sorted({find(contact_id) for contact_id in ids})
+        for root in roots[1:]:
+            parent[root] = roots[0]
+
+    for keyed in duplicate_key_querysets(contacts).values():
+        shared = keyed.values('user_id', 'key').annotate(contacts=Count('id')).filter(contacts__gt=1).order_by()
+        shared_keys = {(row['user_id'], row['key']) for row in shared}
+        if not shared_keys:
+            continue
+        groups = defaultdict(list)
+        members = keyed.filter(key__in={key for _, key in shared_keys}).values_list(
+            'id', 'user_id', 'key', 'normalized_phone'
+        )
+        for contact_id, user_id, key, normalized in members.iterator():
+            if (user_id, key) in shared_keys:
+                groups[user_id, key].append(contact_id)
+                numbers[contact_id] = normalized
+        for group in groups.values():
+            union(group)
+
+    clusters = defaultdict(list)
+    for contact_id in parent:
+        clusters[find(contact_id)].append(contact_id)
+    mergeable, conflicts = [], []
+    for ids in sorted(sorted(ids) for ids in clusters.values()):
+        (mergeable if numbers_compatible(numbers[contact_id] for contact_id in ids) else conflicts).append(ids)
+    return mergeable, conflicts
+
+
+def merge_clusters(clusters, user=None):
+    """Merge each cluster into its first contact; returns (contacts removed, calls moved).
+
+    Pass user to refuse clusters containing other users' contacts.
+    """
+    survivor_of = {
+        duplicate: cluster[0] for cluster in clusters for duplicate in cluster[1:]
+    }
+    survivors = {cluster[0] for cluster in clusters}
+    if not survivor_of:
+        return 0, 0
+    if user is not None and Contact.objects.filter(id__in=[*survivor_of, *survivors]).exclude(user=user).exists():
+        raise ValueError("Clusters may only contain the user's own contacts")
+
+    removed = calls_moved = 0
+    duplicates = list(survivor_of)
+    with transaction.atomic():
+        # Survivors without an email inherit the first one among their duplicates
+        emails = {}
+        for contact_id, email in (
+            Contact.objects.filter(id__in=[*duplicates, *survivors], email__gt='')
+            .order_by('id').values_list('id', 'email').iterator()
+        ):
+            emails.setdefault(survivor_of.get(contact_id, contact_id), (contact_id, email))
+
+        for start in range(0, len(duplicates), MERGE_BATCH_SIZE):
+            batch = duplicates[start:start + MERGE_BATCH_SIZE]
+            calls_moved += Call.objects.filter(contact_id__in=batch).update(
+                contact_id=Case(*[When(contact_id=duplicate, then=Value(survivor_of[duplicate])) for duplicate in batch]),
+                updated_at=timezone.now(),
+            )
+            removed += Contact.objects.filter(id__in=batch).delete()[1].get(Contact._meta.label, 0)
+
+        for survivor, (source, email) in emails.items():
+            if source != survivor:
+                Contact.objects.filter(id=survivor).update(email=email, updated_at=timezone.now())
+    # Deletes invalidate through signals; survivors were changed with update()
+    caller_cache.invalidate_contacts(Contact.objects.filter(id__in=survivors).only('id', 'user_id', 'phone_number'))
+    return removed, calls_moved
+
+
+def merge_duplicates(after_user_id=0, users_per_batch=500, user=None, dry_run=False):
+    """Find and merge duplicates user batch by user batch.
+
+    Yields a progress dict after each batch; its last_user_id is the point
+    to resume from. Conflicting clusters are reported and never merged;
+    with dry_run nothing is merged.
+    """
+    users = Contact.objects.order_by().values_list('user_id', flat=True).distinct()
+    if user is not None:
+        users = users.filter(user=user)
+    while True:
+        batch = list(users.filter(user_id__gt=after_user_id).order_by('user_id')[:users_per_batch])
+        if not batch:
+            return
+        clusters, conflicts = find_clusters(Contact.objects.filter(user_id__gte=batch[0], user_id__lte=batch[-1]))
+        removed = calls_moved = 0
+        if not dry_run:
+            removed, calls_moved = merge_clusters(clusters)
+        after_user_id = batch[-1]
+        yield {
+            'last_user_id': after_user_id,
+            'users': len(batch),
+            'clusters': clusters,
+            'conflicts': conflicts,
+            'contacts_removed': removed,
+            'calls_moved': calls_moved,
+        }
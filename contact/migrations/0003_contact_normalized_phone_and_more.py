@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact', '0002_alter_contact_email'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='normalized_phone',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(fields=['user', 'normalized_phone'], name='contact_user_norm_phone_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(fields=['normalized_phone'], name='contact_norm_phone_idx'),
+        ),
+    ]
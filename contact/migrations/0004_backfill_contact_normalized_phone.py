@@ -0,0 +1,36 @@
+# Generated manually to backfill the canonical phone number in batches
+
+import re
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_normalized_phone(apps, schema_editor):
+    Contact = apps.get_model('contact', 'Contact')
+    last_id = 0
+    while True:
+        batch = list(
+            Contact.objects.filter(id__gt=last_id)
+            .order_by('id')
+            .only('id', 'phone_number', 'normalized_phone')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for contact in batch:
+            contact.normalized_phone = re.sub(r'\D', '', contact.phone_number or '')
+        Contact.objects.bulk_update(batch, ['normalized_phone'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('contact', '0003_contact_normalized_phone_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_normalized_phone, migrations.RunPython.noop),
+    ]
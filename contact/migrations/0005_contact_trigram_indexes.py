@@ -0,0 +1,41 @@
+# Generated manually to add pg_trgm indexes for contact search
+
+from django.db import migrations
+
+TRIGRAM_INDEXES = {
+    'contact_name_trgm_idx': 'name',
+    'contact_phone_trgm_idx': 'phone_number',
+    'contact_email_trgm_idx': 'email',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # SQLite uses an FTS5 table instead; see contact.search
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for index_name, column in TRIGRAM_INDEXES.items():
+        # Matches the UPPER(column::text) LIKE UPPER(...) that icontains compiles to
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} '
+            f'ON contact_contact USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}')
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('contact', '0004_backfill_contact_normalized_phone'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,34 @@
+# Generated manually to backfill the reversed phone digits in batches
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_reversed_phone(apps, schema_editor):
+    Contact = apps.get_model('contact', 'Contact')
+    last_id = 0
+    while True:
+        batch = list(
+            Contact.objects.filter(id__gt=last_id)
+            .order_by('id')
+            .only('id', 'normalized_phone', 'reversed_phone')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for contact in batch:
+            contact.reversed_phone = contact.normalized_phone[::-1]
+        Contact.objects.bulk_update(batch, ['reversed_phone'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('contact', '0006_contact_reversed_phone_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_reversed_phone, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated manually to order NULLs last in the recency index on PostgreSQL
+
+from django.db import migrations
+
+
+def rebuild_recent_index(apps, schema_editor):
+    # PostgreSQL puts NULLs first in a DESC index, but the contact list sorts
+    # never-called contacts last. SQLite treats NULLs as smallest, so the
+    # plain DESC index already matches there.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS contact_user_recent_idx')
+    schema_editor.execute(
+        'CREATE INDEX CONCURRENTLY contact_user_recent_idx '
+        'ON contact_contact (user_id, last_call_at DESC NULLS LAST, id DESC)'
+    )
+
+
+def restore_recent_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS contact_user_recent_idx')
+    schema_editor.execute(
+        'CREATE INDEX CONCURRENTLY contact_user_recent_idx '
+        'ON contact_contact (user_id, last_call_at DESC, id DESC)'
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('contact', '0008_contact_call_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_recent_index, restore_recent_index),
+    ]
@@ -0,0 +1,93 @@
+# Generated manually to resolve duplicates ahead of the per-user unique constraints
+
+from django.db import migrations
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def merge_duplicate_numbers(apps, schema_editor):
+    """Merge contacts sharing a (user, canonical number) into the oldest one.
+
+    As contact.merge does: calls move to the survivor, and a survivor
+    without a name or email takes the first one among its duplicates before
+    they are deleted. The survivors' call summaries are recomputed, because
+    on SQLite the call triggers are dropped while migrations run. No
+    tombstones are written: the changes endpoints arrive in a later
+    migration, so no client can have synced these contacts yet.
+    """
+    Contact = apps.get_model('contact', 'Contact')
+    Call = apps.get_model('call', 'Call')
+
+    groups = (
+        Contact.objects.exclude(normalized_phone='')
+        .values('user_id', 'normalized_phone')
+        .annotate(contacts=Count('id'))
+        .filter(contacts__gt=1)
+        .order_by()
+    )
+    survivors = []
+    for group in list(groups):
+        survivor, *duplicates = Contact.objects.filter(
+            user_id=group['user_id'], normalized_phone=group['normalized_phone']
+        ).order_by('id')
+        Call.objects.filter(contact__in=duplicates).update(contact_id=survivor.id, updated_at=timezone.now())
+        for field in ('name', 'email'):
+            if not getattr(survivor, field):
+                setattr(survivor, field, next((getattr(d, field) for d in duplicates if getattr(d, field)), None))
+        Contact.objects.filter(id__in=[duplicate.id for duplicate in duplicates]).delete()
+        Contact.objects.filter(id=survivor.id).update(
+            name=survivor.name or '', email=survivor.email, updated_at=timezone.now()
+        )
+        survivors.append(survivor.id)
+
+    calls = Call.objects.filter(contact=OuterRef('pk')).order_by().values('contact')
+    Contact.objects.filter(id__in=survivors).update(
+        call_count=Coalesce(Subquery(calls.annotate(calls=Count('id')).values('calls')), 0),
+        total_talk_seconds=Coalesce(Subquery(calls.annotate(duration=Sum('call_duration')).values('duration')), 0),
+        last_call_at=Subquery(calls.annotate(last=Max('created_at')).values('last')),
+    )
+
+
+def check_duplicate_emails(apps, schema_editor):
+    """Stop if an email is on several of a user's contacts with different numbers.
+
+    Those are different people or a typo. Either way someone has to decide,
+    so the migration neither merges them nor clears an address.
+    """
+    Contact = apps.get_model('contact', 'Contact')
+    groups = list(
+        Contact.objects.filter(email__gt='')
+        .values('user_id', 'email')
+        .annotate(contacts=Count('id'))
+        .filter(contacts__gt=1)
+        .order_by('user_id', 'email')
+    )
+    if not groups:
+        return
+    conflicts = []
+    for group in groups[:20]:
+        ids = list(
+            Contact.objects.filter(user_id=group['user_id'], email=group['email'])
+            .order_by('id').values_list('id', flat=True)
+        )
+        conflicts.append(f"user {group['user_id']}, {group['email']!r}: contacts {ids}")
+    raise RuntimeError(
+        f"{len(groups)} email addresses are shared by several contacts of one user, e.g.\n  "
+        + "\n  ".join(conflicts)
+        + "\nGive each of them a single contact (change or clear the other contacts' email) "
+        "and run migrate again."
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact', '0009_contact_recent_index_nulls_last'),
+        ('call', '0019_contact_summary_triggers'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_numbers, migrations.RunPython.noop),
+        migrations.RunPython(check_duplicate_emails, migrations.RunPython.noop),
+    ]
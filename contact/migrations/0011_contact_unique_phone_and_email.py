@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact', '0010_resolve_duplicate_contacts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='contact',
+            constraint=models.UniqueConstraint(condition=models.Q(('normalized_phone__gt', '')), fields=('user', 'normalized_phone'), name='contact_user_phone_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='contact',
+            constraint=models.UniqueConstraint(condition=models.Q(('email__gt', '')), fields=('user', 'email'), name='contact_user_email_uniq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact', '0011_contact_unique_phone_and_email'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='contact_user_updated_idx'),
+        ),
+    ]
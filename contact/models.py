@@ -1,14 +1,211 @@
-from django.db import models
+import re
+
+from django.db import connections, models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+
+def normalize_phone_number(phone_number):
+    """Normalize phone number by removing all non-digit characters"""
+    if not phone_number:
+        return ""
+    # Remove all non-digit characters
+    normalized = re.sub(r'\D', '', phone_number)
+    return normalized
+
+
+CALLER_SUFFIX_DIGITS = 10
+# Maintained by database triggers on call_call (see call.rollups); never written by save()
+CALL_SUMMARY_FIELDS = ('last_call_at', 'call_count', 'total_talk_seconds')
+CALLER_SUFFIX_CANDIDATE_LIMIT = 20
+UPSERT_COLUMNS = (
+    'user_id', 'name', 'phone_number', 'normalized_phone', 'reversed_phone', 'email',
+    'call_count', 'total_talk_seconds', 'created_at', 'updated_at',
+)
+
+
+class ContactQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the contacts, logging them for the changes endpoints (see call.sync)"""
+        from call.sync import record_contact_deletions
+
+        with transaction.atomic(using=self.db):
+            record_contact_deletions(self)
+            return super().delete()
+
+    def matching_number(self, phone_number, user=None):
+        """Contacts whose canonical number equals the canonical form of phone_number"""
+        normalized = normalize_phone_number(phone_number)
+        if not normalized:
+            return self.none()
+        queryset = self.filter(normalized_phone=normalized)
+        if user is not None:
+            queryset = queryset.filter(user=user)
+        return queryset
+
+    def matching_suffix(self, phone_number, user=None, digits=CALLER_SUFFIX_DIGITS):
+        """Contacts whose canonical number ends with the last `digits` digits of phone_number
+
+        Served as a range scan on the reversed-digits index.
+        """
+        normalized = normalize_phone_number(phone_number)
+        if not normalized:
+            return self.none()
+        prefix = normalized[-digits:][::-1]
+        # ':' sorts right after '9', so this is "starts with prefix" for digit strings
+        queryset = self.filter(reversed_phone__gte=prefix, reversed_phone__lt=prefix + ':')
+        if user is not None:
+            queryset = queryset.filter(user=user)
+        return queryset
+
+    def resolve_caller(self, phone_number, user=None, digits=CALLER_SUFFIX_DIGITS):
+        """Resolve an inbound caller ID to a single contact, or None when ambiguous
+
+        Among contacts sharing the last `digits` digits, an exact canonical
+        match wins. Otherwise the match must be unique up to a missing
+        prefix (e.g. a number saved without its country code); several
+        different numbers sharing the suffix resolve to None.
+        """
+        normalized = normalize_phone_number(phone_number)
+        if not normalized:
+            return None
+        candidates = list(self.caller_candidates(normalized, user=user, digits=digits))
+        return pick_caller(candidates, normalized)
+
+    async def aresolve_caller(self, phone_number, user=None, digits=CALLER_SUFFIX_DIGITS):
+        """Async version of resolve_caller()"""
+        normalized = normalize_phone_number(phone_number)
+        if not normalized:
+            return None
+        candidates = [
+            contact async for contact in self.caller_candidates(normalized, user=user, digits=digits)
+        ]
+        return pick_caller(candidates, normalized)
+
+    def caller_candidates(self, normalized, user=None, digits=CALLER_SUFFIX_DIGITS):
+        """Contacts sharing the suffix, capped; exact matches sort first so the cap never drops them"""
+        exact_first = models.Case(models.When(normalized_phone=normalized, then=0), default=1)
+        return self.matching_suffix(normalized, user=user, digits=digits).order_by(
+            exact_first, 'id'
+        )[:CALLER_SUFFIX_CANDIDATE_LIMIT]
+
+    def upsert(self, user, rows):
+        """Insert or update contacts keyed on (user, canonical number) with INSERT ... ON CONFLICT.
+
+        rows are (name, phone_number, email) with distinct, non-empty canonical
+        numbers. An existing contact gets the new name and number formatting,
+        and the new email unless it is None. One statement per batch, no reads
+        first. Returns {canonical number: (contact id, created)}; raises
+        IntegrityError if an email belongs to another of the user's contacts.
+        """
+        connection = connections[self.db]
+        table = self.model._meta.db_table
+        quote = connection.ops.quote_name
+        user_id = getattr(user, 'pk', user)
+        max_params = connection.features.max_query_params
+        batch_size = max_params // len(UPSERT_COLUMNS) if max_params else len(rows) or 1
+        row_sql = '(' + ', '.join(['%s'] * len(UPSERT_COLUMNS)) + ')'
+        results = {}
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                # Stamped per batch, as close to the commit as possible (see call.sync)
+                now = connection.ops.adapt_datetimefield_value(timezone.now())
+                params = []
+                for name, phone_number, email in batch:
+                    normalized = normalize_phone_number(phone_number)
+                    params += [user_id, name, phone_number, normalized, normalized[::-1], email, 0, 0, now, now]
+                # The conflict target repeats the partial index's WHERE clause so it can be inferred
+                cursor.execute(
+                    f"INSERT INTO {quote(table)} ({', '.join(map(quote, UPSERT_COLUMNS))}) "
+                    f"VALUES {', '.join([row_sql] * len(batch))} "
+                    f"ON CONFLICT (user_id, normalized_phone) WHERE normalized_phone > '' DO UPDATE SET "
+                    f"name = excluded.name, phone_number = excluded.phone_number, "
+                    f"email = COALESCE(excluded.email, {quote(table)}.email), updated_at = excluded.updated_at "
+                    f"RETURNING id, normalized_phone, created_at = updated_at",
+                    params,
+                )
+                for contact_id, normalized, created in cursor.fetchall():
+                    results[normalized] = (contact_id, bool(created))
+        return results
+
+
+def pick_caller(candidates, normalized):
+    """Apply the resolve_caller() ambiguity rules to contacts sharing a suffix"""
+    for contact in candidates:
+        if contact.normalized_phone == normalized:
+            return contact
+    compatible = [
+        contact for contact in candidates
+        if normalized.endswith(contact.normalized_phone) or contact.normalized_phone.endswith(normalized)
+    ]
+    if len({contact.normalized_phone for contact in compatible}) == 1:
+        return compatible[0]
+    return None
+
 
 # Create your models here.
 class Contact(models.Model):
     name = models.CharField(max_length=255)
     phone_number = models.CharField(max_length=255)
+    normalized_phone = models.CharField(max_length=255, blank=True, default='', editable=False)
+    reversed_phone = models.CharField(max_length=255, blank=True, default='', editable=False)
     email = models.EmailField(max_length=255, null=True, blank=True)
+    last_call_at = models.DateTimeField(null=True, blank=True, editable=False)
+    call_count = models.IntegerField(default=0, editable=False)
+    total_talk_seconds = models.BigIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    objects = ContactQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'normalized_phone'], name='contact_user_norm_phone_idx'),
+            models.Index(fields=['normalized_phone'], name='contact_norm_phone_idx'),
+            # Suffix ("ends with N digits") lookups for inbound caller ID
+            models.Index(fields=['user', 'reversed_phone'], name='contact_user_rev_phone_idx'),
+            models.Index(fields=['reversed_phone'], name='contact_rev_phone_idx'),
+            # Contact list sorted by recency or frequency of calls
+            models.Index(fields=['user', '-last_call_at', '-id'], name='contact_user_recent_idx'),
+            models.Index(fields=['user', '-call_count', '-id'], name='contact_user_frequent_idx'),
+            # Delta sync: keyset scan on (updated_at, id)
+            models.Index(fields=['user', 'updated_at', 'id'], name='contact_user_updated_idx'),
+        ]
+        constraints = [
+            # One contact per canonical number and per email address for each user.
+            # Also the conflict targets of ContactQuerySet.upsert().
+            models.UniqueConstraint(
+                fields=['user', 'normalized_phone'], condition=models.Q(normalized_phone__gt=''),
+                name='contact_user_phone_uniq',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'email'], condition=models.Q(email__gt=''),
+                name='contact_user_email_uniq',
+            ),
+        ]
+
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    def save(self, *args, **kwargs):
+        self.normalized_phone = normalize_phone_number(self.phone_number)
+        self.reversed_phone = self.normalized_phone[::-1]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'phone_number' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'normalized_phone', 'reversed_phone'}
+        elif update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            # Don't write back call summary values that may be stale on this instance
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in CALL_SUMMARY_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from call.sync import record_contact_deletions
+
+        with transaction.atomic(using=self._state.db):
+            record_contact_deletions(Contact.objects.using(self._state.db).filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
@@ -0,0 +1,103 @@
+"""
+Substring search for contacts and call history.
+
+PostgreSQL serves the ``icontains`` filters from pg_trgm GIN indexes on
+``UPPER(column::text)`` (created in the search index migrations). SQLite uses
+FTS5 tables with the trigram tokenizer, kept in sync with the source table by
+triggers. Queries shorter than a trigram fall back to plain ``icontains``.
+"""
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+MIN_NGRAM_QUERY_LENGTH = 3
+
+CONTACT_TABLE = 'contact_contact'
+CONTACT_SEARCH_FIELDS = ('name', 'phone_number', 'email')
+
+
+def search_table_name(table):
+    return f'{table}_search'
+
+
+def sqlite_search_statements(table, columns):
+    """SQL creating the FTS5 table and the triggers that keep it in sync"""
+    search_table = search_table_name(table)
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    delete_old = (
+        f"INSERT INTO {search_table}({search_table}, rowid, {column_list}) "
+        f"VALUES ('delete', old.id, {old_values});"
+    )
+    insert_new = f"INSERT INTO {search_table}(rowid, {column_list}) VALUES (new.id, {new_values});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {search_table} USING fts5("
+        f"{column_list}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {search_table}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {search_table}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {search_table}_au AFTER UPDATE OF {column_list} ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+    ]
+
+
+def ensure_sqlite_search_index(connection, table, columns):
+    """Create the FTS5 table and triggers if any are missing, then rebuild it.
+
+    SQLite drops a table's triggers whenever a migration remakes the table, so
+    this runs after every migrate; it is a no-op when everything is in place.
+    """
+    search_table = search_table_name(table)
+    expected = {f'{search_table}_ai', f'{search_table}_ad', f'{search_table}_au'}
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [table])
+        if expected <= {row[0] for row in cursor.fetchall()}:
+            return False
+        for statement in sqlite_search_statements(table, columns):
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild')")
+    return True
+
+
+def uses_ngram_index(queryset, query):
+    return len(query) >= MIN_NGRAM_QUERY_LENGTH and connections[queryset.db].vendor == 'sqlite'
+
+
+def ngram_match_ids(table, query, columns=None):
+    """Subquery of row ids whose indexed columns (or only the given ones) contain query"""
+    search_table = search_table_name(table)
+    phrase = '"' + query.replace('"', '""') + '"'
+    if columns:
+        phrase = '{%s} : %s' % (' '.join(columns), phrase)
+    return RawSQL(f'SELECT rowid FROM {search_table} WHERE {search_table} MATCH %s', [phrase])
+
+
+def icontains_filter(fields, query):
+    condition = Q()
+    for field in fields:
+        condition |= Q(**{f'{field}__icontains': query})
+    return condition
+
+
+def search_contacts(queryset, query, rank=True, fields=CONTACT_SEARCH_FIELDS):
+    """Filter contacts by a substring of name, phone number or email (or the given fields).
+
+    With rank=True results are ordered exact name match first, then name
+    prefix, then phone/email prefix, then any other substring match.
+    """
+    if uses_ngram_index(queryset, query):
+        queryset = queryset.filter(id__in=ngram_match_ids(CONTACT_TABLE, query, columns=fields))
+    else:
+        queryset = queryset.filter(icontains_filter(fields, query))
+
+    if rank:
+        queryset = queryset.annotate(
+            search_rank=Case(
+                When(name__iexact=query, then=Value(3)),
+                When(name__istartswith=query, then=Value(2)),
+                When(Q(phone_number__istartswith=query) | Q(email__istartswith=query), then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        ).order_by('-search_rank', 'name', 'id')
+    return queryset
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from .fast_serializers import ValuesSerializer, column, datetime_column
 from .models import Contact
 from django.contrib.auth.models import User
 
@@ -12,8 +13,11 @@ class ContactSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Contact
-        fields = ['id', 'name', 'phone_number', 'email', 'created_at', 'updated_at', 'user']
-        read_only_fields = ['created_at', 'updated_at', 'user']
+        fields = [
+            'id', 'name', 'phone_number', 'email', 'last_call_at', 'call_count', 'total_talk_seconds',
+            'created_at', 'updated_at', 'user',
+        ]
+        read_only_fields = ['last_call_at', 'call_count', 'total_talk_seconds', 'created_at', 'updated_at', 'user']
 
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
@@ -30,24 +34,32 @@ class ContactSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Phone number must contain at least 10 digits")
         
         return cleaned_number
-    
-    def validate_email(self, value):
-        """Validate email format"""
-        if value:
-            # Check if email already exists for this user
-            user = self.context['request'].user
-            if Contact.objects.filter(user=user, email=value).exists():
-                # If updating, exclude current instance
-                if self.instance:
-                    if Contact.objects.filter(user=user, email=value).exclude(id=self.instance.id).exists():
-                        raise serializers.ValidationError("A contact with this email already exists")
-                else:
-                    raise serializers.ValidationError("A contact with this email already exists")
-        return value
 
 class ContactListSerializer(serializers.ModelSerializer):
     """Simplified serializer for list views"""
     class Meta:
         model = Contact
-        fields = ['id', 'name', 'phone_number', 'email', 'created_at']
-        read_only_fields = ['created_at']
+        fields = ['id', 'name', 'phone_number', 'email', 'last_call_at', 'call_count', 'created_at']
+        read_only_fields = ['last_call_at', 'call_count', 'created_at']
+
+
+# ContactListSerializer over values() rows
+CONTACT_LIST_VALUES = ValuesSerializer({
+    'id': column('id'),
+    'name': column('name'),
+    'phone_number': column('phone_number'),
+    'email': column('email'),
+    'last_call_at': datetime_column('last_call_at'),
+    'call_count': column('call_count'),
+    'created_at': datetime_column('created_at'),
+})
+
+# Delta sync rows (see call.sync); the trigger-maintained call summary is left out
+CONTACT_SYNC_VALUES = ValuesSerializer({
+    'id': column('id'),
+    'name': column('name'),
+    'phone_number': column('phone_number'),
+    'email': column('email'),
+    'created_at': datetime_column('created_at'),
+    'updated_at': datetime_column('updated_at'),
+}, required_columns=('id', 'updated_at'))
@@ -1,3 +1,830 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from call.models import Call
+from call.rollups import rebuild_contact_summaries
+from . import imports
+from .caller_cache import CallerCache, caller_cache
+from .merge import find_clusters
+from .models import Contact, normalize_phone_number
+from .serializers import ContactListSerializer
+from .views import CONTACT_ORDERINGS
+
+
+class NormalizedPhoneTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.other = User.objects.create_user(username='bob', password='pass12345')
+
+    def test_normalize_phone_number(self):
+        self.assertEqual(normalize_phone_number('+1 (234) 567-8900'), '12345678900')
+        self.assertEqual(normalize_phone_number(None), '')
+
+    def test_normalized_phone_filled_on_save(self):
+        contact = Contact.objects.create(user=self.user, name='A', phone_number='+1-234-567-8900')
+        self.assertEqual(contact.normalized_phone, '12345678900')
+        contact.phone_number = '+44 20 7946 0000'
+        contact.save(update_fields=['phone_number'])
+        contact.refresh_from_db()
+        self.assertEqual(contact.normalized_phone, '442079460000')
+
+    def test_matching_number_is_scoped_to_user(self):
+        mine = Contact.objects.create(user=self.user, name='A', phone_number='+12345678900')
+        Contact.objects.create(user=self.other, name='B', phone_number='12345678900')
+        matches = Contact.objects.matching_number('+1 234 567 8900', user=self.user)
+        self.assertEqual(list(matches), [mine])
+        self.assertFalse(Contact.objects.matching_number('', user=self.user).exists())
+
+
+class BulkCallLinkingTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def seed_calls(self, number, count):
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number=number,
+                 normalized_number=normalize_phone_number(number), call_status='completed')
+            for _ in range(count)
+        ])
+
+    def create_contact(self, phone_number):
+        return self.client.post('/api/contact/contacts/', {'name': 'A', 'phone_number': phone_number})
+
+    def test_link_to_contact_updates_only_matching_unlinked_calls(self):
+        self.seed_calls('+1 (234) 567-8900', 3)
+        self.seed_calls('+19998887777', 2)
+        contact = Contact.objects.create(user=self.user, name='A', phone_number='12345678900')
+        self.assertEqual(Call.objects.link_to_contact(contact), 3)
+        self.assertEqual(Call.objects.filter(contact=contact).count(), 3)
+        self.assertEqual(Call.objects.link_to_contact(contact), 0)
+
+    def test_create_query_count_is_constant(self):
+        """Linking costs the same number of queries for 1 or 200 matching calls"""
+        self.seed_calls('+12345678900', 1)
+        self.seed_calls('+13334445555', 200)
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.create_contact('+12345678900')
+        self.assertEqual(response.data['linked_calls'], 1)
+
+        with CaptureQueriesContext(connection) as many:
+            response = self.create_contact('+13334445555')
+        self.assertEqual(response.data['linked_calls'], 200)
+
+        self.assertEqual(len(few), len(many))
+
+
+class UnlinkedCallsStatsTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/api/contact/contacts/unlinked_calls_stats/'
+
+    def seed_calls(self, number, count):
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number=number,
+                 normalized_number=normalize_phone_number(number), call_status='completed')
+            for _ in range(count)
+        ])
+
+    def test_groups_and_matches_in_sql(self):
+        # Calls created before the contacts exist stay unlinked
+        self.seed_calls('+1 234 567 8900', 2)
+        self.seed_calls('12345678900', 1)
+        self.seed_calls('+15550001111', 4)
+        self.seed_calls('+19990001111', 1)
+        first = Contact.objects.create(user=self.user, name='First', phone_number='+12345678900')
+        Contact.objects.create(user=self.user, name='Second', phone_number='15550001111')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_unlinked_calls'], 8)
+        self.assertEqual(response.data['unique_phone_numbers'], 3)
+        self.assertEqual(response.data['potential_matches_count'], 2)
+        self.assertIsNone(response.data['next_cursor'])
+        match = response.data['potential_matches'][0]
+        self.assertEqual(match['phone_number'], '12345678900')
+        self.assertEqual(match['contact_id'], first.id)
+        self.assertEqual(match['call_count'], 3)
+        self.assertEqual(sorted(match['original_numbers']), ['+1 234 567 8900', '12345678900'])
+
+    def test_cursor_pagination_and_bounded_queries(self):
+        for index in range(5):
+            number = f'+1555000000{index}'
+            self.seed_calls(number, 3)
+            Contact.objects.create(user=self.user, name=str(index), phone_number=number)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'limit': 2})
+        first_page_queries = len(queries)
+        self.assertEqual(len(response.data['potential_matches']), 2)
+        self.assertEqual(response.data['potential_matches_count'], 5)
+
+        seen = [m['phone_number'] for m in response.data['potential_matches']]
+        while response.data['next_cursor']:
+            response = self.client.get(self.url, {'limit': 2, 'cursor': response.data['next_cursor']})
+            seen += [m['phone_number'] for m in response.data['potential_matches']]
+        self.assertEqual(seen, sorted(f'1555000000{index}' for index in range(5)))
+
+        self.seed_calls('+15550000009', 50)
+        Contact.objects.create(user=self.user, name='9', phone_number='+15550000009')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, {'limit': 2})
+        self.assertEqual(len(queries), first_page_queries)
+
+    def test_all_matches_without_limit_or_cursor(self):
+        for index in range(5):
+            number = f'+1555000000{index}'
+            self.seed_calls(number, 2)
+            Contact.objects.create(user=self.user, name=str(index), phone_number=number)
+
+        with mock.patch('contact.views.UNLINKED_STATS_DEFAULT_LIMIT', 2):
+            response = self.client.get(self.url)
+            self.assertEqual(len(response.data['potential_matches']), 5)
+            self.assertEqual(response.data['potential_matches_count'], 5)
+            self.assertIsNone(response.data['next_cursor'])
+            self.assertEqual(response.data['potential_matches'][4]['original_numbers'], ['+15550000004'])
+            # A cursor alone pages with the default limit
+            response = self.client.get(self.url, {'cursor': '15550000000'})
+            self.assertEqual([m['phone_number'] for m in response.data['potential_matches']],
+                             ['15550000001', '15550000002'])
+            self.assertEqual(response.data['next_cursor'], '15550000002')
+
+
+class ContactQueryBudgetTests(TestCase):
+    """Fixed query budgets; a per-row query anywhere makes these fail"""
+
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        token = RefreshToken.for_user(self.user).access_token
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number=f'+1555200{index % 15:04d}',
+                 normalized_number=f'1555200{index % 15:04d}', call_status='completed')
+            for index in range(60)
+        ])
+        self.contacts = [
+            Contact.objects.create(user=self.user, name=f'Contact {index}', phone_number=f'+1555200{index:04d}',
+                                   email=f'contact{index}@example.com' if index % 2 else None)
+            for index in range(20)
+        ]
+        # Unlink the calls again so the stats endpoint has matches to report
+        Call.objects.update(contact=None)
+
+    def test_list_budget(self):
+        # user, count, page
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/contact/contacts/')
+        self.assertEqual(response.data['count'], 20)
+
+    def test_retrieve_budget(self):
+        # user, contact with owner
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/contact/contacts/{self.contacts[0].id}/')
+        self.assertEqual(response.data['user']['username'], 'alice')
+
+    def test_search_budget(self):
+        # user, matches
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/contact/contacts/search/', {'q': 'Contact'})
+        self.assertEqual(response.data['count'], 20)
+
+    def test_stats_budget(self):
+        # user, aggregate
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/contact/contacts/stats/')
+        self.assertEqual(response.data['contacts_with_email'], 10)
+
+    def test_unlinked_calls_stats_budget(self):
+        # user, totals, match count, page, original numbers
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/contact/contacts/unlinked_calls_stats/')
+        self.assertEqual(response.data['potential_matches_count'], 15)
+
+
+class ContactSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ann = Contact.objects.create(user=self.user, name='Ann', phone_number='+15551230000')
+        self.annabel = Contact.objects.create(user=self.user, name='Annabel Lee', phone_number='+15559870000',
+                                              email='annabel@example.com')
+        self.joanne = Contact.objects.create(user=self.user, name='Joanne', phone_number='+15554560000',
+                                             email='jo@example.com')
+
+    def search(self, query):
+        response = self.client.get('/api/contact/contacts/search/', {'q': query})
+        return [contact['id'] for contact in response.data['contacts']]
+
+    def test_substring_matches_are_ranked(self):
+        self.assertEqual(self.search('ann'), [self.ann.id, self.annabel.id, self.joanne.id])
+        self.assertEqual(self.search('555456'), [self.joanne.id])
+        self.assertEqual(self.search('EXAMPLE.COM'), [self.annabel.id, self.joanne.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.joanne.name = 'Josephine'
+        self.joanne.save()
+        self.annabel.delete()
+        self.assertEqual(self.search('ann'), [self.ann.id])
+        self.assertEqual(self.search('sephi'), [self.joanne.id])
+
+    def test_short_query_falls_back_to_icontains(self):
+        self.assertEqual(self.search('jo'), [self.joanne.id])
+
+    def test_list_search_is_scoped_to_user(self):
+        other = User.objects.create_user(username='bob', password='pass12345')
+        Contact.objects.create(user=other, name='Anne', phone_number='+15550000000')
+        response = self.client.get('/api/contact/contacts/', {'search': 'ann'})
+        self.assertEqual(response.data['count'], 3)
+
+
+class CallerSuffixResolutionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+
+    def add(self, phone_number, user=None):
+        return Contact.objects.create(user=user or self.user, name=phone_number, phone_number=phone_number)
+
+    def test_national_number_matches_international_caller(self):
+        contact = self.add('(555) 123-4567')
+        self.assertEqual(contact.reversed_phone, '7654321555')
+        self.assertEqual(Contact.objects.resolve_caller('+1 555 123 4567', user=self.user), contact)
+
+    def test_exact_match_wins_over_other_suffix_matches(self):
+        self.add('+445551234567')
+        exact = self.add('+15551234567')
+        self.assertEqual(Contact.objects.resolve_caller('+15551234567', user=self.user), exact)
+
+    def test_exact_match_survives_the_candidate_cap(self):
+        for prefix in range(30, 60):
+            self.add(f'+{prefix}5551234567')
+        exact = self.add('+15551234567')
+        self.assertEqual(Contact.objects.resolve_caller('+15551234567', user=self.user), exact)
+
+    def test_different_numbers_sharing_suffix_are_ambiguous(self):
+        self.add('+445551234567')
+        self.add('+15551234567')
+        self.assertIsNone(Contact.objects.resolve_caller('555-123-4567', user=self.user))
+        self.assertIsNone(Contact.objects.resolve_caller('', user=self.user))
+
+    def test_scoped_to_user(self):
+        other = User.objects.create_user(username='bob', password='pass12345')
+        self.add('+15551234567', user=other)
+        self.assertIsNone(Contact.objects.resolve_caller('+15551234567', user=self.user))
+
+    def test_suffix_lookup_is_an_index_range_scan(self):
+        plan = Contact.objects.matching_suffix('+15551234567', user=self.user).explain()
+        self.assertIn('contact_user_rev_phone_idx', plan)
+
+
+class CallerCacheTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.other = User.objects.create_user(username='bob', password='pass12345')
+        self.contact = Contact.objects.create(user=self.user, name='Alice Mobile', phone_number='+1 555 123 4567')
+
+    def test_repeat_caller_is_resolved_without_queries(self):
+        self.assertEqual(caller_cache.resolve_caller('+15551234567', user=self.user).id, self.contact.id)
+        hits = caller_cache.stats()['hits']
+        with self.assertNumQueries(0):
+            match = caller_cache.resolve_caller('+1 (555) 123-4567', user=self.user.id)
+        self.assertEqual(match, (self.contact.id, 'Alice Mobile'))
+        self.assertEqual(caller_cache.stats()['hits'], hits + 1)
+
+    def test_saving_a_contact_evicts_matching_negative_entries(self):
+        self.assertIsNone(caller_cache.resolve_number('5559876543', user=self.user))
+        self.assertIsNone(caller_cache.resolve_caller('+15559876543', user=self.user))
+        Contact.objects.create(user=self.other, name='Not Alice', phone_number='5559876543')
+        with self.assertNumQueries(0):
+            self.assertIsNone(caller_cache.resolve_number('5559876543', user=self.user))
+
+        new = Contact.objects.create(user=self.user, name='New', phone_number='5559876543')
+        self.assertEqual(caller_cache.resolve_number('5559876543', user=self.user).id, new.id)
+        self.assertEqual(caller_cache.resolve_caller('+15559876543', user=self.user).id, new.id)
+
+    def test_renumbering_or_deleting_a_contact_evicts_its_entries(self):
+        caller_cache.resolve_caller('+15551234567', user=self.user)
+        self.contact.phone_number = '5550000000'
+        self.contact.save()
+        self.assertIsNone(caller_cache.resolve_caller('+15551234567', user=self.user))
+
+        self.assertEqual(caller_cache.resolve_number('5550000000', user=self.user).id, self.contact.id)
+        self.contact.delete()
+        self.assertIsNone(caller_cache.resolve_number('5550000000', user=self.user))
+
+    def test_negative_entries_expire_first_and_lru_is_bounded(self):
+        now = [0.0]
+        cache = CallerCache(max_size=2, ttl=60, negative_ttl=5, clock=lambda: now[0])
+        cache.resolve_number('15551234567', user=self.user)
+        cache.resolve_number('5550000001', user=self.user)
+        now[0] = 10
+        with self.assertNumQueries(1):
+            cache.resolve_number('15551234567', user=self.user)
+            cache.resolve_number('5550000001', user=self.user)
+        cache.resolve_number('5550000002', user=self.user)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        with self.assertNumQueries(1):
+            cache.resolve_number('15551234567', user=self.user)
+
+
+class ContactCallSummaryTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ann = Contact.objects.create(user=self.user, name='Ann', phone_number='+15550001111')
+        self.bob = Contact.objects.create(user=self.user, name='Bob', phone_number='+15550002222')
+        self.cid = Contact.objects.create(user=self.user, name='Cid', phone_number='+15550003333')
+
+    def call(self, contact_number, call_sid, duration=0, **fields):
+        return Call.objects.create(
+            user=self.user, contact_number=contact_number, call_sid=call_sid,
+            call_status='completed', call_duration=duration, **fields
+        )
+
+    def summary(self, contact):
+        contact.refresh_from_db()
+        return contact.call_count, contact.total_talk_seconds, contact.last_call_at
+
+    def test_new_calls_and_status_callbacks_update_summary(self):
+        first = self.call('+15550001111', 'CA1', duration=30)
+        second = Call.objects.create(
+            user=self.user, contact_number='+15550001111', call_sid='CA2', call_status='ringing'
+        )
+        self.assertEqual(self.summary(self.ann), (2, 30, second.created_at))
+
+        Call.objects.advance_status('CA2', 'completed', duration=45)
+        self.assertEqual(self.summary(self.ann), (2, 75, second.created_at))
+
+        second.delete()
+        self.assertEqual(self.summary(self.ann), (1, 30, first.created_at))
+        first.delete()
+        self.assertEqual(self.summary(self.ann), (0, 0, None))
+
+    def test_linking_moves_calls_between_summaries(self):
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number='+15550009999', normalized_number='15550009999',
+                 call_status='completed', call_duration=10)
+            for _ in range(3)
+        ])
+        self.bob.phone_number = '+15550009999'
+        self.bob.save()
+        self.assertEqual(Call.objects.link_to_contact(self.bob), 3)
+        self.assertEqual(self.summary(self.bob)[:2], (3, 30))
+
+        Call.objects.filter(contact=self.bob).update(contact=self.cid)
+        self.assertEqual(self.summary(self.bob), (0, 0, None))
+        self.assertEqual(self.summary(self.cid)[:2], (3, 30))
+
+    def test_saving_a_stale_contact_keeps_summary(self):
+        stale = Contact.objects.get(pk=self.ann.pk)
+        self.call('+15550001111', 'CA1', duration=30)
+        stale.name = 'Ann B'
+        stale.save()
+        self.assertEqual(self.summary(self.ann)[:2], (1, 30))
+        self.assertEqual(self.ann.name, 'Ann B')
+
+    def test_rebuild_matches_triggers(self):
+        self.call('+15550001111', 'CA1', duration=30)
+        self.call('+15550002222', 'CA2', duration=5)
+        expected = {contact.pk: self.summary(contact) for contact in (self.ann, self.bob, self.cid)}
+        Contact.objects.update(call_count=0, total_talk_seconds=0, last_call_at=None)
+        self.assertEqual(rebuild_contact_summaries(user=self.user), 3)
+        self.assertEqual(
+            {contact.pk: self.summary(contact) for contact in (self.ann, self.bob, self.cid)}, expected
+        )
+
+    def test_create_response_includes_linked_summary(self):
+        self.call('+15550004444', 'CA1', duration=12)
+        response = self.client.post('/api/contact/contacts/', {'name': 'Dee', 'phone_number': '+15550004444'})
+        self.assertEqual(response.data['contact']['call_count'], 1)
+        self.assertEqual(response.data['contact']['total_talk_seconds'], 12)
+
+    def test_list_ordering(self):
+        self.call('+15550001111', 'CA1')
+        for index in range(3):
+            self.call('+15550002222', f'CA-bob-{index}')
+        # created_at is auto_now_add; move Ann's call to be the latest
+        Call.objects.filter(call_sid='CA1').update(created_at=timezone.now() + timedelta(hours=1))
+
+        recent = self.client.get('/api/contact/contacts/', {'ordering': 'recent'})
+        self.assertEqual([row['name'] for row in recent.data['results']], ['Ann', 'Bob', 'Cid'])
+        frequent = self.client.get('/api/contact/contacts/', {'ordering': 'frequent'})
+        self.assertEqual([row['name'] for row in frequent.data['results']], ['Bob', 'Ann', 'Cid'])
+        self.assertEqual(frequent.data['results'][0]['call_count'], 3)
+
+        response = self.client.get('/api/contact/contacts/', {'ordering': 'loudest'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_recent_ordering_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite query plan')
+        queryset = Contact.objects.filter(user=self.user).order_by(*CONTACT_ORDERINGS['recent'])[:20]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('contact_user_recent_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ContactExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        other = User.objects.create_user(username='bob', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for index in range(5):
+            Contact.objects.create(user=self.user, name=f'Contact {index}', phone_number=f'+1555000{index:04d}')
+        Contact.objects.create(user=other, name='Not mine', phone_number='+15559990000')
+
+    def test_csv_export(self):
+        response = self.client.get('/api/contact/contacts/export/', {'ordering': 'name'})
+        self.assertTrue(response.streaming)
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['name'] for row in rows], [f'Contact {index}' for index in range(5)])
+        self.assertEqual(rows[0]['call_count'], '0')
+
+    def test_gzip_ndjson_export_with_search(self):
+        response = self.client.get(
+            '/api/contact/contacts/export/', {'output': 'ndjson', 'compress': 'gzip', 'search': 'Contact 3'}
+        )
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Contact 3'])
+
+    def test_invalid_output(self):
+        response = self.client.get('/api/contact/contacts/export/', {'output': 'xlsx'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ContactImportTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def import_json(self, rows):
+        return self.client.post('/api/contact/contacts/import/', rows, format='json')
+
+    def test_rows_taken_by_a_concurrent_write_fail_alone(self):
+        existing_values = imports.existing_values
+        calls = []
+
+        def racing_existing_values(*args):
+            found = existing_values(*args)
+            if not calls:
+                # Another request creates contacts after this import looked
+                Contact.objects.create(user=self.user, name='Raced', phone_number='+15550000002')
+                Contact.objects.create(user=self.user, name='Raced too', phone_number='+15550000009',
+                                       email='cid@example.com')
+            calls.append(args)
+            return found
+
+        with mock.patch('contact.imports.existing_values', side_effect=racing_existing_values):
+            response = self.import_json([
+                {'name': 'Ann', 'phone_number': '+15550000001'},
+                {'name': 'Bob', 'phone_number': '+15550000002'},
+                {'name': 'Cid', 'phone_number': '+15550000003', 'email': 'cid@example.com'},
+            ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['errors'], [
+            {'row': 2, 'errors': {'phone_number': 'A contact with this phone number already exists'}},
+            {'row': 3, 'errors': {'email': 'A contact with this email already exists'}},
+        ])
+        self.assertTrue(Contact.objects.filter(user=self.user, name='Ann').exists())
+
+    def import_file(self, name, content):
+        upload = SimpleUploadedFile(name, content.encode())
+        return self.client.post('/api/contact/contacts/import/', {'file': upload}, format='multipart')
+
+    def test_json_import_reports_row_errors_and_links_calls(self):
+        Contact.objects.create(user=self.user, name='Existing', phone_number='+15550000000')
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number='+1 555 000 0001', normalized_number='15550000001',
+                 call_status='completed', call_duration=20)
+            for _ in range(3)
+        ])
+        response = self.import_json([
+            {'name': 'Ann', 'phone_number': '+1 (555) 000-0001', 'email': 'ann@example.com'},
+            {'name': 'Bob', 'phone_number': '555'},
+            {'name': 'Ann again', 'phone_number': '15550000001'},
+            {'name': 'Old', 'phone_number': '1-555-000-0000'},
+            {'name': 'Cid', 'phone_number': '+15550000002', 'email': 'not-an-email'},
+            {'name': 'Dee', 'phone_number': '+15550000003'},
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['received'], response.data['created']), (6, 2))
+        self.assertEqual(response.data['linked_calls'], 3)
+        self.assertEqual(response.data['errors'], [
+            {'row': 2, 'errors': {'phone_number': 'Phone number must contain at least 10 digits'}},
+            {'row': 3, 'errors': {'row': 'Duplicate of row 1'}},
+            {'row': 4, 'errors': {'phone_number': 'A contact with this phone number already exists'}},
+            {'row': 5, 'errors': {'email': 'Enter a valid email address.'}},
+        ])
+        self.assertIsNotNone(response.data['rows_per_second'])
+        ann = Contact.objects.get(user=self.user, name='Ann')
+        self.assertEqual((ann.phone_number, ann.normalized_phone, ann.reversed_phone),
+                         ('+15550000001', '15550000001', '10000005551'))
+        self.assertEqual((ann.call_count, ann.total_talk_seconds), (3, 60))
+
+    def test_csv_upload_with_header_aliases(self):
+        response = self.import_file('people.csv', 'Full Name,Phone,Email Address,Company\n'
+                                                  'Ann,+15550000001,ann@example.com,Acme\n'
+                                                  '"Bob, Jr",+15550000002,,\n')
+        self.assertEqual(response.data['created'], 2)
+        bob = Contact.objects.get(user=self.user, normalized_phone='15550000002')
+        self.assertEqual((bob.name, bob.email), ('Bob, Jr', None))
+
+    def test_vcard_upload(self):
+        response = self.import_file('cards.vcf', (
+            'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Ann\r\n  Smith\r\n'
+            'TEL;TYPE=CELL:+1 555 000 0001\r\nTEL:+15559999999\r\nitem1.EMAIL;TYPE=INTERNET:ann@example.com\r\n'
+            'END:VCARD\r\nBEGIN:VCARD\r\nVERSION:3.0\r\nN:Jones;Bob;;;\r\nTEL:tel:+15550000002\r\nEND:VCARD\r\n'
+        ))
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(
+            set(Contact.objects.filter(user=self.user).values_list('name', 'phone_number', 'email')),
+            {('Ann Smith', '+15550000001', 'ann@example.com'), ('Bob Jones', '+15550000002', None)},
+        )
+
+    def test_query_count_is_constant(self):
+        def rows(offset, count):
+            return [{'name': f'C{index}', 'phone_number': f'+1555{offset + index:07d}'} for index in range(count)]
+
+        with CaptureQueriesContext(connection) as few:
+            self.import_json(rows(0, 5))
+        with CaptureQueriesContext(connection) as many:
+            self.import_json(rows(100, 200))
+        self.assertEqual(Contact.objects.filter(user=self.user).count(), 205)
+
+        # Only the number of INSERT batches grows (the backend caps parameters per statement)
+        def lookups(queries):
+            return [query['sql'] for query in queries.captured_queries if not query['sql'].startswith('INSERT')]
+        self.assertEqual(len(lookups(few)), len(lookups(many)))
+
+    def test_import_evicts_cached_misses(self):
+        self.assertIsNone(caller_cache.resolve_number('+15550000001', user=self.user))
+        self.import_json([{'name': 'Ann', 'phone_number': '+15550000001'}])
+        self.assertEqual(caller_cache.resolve_number('+15550000001', user=self.user).name, 'Ann')
+
+    def test_rejects_unusable_uploads(self):
+        self.assertEqual(self.import_json({'rows': []}).status_code, 400)
+        self.assertEqual(self.import_file('people.csv', 'name,email\nAnn,a@example.com\n').status_code, 400)
+        with self.settings(CONTACT_IMPORT_MAX_ROWS=1):
+            response = self.import_json([{'name': 'A', 'phone_number': '+15550000001'}] * 2)
+        self.assertEqual(response.status_code, 400)
+
+
+class ContactUniquenessTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.other = User.objects.create_user(username='bob', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ann = Contact.objects.create(user=self.user, name='Ann', phone_number='+15550001111', email='ann@example.com')
+
+    def upsert(self, rows):
+        return self.client.post('/api/contact/contacts/upsert/', rows, format='json')
+
+    def test_database_rejects_duplicate_number_and_email_per_user(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Contact.objects.create(user=self.user, name='Ann 2', phone_number='1 (555) 000-1111')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Contact.objects.create(user=self.user, name='Ann 3', phone_number='+15550002222', email='ann@example.com')
+        # Other users, and contacts without an email, are unaffected
+        Contact.objects.create(user=self.other, name='Ann', phone_number='+15550001111', email='ann@example.com')
+        Contact.objects.create(user=self.user, name='B', phone_number='+15550003333', email='')
+        Contact.objects.create(user=self.user, name='C', phone_number='+15550004444', email='')
+
+    def test_create_and_update_report_duplicates(self):
+        response = self.client.post('/api/contact/contacts/', {'name': 'Dup', 'phone_number': '1-555-000-1111'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('phone_number', response.data['details'])
+
+        bob = Contact.objects.create(user=self.user, name='Bob', phone_number='+15550002222')
+        response = self.client.patch(f'/api/contact/contacts/{bob.id}/', {'email': 'ann@example.com'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.data['details']), ['email'])
+
+        # Writing a contact's own values back is not a conflict
+        response = self.client.patch(f'/api/contact/contacts/{self.ann.id}/', {'email': 'ann@example.com'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_create_runs_no_uniqueness_reads(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/contact/contacts/', {
+                'name': 'New', 'phone_number': '+15550009999', 'email': 'new@example.com'
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('SELECT') and 'contact_contact' in query['sql']
+        ])
+
+    def test_upsert_inserts_and_updates_in_one_statement(self):
+        Call.objects.bulk_create([
+            Call(user=self.user, contact_number='+15550002222', normalized_number='15550002222', call_status='completed')
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.upsert([
+                {'name': 'Ann Smith', 'phone_number': '1 (555) 000-1111'},
+                {'name': 'Bob', 'phone_number': '+15550002222', 'email': 'bob@example.com'},
+            ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        self.assertEqual(response.data['linked_calls'], 1)
+        writes = [query['sql'] for query in queries.captured_queries if 'contact_contact' in query['sql']]
+        self.assertTrue(writes[0].startswith('INSERT'))
+        self.assertEqual(sum(sql.startswith('INSERT') for sql in writes), 1)
+
+        self.ann.refresh_from_db()
+        self.assertEqual((self.ann.name, self.ann.phone_number, self.ann.email),
+                         ('Ann Smith', '15550001111', 'ann@example.com'))
+        self.assertEqual(response.data['contacts'][0], {'row': 1, 'id': self.ann.id, 'created': False})
+        bob = Contact.objects.get(user=self.user, normalized_phone='15550002222')
+        self.assertEqual((bob.reversed_phone, bob.call_count), ('22220005551', 1))
+
+    def test_upsert_reports_email_conflicts_per_row(self):
+        response = self.upsert([
+            {'name': 'Bob', 'phone_number': '+15550002222', 'email': 'ann@example.com'},
+            {'name': 'Cid', 'phone_number': '+15550003333'},
+            {'name': 'Bad', 'phone_number': '12'},
+        ])
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['row'] for error in response.data['errors']], [1, 3])
+        self.assertEqual(response.data['errors'][0]['errors'], {'email': 'A contact with this email already exists'})
+        self.assertFalse(Contact.objects.filter(normalized_phone='15550002222').exists())
+
+    def test_upsert_refreshes_cached_caller_name(self):
+        self.assertEqual(caller_cache.resolve_number('+15550001111', user=self.user).name, 'Ann')
+        self.upsert({'name': 'Ann Smith', 'phone_number': '+15550001111'})
+        self.assertEqual(caller_cache.resolve_number('+15550001111', user=self.user).name, 'Ann Smith')
+
+
+class ContactMergeTests(TestCase):
+    def setUp(self):
+        caller_cache.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ann = self.contact('Ann', '+15550001111')
+        self.ann_local = self.contact('Ann (local)', '555-000-1111', email='ann@example.com')
+        self.cid = self.contact('Cid', '+15550002222', email='Cid@Example.com')
+        self.cid_work = self.contact('Cid work', '+15559990000', email='cid@example.com')
+        self.london = self.contact('London', '+44 20 7946 0000')
+        self.maine = self.contact('Maine', '+1 207 946 0000')
+        self.solo = self.contact('Solo', '+15550003333')
+        for contact, calls in ((self.ann, 1), (self.ann_local, 2)):
+            for _ in range(calls):
+                Call.objects.create(user=self.user, contact=contact, contact_number=contact.phone_number,
+                                    call_status='completed', call_duration=10)
+
+    def contact(self, name, phone_number, email=None, user=None):
+        return Contact.objects.create(user=user or self.user, name=name, phone_number=phone_number, email=email)
+
+    def test_find_clusters_by_suffix_and_email_case(self):
+        mergeable, conflicts = find_clusters(Contact.objects.filter(user=self.user))
+        self.assertEqual(mergeable, [[self.ann.id, self.ann_local.id]])
+        # Same email on two different numbers, and a shared suffix across countries, need review
+        self.assertEqual(conflicts, [[self.cid.id, self.cid_work.id], [self.london.id, self.maine.id]])
+
+    def test_command_merges_into_oldest_and_moves_calls(self):
+        out = io.StringIO()
+        call_command('merge_duplicate_contacts', stdout=out)
+        self.assertIn('Merged 1 duplicate groups (1 contacts removed, 2 calls moved); 2 groups need review',
+                      out.getvalue())
+        self.assertFalse(Contact.objects.filter(id=self.ann_local.id).exists())
+        self.ann.refresh_from_db()
+        self.assertEqual(self.ann.email, 'ann@example.com')
+        self.assertEqual((self.ann.call_count, self.ann.total_talk_seconds), (3, 30))
+        self.assertEqual(Contact.objects.filter(user=self.user).count(), 6)
+
+    def test_command_resumes_from_checkpoint(self):
+        later = User.objects.create_user(username='zed', password='pass12345')
+        self.contact('Zed', '+15550004444', user=later)
+        self.contact('Zed', '5550004444', user=later)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'merge.json')
+            with open(checkpoint, 'w') as f:
+                json.dump({'last_user_id': self.user.id}, f)
+            call_command('merge_duplicate_contacts', checkpoint=checkpoint, users_per_batch=1, stdout=io.StringIO())
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f), {'last_user_id': later.id})
+        self.assertEqual(Contact.objects.filter(user=later).count(), 1)
+        self.assertTrue(Contact.objects.filter(id=self.ann_local.id).exists())
+
+    def test_dry_run_changes_nothing(self):
+        call_command('merge_duplicate_contacts', dry_run=True, stdout=io.StringIO())
+        self.assertEqual(Contact.objects.filter(user=self.user).count(), 7)
+
+    def test_duplicates_endpoint(self):
+        response = self.client.get('/api/contact/contacts/duplicates/')
+        self.assertEqual((response.data['count'], response.data['mergeable']), (3, 1))
+        self.assertEqual([contact['name'] for contact in response.data['duplicates'][0]['contacts']],
+                         ['Ann', 'Ann (local)'])
+        self.assertTrue(response.data['duplicates'][1]['conflict'])
+
+    def test_merge_endpoint(self):
+        response = self.client.post('/api/contact/contacts/merge/', {
+            'contact_ids': [self.cid.id, self.cid_work.id], 'survivor_id': self.cid_work.id
+        }, format='json')
+        self.assertEqual(response.data['survivors'], [self.cid_work.id])
+        self.assertFalse(Contact.objects.filter(id=self.cid.id).exists())
+
+        response = self.client.post('/api/contact/contacts/merge/', {'all': True}, format='json')
+        self.assertEqual((response.data['contacts_removed'], response.data['calls_moved']), (1, 2))
+
+        other = User.objects.create_user(username='bob', password='pass12345')
+        theirs = self.contact('Theirs', '+15550005555', user=other)
+        response = self.client.post('/api/contact/contacts/merge/', {
+            'contact_ids': [self.solo.id, theirs.id]
+        }, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.post('/api/contact/contacts/merge/', {}, format='json').status_code, 400)
+
+
+class ContactListFastPathTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for index in range(6):
+            Contact.objects.create(user=self.user, name=f'Zoë {index}', phone_number=f'+1555300{index:04d}',
+                                   email=f'zoe{index}@example.com' if index % 2 else None)
+        Call.objects.create(user=self.user, contact_number='+15553000002', call_status='completed')
+
+    def test_output_is_byte_identical_to_serializer(self):
+        for params in ({'ordering': 'recent'}, {'ordering': 'name', 'search': 'Zoë'}):
+            with self.subTest(params=params):
+                response = self.client.get('/api/contact/contacts/', params)
+                contacts = Contact.objects.filter(user=self.user).order_by(*CONTACT_ORDERINGS[params['ordering']])
+                self.assertEqual(response.content, JSONRenderer().render({
+                    'count': 6, 'next': None, 'previous': None,
+                    'results': ContactListSerializer(contacts, many=True).data,
+                }))
+        self.assertEqual(response.json()['results'][2]['call_count'], 1)
+
+    def test_sparse_fieldset(self):
+        response = self.client.get('/api/contact/contacts/', {'ordering': 'name', 'fields': 'name, last_call_at'})
+        self.assertEqual(list(response.json()['results'][0]), ['name', 'last_call_at'])
+        self.assertEqual(self.client.get('/api/contact/contacts/', {'fields': 'user'}).status_code, 400)
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class ContactChangesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ann = Contact.objects.create(user=self.user, name='Ann', phone_number='+15550001111')
+        self.bob = Contact.objects.create(user=self.user, name='Bob', phone_number='+15550002222')
+        other = User.objects.create_user(username='bob', password='pass12345')
+        Contact.objects.create(user=other, name='Eve', phone_number='+15550003333')
+
+    def changes(self, since=None):
+        response = self.client.get('/api/contact/contacts/changes/', {'since': since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_edits_and_deletes_after_the_cursor(self):
+        page = self.changes()
+        self.assertEqual([row['name'] for row in page['contacts']], ['Ann', 'Bob'])
+        self.assertNotIn('call_count', page['contacts'][0])
+        self.client.patch(f'/api/contact/contacts/{self.ann.id}/', {'name': 'Ann B'}, format='json')
+        self.client.delete(f'/api/contact/contacts/{self.bob.id}/')
+        Contact.objects.get(name='Eve').delete()
+        page = self.changes(page['next_cursor'])
+        self.assertEqual([row['name'] for row in page['contacts']], ['Ann B'])
+        self.assertEqual(page['deleted'], [self.bob.id])
+        self.assertFalse(page['has_more'])
+        self.assertEqual(self.changes(page['next_cursor'])['contacts'], [])
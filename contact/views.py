@@ -3,21 +3,53 @@ from rest_framework.viewsets import ModelViewSet
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
-from django.db.models import Q
-from django.db import transaction
-from .models import Contact
-from .serializers import ContactSerializer, ContactListSerializer
+from django.db.models import Count, Exists, F, Max, Min, OuterRef, Q, Subquery
+from django.db import IntegrityError, transaction
+from django.conf import settings
+from .exports import export_options, stream_export
+from .fast_serializers import FastJSONRenderer
+from .imports import IMPORT_INPUTS, ContactImportError, import_contacts, parse_json, parse_upload, upsert_contacts
+from .merge import find_clusters, merge_clusters
+from .models import CALL_SUMMARY_FIELDS, Contact, normalize_phone_number
+from .search import search_contacts
+from .serializers import CONTACT_LIST_VALUES, CONTACT_SYNC_VALUES, ContactSerializer, ContactListSerializer
 from rest_framework.permissions import IsAuthenticated
 from call.models import Call
-import re
+from call.sync import SyncCursorExpired, changes_since, sync_page_size
+
+UNLINKED_STATS_DEFAULT_LIMIT = 100
+UNLINKED_STATS_MAX_LIMIT = 1000
+
+# ?ordering= for the contact list; recent and frequent are served by the
+# (user, -last_call_at, -id) and (user, -call_count, -id) indexes
+CONTACT_ORDERINGS = {
+    'recent': (F('last_call_at').desc(nulls_last=True), '-id'),
+    'frequent': ('-call_count', '-id'),
+    'name': ('name', 'id'),
+    'created': ('-created_at', '-id'),
+}
+CONTACT_EXPORT_COLUMNS = (
+    'id', 'name', 'phone_number', 'email', 'last_call_at', 'call_count', 'total_talk_seconds',
+    'created_at', 'updated_at',
+)
+
+def duplicate_contact_errors(user, data, instance=None):
+    """Field errors for a write rejected by the per-user unique constraints.
+
+    Only runs after the database has refused the write, so successful writes
+    never pay for these lookups.
+    """
+    contacts = Contact.objects.filter(user=user)
+    if instance is not None:
+        contacts = contacts.exclude(pk=instance.pk)
+    errors = {}
+    normalized = normalize_phone_number(data.get('phone_number', instance.phone_number if instance else ''))
+    if normalized and contacts.filter(normalized_phone=normalized).exists():
+        errors['phone_number'] = ['A contact with this phone number already exists']
+    if data.get('email') and contacts.filter(email=data['email']).exists():
+        errors['email'] = ['A contact with this email already exists']
+    return errors
 
-def normalize_phone_number(phone_number):
-    """Normalize phone number by removing all non-digit characters"""
-    if not phone_number:
-        return ""
-    # Remove all non-digit characters
-    normalized = re.sub(r'\D', '', phone_number)
-    return normalized
 
 # Create your views here.
 class ContactView(ModelViewSet):
@@ -27,7 +59,11 @@ class ContactView(ModelViewSet):
 
     def get_queryset(self):
         """Filter contacts by authenticated user"""
-        return Contact.objects.filter(user=self.request.user)
+        queryset = Contact.objects.filter(user=self.request.user)
+        if self.action in ('retrieve', 'update', 'partial_update', 'link_calls'):
+            # ContactSerializer nests the owning user
+            queryset = queryset.select_related('user')
+        return queryset
     
     def get_serializer_class(self):
         """Use different serializers for different actions"""
@@ -35,62 +71,69 @@ class ContactView(ModelViewSet):
             return ContactListSerializer
         return ContactSerializer
     
+    def get_renderers(self):
+        if self.action in ('list', 'changes'):
+            return [FastJSONRenderer(), *[renderer for renderer in super().get_renderers() if renderer.format != 'json']]
+        return super().get_renderers()
+
     def list(self, request, *args, **kwargs):
         """Enhanced list with search and filtering"""
+        try:
+            fields = CONTACT_LIST_VALUES.select(request.query_params.get('fields'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         queryset = self.get_queryset()
         
         # Search functionality
         search = request.query_params.get('search', None)
         if search:
-            queryset = queryset.filter(
-                Q(name__icontains=search) |
-                Q(phone_number__icontains=search) |
-                Q(email__icontains=search)
-            )
+            queryset = search_contacts(queryset, search)
+
+        ordering = request.query_params.get('ordering')
+        if ordering:
+            if ordering not in CONTACT_ORDERINGS:
+                return Response({
+                    'error': f"ordering must be one of: {', '.join(CONTACT_ORDERINGS)}"
+                }, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.order_by(*CONTACT_ORDERINGS[ordering])
         
+        # values() rows instead of ContactListSerializer; same output, no model instances
+        queryset = CONTACT_LIST_VALUES.values(queryset, fields)
+
         # Pagination
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            return self.get_paginated_response(CONTACT_LIST_VALUES.serialize(page, fields))
         
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        return Response(CONTACT_LIST_VALUES.serialize(queryset, fields))
     
     def create(self, request, *args, **kwargs):
         """Create a new contact and link existing call history"""
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            with transaction.atomic():
-                # Create the contact
-                contact = serializer.save(user=request.user)
-                
-                # Find existing calls with the same phone number for this user
-                phone_number = normalize_phone_number(contact.phone_number)
-                existing_calls = Call.objects.filter(
-                    user=request.user,
-                    contact__isnull=True  # Only calls that don't already have a contact
-                )
-                
-                # Filter calls by normalized phone number
-                matching_calls = []
-                for call in existing_calls:
-                    if normalize_phone_number(call.contact_number) == phone_number:
-                        matching_calls.append(call)
-                
-                # Update all matching calls to link them to this contact
-                linked_calls_count = 0
-                for call in matching_calls:
-                    call.contact = contact
-                    call.save()
-                    linked_calls_count += 1
-                
+            try:
+                with transaction.atomic():
+                    # Create the contact
+                    contact = serializer.save(user=request.user)
+
+                    # Link existing calls with the same phone number in one UPDATE
+                    phone_number = contact.normalized_phone
+                    linked_calls_count = Call.objects.link_to_contact(contact)
+            except IntegrityError:
                 return Response({
-                    'message': 'Contact created successfully',
-                    'contact': ContactSerializer(contact).data,
-                    'linked_calls': linked_calls_count,
-                    'phone_number': phone_number
-                }, status=status.HTTP_201_CREATED)
+                    'error': 'Invalid data',
+                    'details': duplicate_contact_errors(request.user, serializer.validated_data)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if linked_calls_count:
+                # The call triggers updated the summary in the database
+                contact.refresh_from_db(fields=CALL_SUMMARY_FIELDS)
+
+            return Response({
+                'message': 'Contact created successfully',
+                'contact': ContactSerializer(contact).data,
+                'linked_calls': linked_calls_count,
+                'phone_number': phone_number
+            }, status=status.HTTP_201_CREATED)
         return Response({
             'error': 'Invalid data',
             'details': serializer.errors
@@ -102,40 +145,32 @@ class ContactView(ModelViewSet):
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         if serializer.is_valid():
-            with transaction.atomic():
-                # Check if phone number is being updated
-                old_phone_number = instance.phone_number
-                contact = serializer.save()
-                new_phone_number = contact.phone_number
-                
-                linked_calls_count = 0
-                
-                # If phone number changed, link existing calls with the new number
-                if old_phone_number != new_phone_number:
-                    normalized_new_number = normalize_phone_number(new_phone_number)
-                    existing_calls = Call.objects.filter(
-                        user=request.user,
-                        contact__isnull=True  # Only calls that don't already have a contact
-                    )
-                    
-                    # Filter calls by normalized phone number
-                    matching_calls = []
-                    for call in existing_calls:
-                        if normalize_phone_number(call.contact_number) == normalized_new_number:
-                            matching_calls.append(call)
-                    
-                    # Update all matching calls to link them to this contact
-                    for call in matching_calls:
-                        call.contact = contact
-                        call.save()
-                        linked_calls_count += 1
-                
+            # Check if phone number is being updated
+            old_phone_number = instance.phone_number
+            try:
+                with transaction.atomic():
+                    contact = serializer.save()
+                    new_phone_number = contact.phone_number
+
+                    linked_calls_count = 0
+
+                    # If phone number changed, link existing calls with the new number
+                    if old_phone_number != new_phone_number:
+                        linked_calls_count = Call.objects.link_to_contact(contact)
+            except IntegrityError:
                 return Response({
-                    'message': 'Contact updated successfully',
-                    'contact': ContactSerializer(contact).data,
-                    'linked_calls': linked_calls_count,
-                    'phone_number': new_phone_number
-                })
+                    'error': 'Invalid data',
+                    'details': duplicate_contact_errors(request.user, serializer.validated_data, instance)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if linked_calls_count:
+                contact.refresh_from_db(fields=CALL_SUMMARY_FIELDS)
+
+            return Response({
+                'message': 'Contact updated successfully',
+                'contact': ContactSerializer(contact).data,
+                'linked_calls': linked_calls_count,
+                'phone_number': new_phone_number
+            })
         return Response({
             'error': 'Invalid data',
             'details': serializer.errors
@@ -158,83 +193,257 @@ class ContactView(ModelViewSet):
                 'error': 'Search query is required'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        contacts = self.get_queryset().filter(
-            Q(name__icontains=query) |
-            Q(phone_number__icontains=query) |
-            Q(email__icontains=query)
-        )
+        contacts = search_contacts(self.get_queryset(), query)
         
         serializer = ContactListSerializer(contacts, many=True)
         return Response({
             'contacts': serializer.data,
-            'count': contacts.count(),
+            'count': len(serializer.data),
             'query': query
         })
     
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        """Import many contacts from an uploaded CSV/vCard/JSON file or a JSON array body"""
+        upload = request.FILES.get('file')
+        kind = request.query_params.get('input')
+        if kind and kind not in IMPORT_INPUTS:
+            return Response({
+                'error': f"input must be one of: {', '.join(IMPORT_INPUTS)}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            rows = parse_upload(upload, kind) if upload else parse_json(request.data)
+        except ContactImportError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.CONTACT_IMPORT_MAX_ROWS:
+            return Response({
+                'error': f'At most {settings.CONTACT_IMPORT_MAX_ROWS} contacts can be imported at once'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        report = import_contacts(request.user, rows)
+        return Response({
+            'message': f"Imported {report['created']} of {report['received']} contacts",
+            **report
+        }, status=status.HTTP_201_CREATED if report['created'] else status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['post'])
+    def upsert(self, request):
+        """Create or update contacts keyed on phone number, one statement per batch
+
+        Accepts one contact object or a list. A contact whose canonical
+        number already exists is updated in place (an omitted email is kept).
+        """
+        rows = request.data if isinstance(request.data, list) else [request.data]
+        if len(rows) > settings.CONTACT_IMPORT_MAX_ROWS:
+            return Response({
+                'error': f'At most {settings.CONTACT_IMPORT_MAX_ROWS} contacts can be upserted at once'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        report = upsert_contacts(request.user, rows)
+        return Response({
+            'message': f"Created {report['created']} and updated {report['updated']} contacts",
+            **report
+        }, status=status.HTTP_400_BAD_REQUEST if report['failed'] and not report['contacts'] else status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def duplicates(self, request):
+        """Groups of the user's contacts that look like the same person"""
+        mergeable, conflicts = find_clusters(self.get_queryset())
+        contacts = Contact.objects.in_bulk([contact_id for cluster in mergeable + conflicts for contact_id in cluster])
+        groups = [
+            {
+                'contacts': ContactListSerializer([contacts[contact_id] for contact_id in cluster], many=True).data,
+                'conflict': cluster in conflicts,
+            }
+            for cluster in mergeable + conflicts
+        ]
+        return Response({
+            'duplicates': groups,
+            'count': len(groups),
+            'mergeable': len(mergeable)
+        })
+
+    @action(detail=False, methods=['post'])
+    def merge(self, request):
+        """Merge contacts into one, moving their calls
+
+        Send ``contact_ids`` (merged into ``survivor_id``, or the oldest) or
+        ``all: true`` to merge every non-conflicting duplicate group.
+        """
+        data = request.data if isinstance(request.data, dict) else {}
+        if data.get('all'):
+            clusters, _ = find_clusters(self.get_queryset())
+        else:
+            contact_ids = data.get('contact_ids')
+            try:
+                contact_ids = sorted({int(contact_id) for contact_id in contact_ids})
+            except (TypeError, ValueError):
+                contact_ids = []
+            if len(contact_ids) < 2:
+                return Response({
+                    'error': 'contact_ids must list at least two contacts, or pass all: true'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if self.get_queryset().filter(id__in=contact_ids).count() != len(contact_ids):
+                return Response({'error': 'Contact not found'}, status=status.HTTP_404_NOT_FOUND)
+            survivor_id = data.get('survivor_id')
+            if survivor_id is not None:
+                try:
+                    contact_ids.remove(int(survivor_id))
+                except (TypeError, ValueError):
+                    return Response({
+                        'error': 'survivor_id must be one of contact_ids'
+                    }, status=status.HTTP_400_BAD_REQUEST)
+                contact_ids.insert(0, int(survivor_id))
+            clusters = [contact_ids]
+
+        removed, calls_moved = merge_clusters(clusters, user=request.user)
+        return Response({
+            'message': f'Merged {removed} duplicate contacts',
+            'groups': len(clusters),
+            'contacts_removed': removed,
+            'calls_moved': calls_moved,
+            'survivors': [cluster[0] for cluster in clusters]
+        })
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream the user's contacts as CSV or NDJSON (search and ordering as in list)"""
+        try:
+            output, compress = export_options(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        ordering = request.query_params.get('ordering', 'created')
+        if ordering not in CONTACT_ORDERINGS:
+            return Response({
+                'error': f"ordering must be one of: {', '.join(CONTACT_ORDERINGS)}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        contacts = Contact.objects.filter(user=request.user)
+        search = request.query_params.get('search')
+        if search:
+            contacts = search_contacts(contacts, search)
+        contacts = contacts.order_by(*CONTACT_ORDERINGS[ordering])
+        return stream_export(contacts, CONTACT_EXPORT_COLUMNS, 'contacts', output, compress)
+    
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """Contacts changed or deleted since the ?since= cursor (see call.sync)"""
+        try:
+            fields = CONTACT_SYNC_VALUES.select(request.query_params.get('fields'))
+            changes = changes_since(
+                self.get_queryset(), 'contact', request.user, request.query_params.get('since'),
+                CONTACT_SYNC_VALUES, fields, sync_page_size(request.query_params),
+            )
+        except SyncCursorExpired as e:
+            return Response({'error': str(e)}, status=status.HTTP_410_GONE)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'contacts': changes['changed'],
+            'deleted': changes['deleted'],
+            'next_cursor': changes['next_cursor'],
+            'has_more': changes['has_more'],
+        })
+    
     @action(detail=False, methods=['get'])
     def unlinked_calls_stats(self, request):
-        """Get statistics about unlinked calls and potential contact matches"""
+        """Get statistics about unlinked calls and potential contact matches
+
+        Calls are grouped by normalized number in SQL and joined against the
+        user's contacts. All matches are returned unless ``limit`` or
+        ``cursor`` is passed; then one page of numbers is returned, and the
+        returned ``next_cursor`` is passed as ``cursor`` to fetch the next.
+        """
+        paged = 'limit' in request.query_params or 'cursor' in request.query_params
+        try:
+            limit = int(request.query_params.get('limit', UNLINKED_STATS_DEFAULT_LIMIT))
+        except ValueError:
+            limit = UNLINKED_STATS_DEFAULT_LIMIT
+        limit = max(1, min(limit, UNLINKED_STATS_MAX_LIMIT))
+        cursor = request.query_params.get('cursor')
+
         # Get all unlinked calls for the user
         unlinked_calls = Call.objects.filter(
             user=request.user,
             contact__isnull=True
         )
-        
-        # Group by phone number to find potential matches
-        phone_number_groups = {}
-        for call in unlinked_calls:
-            normalized_number = normalize_phone_number(call.contact_number)
-            if normalized_number:
-                if normalized_number not in phone_number_groups:
-                    phone_number_groups[normalized_number] = {
-                        'count': 0,
-                        'original_numbers': set(),
-                        'first_call': call.created_at,
-                        'last_call': call.created_at
-                    }
-                phone_number_groups[normalized_number]['count'] += 1
-                phone_number_groups[normalized_number]['original_numbers'].add(call.contact_number)
-                phone_number_groups[normalized_number]['first_call'] = min(
-                    phone_number_groups[normalized_number]['first_call'], 
-                    call.created_at
-                )
-                phone_number_groups[normalized_number]['last_call'] = max(
-                    phone_number_groups[normalized_number]['last_call'], 
-                    call.created_at
-                )
-        
-        # Find phone numbers that could be linked to existing contacts
-        potential_matches = []
-        for normalized_number, data in phone_number_groups.items():
-            existing_contact = Contact.objects.filter(
-                user=request.user,
-                phone_number__regex=r'[^\d]*' + re.escape(normalized_number) + r'[^\d]*'
-            ).first()
-            
-            if existing_contact:
-                potential_matches.append({
-                    'phone_number': normalized_number,
-                    'contact_name': existing_contact.name,
-                    'contact_id': existing_contact.id,
-                    'call_count': data['count'],
-                    'original_numbers': list(data['original_numbers']),
-                    'first_call': data['first_call'],
-                    'last_call': data['last_call']
-                })
-        
+        totals = unlinked_calls.aggregate(
+            total=Count('id'),
+            unique_numbers=Count('normalized_number', distinct=True, filter=~Q(normalized_number=''))
+        )
+
+        # Group by phone number and keep only numbers that match a contact
+        matching_contacts = Contact.objects.filter(
+            user=request.user,
+            normalized_phone=OuterRef('normalized_number')
+        ).order_by('id')
+        matched_calls = unlinked_calls.exclude(normalized_number='').filter(Exists(matching_contacts))
+        matched_groups = matched_calls.values('normalized_number').order_by('normalized_number')
+        potential_matches_count = matched_groups.distinct().count()
+
+        page_groups = matched_groups
+        if cursor:
+            page_groups = page_groups.filter(normalized_number__gt=cursor)
+        page_groups = page_groups.annotate(
+            call_count=Count('id'),
+            first_call=Min('created_at'),
+            last_call=Max('created_at'),
+            matched_contact_id=Subquery(matching_contacts.values('id')[:1]),
+            matched_contact_name=Subquery(matching_contacts.values('name')[:1]),
+        )
+        if paged:
+            page_groups = list(page_groups[:limit + 1])
+            has_more = len(page_groups) > limit
+            page_groups = page_groups[:limit]
+            page_numbers = [group['normalized_number'] for group in page_groups]
+            page_calls = unlinked_calls.filter(normalized_number__in=page_numbers)
+        else:
+            page_groups = list(page_groups)
+            has_more = False
+            page_calls = matched_calls
+
+        # Collect the distinct raw numbers of the returned matches only
+        original_numbers = {}
+        for row in (
+            page_calls
+            .values('normalized_number', 'contact_number')
+            .order_by()
+            .distinct()
+        ):
+            original_numbers.setdefault(row['normalized_number'], []).append(row['contact_number'])
+
+        potential_matches = [
+            {
+                'phone_number': group['normalized_number'],
+                'contact_name': group['matched_contact_name'],
+                'contact_id': group['matched_contact_id'],
+                'call_count': group['call_count'],
+                'original_numbers': original_numbers.get(group['normalized_number'], []),
+                'first_call': group['first_call'],
+                'last_call': group['last_call']
+            }
+            for group in page_groups
+        ]
+
         return Response({
-            'total_unlinked_calls': unlinked_calls.count(),
-            'unique_phone_numbers': len(phone_number_groups),
+            'total_unlinked_calls': totals['total'],
+            'unique_phone_numbers': totals['unique_numbers'],
             'potential_matches': potential_matches,
-            'potential_matches_count': len(potential_matches)
+            'potential_matches_count': potential_matches_count,
+            'next_cursor': page_groups[-1]['normalized_number'] if has_more else None
         })
     
     @action(detail=False, methods=['get'])
     def stats(self, request):
         """Get contact statistics"""
-        total_contacts = self.get_queryset().count()
-        contacts_with_email = self.get_queryset().filter(email__isnull=False).exclude(email='').count()
-        contacts_with_phone = self.get_queryset().filter(phone_number__isnull=False).exclude(phone_number='').count()
+        counts = self.get_queryset().aggregate(
+            total=Count('id'),
+            with_email=Count('id', filter=Q(email__isnull=False) & ~Q(email='')),
+            with_phone=Count('id', filter=Q(phone_number__isnull=False) & ~Q(phone_number=''))
+        )
+        total_contacts = counts['total']
+        contacts_with_email = counts['with_email']
+        contacts_with_phone = counts['with_phone']
         
         return Response({
             'total_contacts': total_contacts,
@@ -252,24 +461,9 @@ class ContactView(ModelViewSet):
         contact = self.get_object()
         
         with transaction.atomic():
-            normalized_phone_number = normalize_phone_number(contact.phone_number)
-            existing_calls = Call.objects.filter(
-                user=request.user,
-                contact__isnull=True  # Only calls that don't already have a contact
-            )
-            
-            # Filter calls by normalized phone number
-            matching_calls = []
-            for call in existing_calls:
-                if normalize_phone_number(call.contact_number) == normalized_phone_number:
-                    matching_calls.append(call)
-            
-            # Update all matching calls to link them to this contact
-            linked_calls_count = 0
-            for call in matching_calls:
-                call.contact = contact
-                call.save()
-                linked_calls_count += 1
+            linked_calls_count = Call.objects.link_to_contact(contact)
+            if linked_calls_count:
+                contact.refresh_from_db(fields=CALL_SUMMARY_FIELDS)
             
             return Response({
                 'message': f'Successfully linked {linked_calls_count} calls to contact',
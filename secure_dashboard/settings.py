@@ -160,15 +160,44 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authentication.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    # Sliding-window rates for authentication.ratelimit; '5/5m' is 5 per 5 minutes
+    'DEFAULT_THROTTLE_RATES': {
+        'login': os.getenv('THROTTLE_RATE_LOGIN', '10/5m'),
+        'login_ip': os.getenv('THROTTLE_RATE_LOGIN_IP', '100/5m'),
+        'register': os.getenv('THROTTLE_RATE_REGISTER', '20/h'),
+        'webauthn_begin': os.getenv('THROTTLE_RATE_WEBAUTHN_BEGIN', '5/5m'),
+        'webauthn_complete': os.getenv('THROTTLE_RATE_WEBAUTHN_COMPLETE', '5/5m'),
+    },
+}
+
+# Cache for the auth user cache, the 'cache' rate limiter and the 'cache'
+# challenge store. The LocMem default is per process: with several workers set
+# CACHE_BACKEND/CACHE_LOCATION to a shared cache, e.g.
+# django.core.cache.backends.redis.RedisCache (needs the redis package) and redis://host:6379/0
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
 }
 
+# Users resolved from JWTs are cached per id; use a shared cache with several workers
+AUTH_USER_CACHE_ALIAS = os.getenv('AUTH_USER_CACHE_ALIAS', 'default')
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', '60'))  # seconds
+
+# Rate limiter storage: 'local' (per process) or 'cache' (RATE_LIMIT_CACHE_ALIAS,
+# shared by all workers when that cache is Redis or Memcached)
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'local')
+RATE_LIMIT_CACHE_ALIAS = os.getenv('RATE_LIMIT_CACHE_ALIAS', 'default')
+RATE_LIMIT_LOCAL_MAX_KEYS = int(os.getenv('RATE_LIMIT_LOCAL_MAX_KEYS', '100000'))
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # For development only - use CORS_ALLOWED_ORIGINS in production
 
@@ -237,6 +266,36 @@ TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN', '')  # Legacy, use TWILIO_API
 TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER', '')
 TWILIO_CALLER_ID = os.getenv('TWILIO_CALLER_ID', TWILIO_PHONE_NUMBER)  # Fallback to phone number
 TWIML_APP_SID = os.getenv('TWIML_APP_SID', '')
+TWILIO_TOKEN_TTL = int(os.getenv('TWILIO_TOKEN_TTL', '3600'))  # seconds
+TWILIO_TOKEN_REFRESH_MARGIN = int(os.getenv('TWILIO_TOKEN_REFRESH_MARGIN', '300'))  # mint anew this close to expiry
+
+# Write-behind queue for calls created by the voice webhooks
+CALL_WRITE_BEHIND = os.getenv('CALL_WRITE_BEHIND', 'True').lower() == 'true'
+CALL_WRITE_QUEUE_MAX_SIZE = int(os.getenv('CALL_WRITE_QUEUE_MAX_SIZE', '10000'))
+CALL_WRITE_QUEUE_BATCH_SIZE = int(os.getenv('CALL_WRITE_QUEUE_BATCH_SIZE', '500'))
+CALL_WRITE_QUEUE_FLUSH_INTERVAL = float(os.getenv('CALL_WRITE_QUEUE_FLUSH_INTERVAL', '0.2'))  # seconds
+CALL_WRITE_QUEUE_JOURNAL_DIR = os.getenv('CALL_WRITE_QUEUE_JOURNAL_DIR', str(BASE_DIR / 'logs' / 'call_queue'))
+# Status callbacks for calls that were never written are discarded after this long
+CALL_PENDING_STATUS_TTL = int(os.getenv('CALL_PENDING_STATUS_TTL', '86400'))  # seconds
+
+# In-process phone number -> contact cache used by the voice webhooks
+CALLER_CACHE_MAX_SIZE = int(os.getenv('CALLER_CACHE_MAX_SIZE', '10000'))
+CALLER_CACHE_TTL = float(os.getenv('CALLER_CACHE_TTL', '300'))  # seconds
+CALLER_CACHE_NEGATIVE_TTL = float(os.getenv('CALLER_CACHE_NEGATIVE_TTL', '30'))  # seconds
+
+# Streaming CSV/NDJSON exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))  # rows fetched and written per batch
+EXPORT_GZIP_LEVEL = int(os.getenv('EXPORT_GZIP_LEVEL', '6'))
+
+# Bulk contact import
+CONTACT_IMPORT_MAX_ROWS = int(os.getenv('CONTACT_IMPORT_MAX_ROWS', '100000'))
+CONTACT_IMPORT_BATCH_SIZE = int(os.getenv('CONTACT_IMPORT_BATCH_SIZE', '1000'))  # rows per INSERT / lookup
+
+# Delta-sync changes endpoints
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', '500'))  # default and maximum rows per page
+# The cursor never passes changes younger than this, so it must exceed the longest write transaction
+SYNC_SETTLE_SECONDS = float(os.getenv('SYNC_SETTLE_SECONDS', '60'))
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.getenv('SYNC_TOMBSTONE_RETENTION_DAYS', '30'))
 
 # Base URL for webhooks and callbacks
 # For local development, use localhost
@@ -250,3 +309,10 @@ FIREBASE_CREDENTIALS_PATH = os.getenv('FIREBASE_CREDENTIALS_PATH', '')
 WEBAUTHN_RP_ID = os.getenv('WEBAUTHN_RP_ID', 'localhost')
 WEBAUTHN_RP_NAME = os.getenv('WEBAUTHN_RP_NAME', 'Secure Dashboard')
 WEBAUTHN_RP_ORIGIN = os.getenv('WEBAUTHN_RP_ORIGIN', 'http://localhost:5173')
+
+# Where pending WebAuthn challenges live between begin and complete:
+# 'database' (shared by all workers), 'cache' (WEBAUTHN_CHALLENGE_CACHE_ALIAS in
+# CACHES above; shared when that cache is Redis/Memcached) or 'memory' (single process only)
+WEBAUTHN_CHALLENGE_STORE = os.getenv('WEBAUTHN_CHALLENGE_STORE', 'database')
+WEBAUTHN_CHALLENGE_CACHE_ALIAS = os.getenv('WEBAUTHN_CHALLENGE_CACHE_ALIAS', 'default')
+WEBAUTHN_CHALLENGE_TTL = int(os.getenv('WEBAUTHN_CHALLENGE_TTL', '600'))  # seconds